@@ -0,0 +1,167 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+
+"""
+containerd reverse proxy throughput benchmark. Runs a Proxy in a child
+process between a loopback TCP client and a UNIX socket server, and
+measures download (server to client) and upload throughput along with
+the CPU time used by the proxy process.
+
+Modes: legacy (4K buffer, the former behaviour), buffered (adaptive
+buffer), splice (splice(2) through a pipe, Linux only).
+
+Usage: python3 proxy_throughput.py [-s 512] [-m legacy,buffered,splice]
+"""
+
+import os
+import sys
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+
+
+CHUNK = 1024 * 1024
+
+
+def serve_proxy(target, mode):
+    import gevent.monkey
+    gevent.monkey.patch_all()
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+    import proxy
+
+    if mode == 'legacy':
+        p = proxy.Proxy(0, target, bufsize=4096, max_bufsize=4096, splice=False)
+    else:
+        p = proxy.Proxy(0, target, splice=(mode == 'splice'))
+
+    p.bind()
+    print(p.sock.getsockname()[1], flush=True)
+    p.serve()
+
+
+def unix_server(path, size, received):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.bind(path)
+    s.listen(8)
+
+    def handle(conn):
+        direction = conn.recv(1)
+        if direction == b'D':
+            data = b'\0' * CHUNK
+            for i in range(size // CHUNK):
+                conn.sendall(data)
+        else:
+            total = 0
+            buf = bytearray(CHUNK)
+            while True:
+                n = conn.recv_into(buf)
+                if not n:
+                    break
+
+                total += n
+
+            received.append(total)
+
+        conn.close()
+
+    while True:
+        conn, _ = s.accept()
+        threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+
+def transfer(port, direction, size):
+    c = socket.create_connection(('127.0.0.1', port))
+    start = time.perf_counter()
+    c.sendall(direction)
+    total = 0
+    if direction == b'D':
+        buf = bytearray(CHUNK)
+        while True:
+            n = c.recv_into(buf)
+            if not n:
+                break
+
+            total += n
+    else:
+        data = b'\0' * CHUNK
+        for i in range(size // CHUNK):
+            c.sendall(data)
+
+        total = size
+        c.shutdown(socket.SHUT_WR)
+        c.recv(1)
+
+    c.close()
+    return total, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', metavar='MB', type=int, default=512)
+    parser.add_argument('-m', metavar='MODES', default='legacy,buffered,splice')
+    parser.add_argument('--serve', nargs=2, metavar=('TARGET', 'MODE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve_proxy(*args.serve)
+        return
+
+    size = args.s * 1024 * 1024
+    path = os.path.join(tempfile.mkdtemp(), 'proxy.sock')
+    received = []
+    threading.Thread(target=unix_server, args=(path, size, received), daemon=True).start()
+    while not os.path.exists(path):
+        time.sleep(0.01)
+
+    for mode in args.m.split(','):
+        if mode == 'splice' and not hasattr(os, 'splice'):
+            print('{0:>9}: not supported on this platform'.format(mode))
+            continue
+
+        child = subprocess.Popen([sys.executable, __file__, '--serve', path, mode], stdout=subprocess.PIPE)
+        port = int(child.stdout.readline())
+        results = []
+        for direction in (b'D', b'U'):
+            results.append(transfer(port, direction, size))
+
+        child.terminate()
+        _, _, rusage = os.wait4(child.pid, 0)
+        print('{0:>9}: download {1:7.1f} MB/s, upload {2:7.1f} MB/s, proxy CPU {3:.2f}s{4}'.format(
+            mode,
+            results[0][0] / results[0][1] / 1024 / 1024,
+            results[1][0] / results[1][1] / 1024 / 1024,
+            rusage.ru_utime + rusage.ru_stime,
+            '' if results[0][0] == size and received[-1] == size else '  SHORT TRANSFER'
+        ))
+
+
+if __name__ == '__main__':
+    main()
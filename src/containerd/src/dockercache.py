@@ -0,0 +1,347 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+
+import logging
+import gevent.pool
+from datetime import datetime
+from gevent.lock import RLock
+from docker.errors import NotFound
+from freenas.utils import query as q
+
+
+SYNC_CONCURRENCY = 8
+
+
+def get_docker_ports(details):
+    if 'HostConfig' not in details:
+        return
+
+    if 'PortBindings' not in details['HostConfig']:
+        return
+
+    if not details['HostConfig']['PortBindings']:
+        return
+
+    for port, config in details['HostConfig']['PortBindings'].items():
+        num, proto = port.split('/')
+        yield {
+            'protocol': proto.upper(),
+            'container_port': int(num),
+            'host_port': int(config[0]['HostPort'])
+        }
+
+
+def get_docker_volumes(details):
+    if 'Mounts' not in details:
+        return
+
+    for mnt in details['Mounts']:
+        yield {
+            'host_path': mnt['Source'],
+            'container_path': mnt['Destination'],
+            'readonly': not mnt['RW'],
+            'source': 'HOST' if mnt['Source'].startswith('/mnt') else 'VM'
+        }
+
+
+def get_interactive(details):
+    config = details.get('Config')
+    if not config:
+        return False
+
+    return config.get('Tty') and config.get('OpenStdin')
+
+
+def normalize_names(names):
+    for i in names:
+        if i[0] == '/':
+            yield i[1:]
+        else:
+            yield i
+
+
+def convert_container(host_id, container, details):
+    external = q.get(details, 'NetworkSettings.Networks.external')
+    return {
+        'id': container['Id'],
+        'image': container['Image'],
+        'names': list(normalize_names(container['Names'])),
+        'command': container['Command'] if isinstance(container['Command'], list) else [container['Command']],
+        'status': container['Status'],
+        'running': details['State'].get('Running', False),
+        'host': host_id,
+        'ports': list(get_docker_ports(details)),
+        'volumes': list(get_docker_volumes(details)),
+        'interactive': get_interactive(details),
+        'labels': details['Config']['Labels'],
+        'expose_ports': 'org.freenas.expose-ports-at-host' in details['Config']['Labels'],
+        'autostart': 'org.freenas.autostart' in details['Config']['Labels'],
+        'environment': details['Config']['Env'],
+        'hostname': details['Config']['Hostname'],
+        'exec_ids': details['ExecIDs'] or [],
+        'bridge': {
+            'enabled': external is not None,
+            'address': external['IPAddress'] if external else None
+        }
+    }
+
+
+def convert_image(image, hosts):
+    return {
+        'id': image['Id'],
+        'names': image['RepoTags'],
+        'size': image['VirtualSize'],
+        'labels': image['Labels'],
+        'hosts': hosts,
+        'created_at': datetime.utcfromtimestamp(int(image['Created']))
+    }
+
+
+class CacheTable(object):
+    """
+    Objects keyed by id with secondary indexes. indexes maps a field name
+    to True if the field holds a list of values, False for a scalar.
+    Stored objects are never modified in place, only replaced.
+    """
+    def __init__(self, indexes):
+        self.objects = {}
+        self.indexes = {f: {} for f in indexes}
+        self.multivalued = indexes
+
+    def index_values(self, obj, field):
+        value = q.get(obj, field)
+        if value is None:
+            return []
+
+        return value if self.multivalued[field] else [value]
+
+    def get(self, id):
+        return self.objects.get(id)
+
+    def put(self, obj):
+        self.remove(obj['id'])
+        self.objects[obj['id']] = obj
+        for field, index in self.indexes.items():
+            for v in self.index_values(obj, field):
+                index.setdefault(v, set()).add(obj['id'])
+
+    def remove(self, id):
+        obj = self.objects.pop(id, None)
+        if not obj:
+            return
+
+        for field, index in self.indexes.items():
+            for v in self.index_values(obj, field):
+                ids = index.get(v)
+                if ids:
+                    ids.discard(id)
+                    if not ids:
+                        del index[v]
+
+    def lookup(self, term):
+        # Returns set of ids matching the filter term, or None if the term
+        # cannot be answered from the indexes
+        if len(term) == 2 and term[0] == 'or':
+            result = set()
+            for i in term[1]:
+                ids = self.lookup(i)
+                if ids is None:
+                    return None
+
+                result |= ids
+
+            return result
+
+        if len(term) != 3:
+            return None
+
+        field, op, value = term
+        try:
+            if field == 'id':
+                if op == '=':
+                    return {value}
+
+                if op == 'in':
+                    return set(value)
+
+            index = self.indexes.get(field)
+            if index is None:
+                return None
+
+            if op == ('contains' if self.multivalued[field] else '='):
+                return set(index.get(value, ()))
+
+            if op == 'in' and not self.multivalued[field]:
+                return set().union(*(index.get(v, ()) for v in value))
+        except TypeError:
+            # Unhashable value
+            pass
+
+        return None
+
+    def query(self, filter=None, params=None):
+        candidates = None
+        for term in filter or []:
+            ids = self.lookup(term)
+            if ids is not None and (candidates is None or len(ids) < len(candidates)):
+                candidates = ids
+
+        if candidates is None:
+            objects = list(self.objects.values())
+        else:
+            objects = [self.objects[i] for i in candidates if i in self.objects]
+
+        return q.query(objects, *(filter or []), stream=True, **(params or {}))
+
+
+class DockerCache(object):
+    """
+    Container and image details of all Docker hosts. Kept current by
+    DockerHost from the Docker event stream; a full sync of a host is
+    only needed when its event stream is (re)connected.
+    """
+    def __init__(self):
+        self.lock = RLock()
+        self.containers = CacheTable({'host': False, 'names': True, 'exec_ids': True})
+        self.images = CacheTable({'hosts': True, 'names': True})
+        self.host_images = {}
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def query_containers(self, filter=None, params=None):
+        with self.lock:
+            return self.containers.query(filter, params)
+
+    def query_images(self, filter=None, params=None):
+        with self.lock:
+            return self.images.query(filter, params)
+
+    def host_by_container(self, id):
+        with self.lock:
+            container = self.containers.get(id)
+            return container['host'] if container else None
+
+    def image_hosts(self, id):
+        with self.lock:
+            image = self.images.get(id)
+            return image['hosts'] if image else []
+
+    def fetch_container(self, connection, id):
+        # Returns (list entry, inspect details) or None if the container is gone
+        try:
+            container = connection.containers(all=True, filters={'id': id})
+            if not container:
+                return None
+
+            return container[0], connection.inspect_container(id)
+        except NotFound:
+            return None
+
+    def update_container(self, host_id, connection, id):
+        """
+        Refreshes a single container. Returns inspect details, or None
+        if the container no longer exists.
+        """
+        fetched = self.fetch_container(connection, id)
+        with self.lock:
+            if not fetched:
+                self.containers.remove(id)
+                return None
+
+            container, details = fetched
+            self.containers.put(convert_container(host_id, container, details))
+            return details
+
+    def sync_host(self, host_id, connection):
+        """
+        Full resync of containers and images of a host. Returns changes
+        as {'containers': {operation: ids}, 'images': {operation: ids}}.
+        """
+        def inspect(container):
+            try:
+                return container, connection.inspect_container(container['Id'])
+            except NotFound:
+                return None
+
+        listing = connection.containers(all=True)
+        pool = gevent.pool.Pool(SYNC_CONCURRENCY)
+        fetched = [i for i in pool.imap_unordered(inspect, listing) if i]
+
+        with self.lock:
+            changes = {'create': [], 'update': [], 'delete': []}
+            present = set()
+            for container, details in fetched:
+                present.add(container['Id'])
+                changes['update' if self.containers.get(container['Id']) else 'create'].append(container['Id'])
+                self.containers.put(convert_container(host_id, container, details))
+
+            for id in list(self.containers.indexes['host'].get(host_id, ())):
+                if id not in present:
+                    self.containers.remove(id)
+                    changes['delete'].append(id)
+
+        self.logger.debug('Synced {0} containers of host {1}'.format(len(present), host_id))
+        return {'containers': changes, 'images': self.sync_images(host_id, connection)}
+
+    def sync_images(self, host_id, connection):
+        """
+        Relists images of a host. Returns changes as {operation: ids}, where
+        an image still present on other hosts is reported as updated.
+        """
+        images = {i['Id']: i for i in connection.images()}
+        with self.lock:
+            old = self.host_images.get(host_id, {})
+            self.host_images[host_id] = images
+            return self.update_images(set(old) | set(images))
+
+    def remove_host(self, host_id):
+        with self.lock:
+            containers = list(self.containers.indexes['host'].get(host_id, ()))
+            for id in containers:
+                self.containers.remove(id)
+
+            old = self.host_images.pop(host_id, {})
+            return {'containers': {'delete': containers}, 'images': self.update_images(set(old))}
+
+    def update_images(self, ids):
+        # Rebuilds aggregated entries of given images from per-host listings
+        changes = {'create': [], 'update': [], 'delete': []}
+        for id in ids:
+            hosts = [h for h, images in self.host_images.items() if id in images]
+            existing = self.images.get(id)
+            if not hosts:
+                if existing:
+                    self.images.remove(id)
+                    changes['delete'].append(id)
+                continue
+
+            image = convert_image(self.host_images[hosts[0]][id], sorted(hosts))
+            if image != existing:
+                self.images.put(image)
+                changes['update' if existing else 'create'].append(id)
+
+        return changes
@@ -55,8 +55,7 @@ import pf
 import urllib.parse
 import requests
 import contextlib
-from docker.errors import NotFound, DockerException
-from datetime import datetime
+from docker.errors import DockerException
 from bsd import kld, sysctl
 from threading import Condition
 from gevent.queue import Queue
@@ -75,6 +74,7 @@ from vnc import app
 from mgmt import ManagementNetwork
 from ec2 import EC2MetadataServer
 from proxy import ReverseProxyServer
+from dockercache import DockerCache, get_docker_ports
 
 
 BOOTROM_PATH = '/usr/local/share/uefi-firmware/BHYVE_UEFI.fd'
@@ -112,56 +112,120 @@ def generate_id():
     return ''.join([random.choice(string.ascii_letters + string.digits) for _ in range(32)])
 
 
-def get_docker_ports(details):
-    if 'HostConfig' not in details:
-        return
-
-    if 'PortBindings' not in details['HostConfig']:
-        return
-
-    if not details['HostConfig']['PortBindings']:
-        return
-
-    for port, config in details['HostConfig']['PortBindings'].items():
-        num, proto = port.split('/')
-        yield {
-            'protocol': proto.upper(),
-            'container_port': int(num),
-            'host_port': int(config[0]['HostPort'])
-        }
-
-
-def get_docker_volumes(details):
-    if 'Mounts' not in details:
-        return
+class BinaryRingBuffer(object):
+    """
+    Fixed capacity circular byte buffer. Contents are stored twice, back to
+    back, so any window of up to size bytes is contiguous and can be handed
+    out as a memoryview. Positions are absolute byte counts since creation,
+    which lets every subscriber keep its own offset into the buffer.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.data = bytearray(size * 2)
+        self.view = memoryview(self.data)
+        self.written = 0
+        self.waiting = 0
+        self.changed = Event()
 
-    for mnt in details['Mounts']:
-        yield {
-            'host_path': mnt['Source'],
-            'container_path': mnt['Destination'],
-            'readonly': not mnt['RW'],
-            'source': 'HOST' if mnt['Source'].startswith('/mnt') else 'VM'
-        }
+    @property
+    def start(self):
+        # Oldest position still available
+        return max(self.written - self.size, 0)
 
+    def push(self, data):
+        size = self.size
+        length = len(data)
+        if length > size:
+            # Only the tail fits, the rest is overwritten right away
+            self.written += length - size
+            data = data[-size:]
+            length = size
+
+        if not length:
+            return
 
-def get_interactive(details):
-    config = details.get('Config')
-    if not config:
-        return False
+        pos = self.written % size
+        if pos + length <= size:
+            self.data[pos:pos + length] = data
+            self.data[pos + size:pos + size + length] = data
+        else:
+            first = size - pos
+            head, tail = data[:first], data[first:]
+            self.data[pos:size] = head
+            self.data[pos + size:] = head
+            self.data[:length - first] = tail
+            self.data[size:size + length - first] = tail
+
+        self.written += length
+        if self.waiting:
+            changed, self.changed = self.changed, Event()
+            changed.set()
+
+    def read(self, start=None):
+        """
+        Returns data from absolute position start (oldest available by
+        default) up to now, without copying. Only valid until the next push.
+        """
+        start = self.start if start is None else max(start, self.start)
+        pos = start % self.size
+        return self.view[pos:pos + self.written - start]
+
+    def subscribe(self, history=True):
+        return RingBufferReader(self, self.start if history else self.written)
+
+
+class RingBufferReader(object):
+    """
+    Subscriber cursor into a BinaryRingBuffer. A reader falling more than
+    the buffer size behind loses the overwritten data, read() reports how
+    many bytes were skipped.
+    """
+    def __init__(self, buffer, offset):
+        self.buffer = buffer
+        self.offset = offset
+        self.lost = 0
+        self.overruns = 0
+        self.closed = Event()
 
-    return config.get('Tty') and config.get('OpenStdin')
+    @property
+    def lag(self):
+        return self.buffer.written - self.offset
 
+    def close(self):
+        self.closed.set()
 
-class BinaryRingBuffer(object):
-    def __init__(self, size):
-        self.data = bytearray(size)
+    def read(self):
+        """
+        Waits for new data. Returns a (data, skipped bytes) tuple, or None
+        once the reader is closed. data is only valid until the next push.
+        """
+        buffer = self.buffer
+        while not self.closed.is_set():
+            written = buffer.written
+            if written > self.offset:
+                start = max(self.offset, written - buffer.size)
+                skipped = start - self.offset
+                if skipped:
+                    self.overruns += 1
+                    self.lost += skipped
+
+                pos = start % buffer.size
+                self.offset = written
+                return buffer.view[pos:pos + written - start], skipped
+
+            buffer.waiting += 1
+            try:
+                gevent.wait([buffer.changed, self.closed], count=1)
+            finally:
+                buffer.waiting -= 1
 
-    def push(self, data):
-        del self.data[0:len(data)]
-        self.data += data
+    def __iter__(self):
+        while True:
+            item = self.read()
+            if item is None:
+                return
 
-    def read(self):
-        return self.data
+            yield item
 
 
 class VirtualMachine(object):
@@ -179,7 +243,7 @@ class VirtualMachine(object):
         self.bhyve_process = None
         self.scrollback = BinaryRingBuffer(SCROLLBACK_SIZE)
         self.console_fd = None
-        self.console_queues = []
+        self.console_readers = []
         self.console_thread = None
         self.tap_interfaces = {}
         self.vnc_socket = None
@@ -482,8 +546,7 @@ class VirtualMachine(object):
 
         # Clear console
         gevent.kill(self.console_thread)
-        for i in self.console_queues:
-            i.put(b'\033[2J')
+        self.scrollback.push(b'\033[2J')
 
     def set_state(self, state):
         self.state = state
@@ -613,19 +676,15 @@ class VirtualMachine(object):
                 continue
 
             self.scrollback.push(ch)
-            try:
-                for i in self.console_queues:
-                    i.put(ch, block=False)
-            except:
-                pass
 
     def console_register(self):
-        queue = gevent.queue.Queue(4096)
-        self.console_queues.append(queue)
-        return queue
+        reader = self.scrollback.subscribe()
+        self.console_readers.append(reader)
+        return reader
 
-    def console_unregister(self, queue):
-        self.console_queues.remove(queue)
+    def console_unregister(self, reader):
+        reader.close()
+        self.console_readers.remove(reader)
 
     def console_write(self, data):
         try:
@@ -658,6 +717,7 @@ class DockerHost(object):
         self.mapped_ports = {}
         self.active_consoles = {}
         self.ready = Event()
+        self.synced = Event()
         self.logger = logging.getLogger(self.__class__.__name__)
         gevent.spawn(self.wait_ready)
 
@@ -677,6 +737,7 @@ class DockerHost(object):
         self.connection = connection
         self.logger.info('Docker instance at {0} ({1}) is ready'.format(self.vm.name, ip))
         self.listener = gevent.spawn(self.listen)
+        self.synced.wait()
 
         # Initialize the bridge network
         default_if = self.context.client.call_sync('network.interface.query', [('id', '=', self.context.default_if)], {'single': True})
@@ -730,16 +791,32 @@ class DockerHost(object):
         })
 
     def init_autostart(self):
-        for container in self.connection.containers(all=True):
-            details = self.connection.inspect_container(container['Id'])
-            if 'org.freenas.autostart' in details['Config']['Labels']:
+        for container in self.context.docker_cache.query_containers([('host', '=', self.vm.id)]):
+            if container['autostart']:
                 try:
-                    self.connection.start(container=container['Id'])
+                    self.connection.start(container=container['id'])
                 except BaseException as err:
                     self.logger.warning(
-                        'Failed to start {0} container automatically: {1}'.format(q.get(container, 'Names.0'), err)
+                        'Failed to start {0} container automatically: {1}'.format(q.get(container, 'names.0'), err)
                     )
 
+    def emit_changes(self, changes):
+        for type in ('container', 'image'):
+            for operation, ids in changes.get(type + 's', {}).items():
+                if ids:
+                    self.context.client.emit_event('containerd.docker.{0}.changed'.format(type), {
+                        'operation': operation,
+                        'ids': ids
+                    })
+
+    def unmap_ports(self, id):
+        p = pf.PF()
+        self.logger.debug('Container {0} has been stopped - cleaning port redirections'.format(id))
+        for i in self.mapped_ports.pop(id, []):
+            rule = first_or_default(lambda r: r.proxy_ports[0] == i, p.get_rules('rdr'))
+            if rule:
+                p.delete_rule('rdr', rule.index)
+
     def listen(self):
         self.logger.debug('Listening for docker events on {0}'.format(self.vm.name))
         actions = {
@@ -751,18 +828,31 @@ class DockerHost(object):
 
         while True:
             try:
-                for ev in self.connection.events(decode=True):
+                events = self.connection.events(decode=True)
+
+                # Subscribed first, so nothing gets lost between the sync and the event stream
+                changes = self.context.docker_cache.sync_host(self.vm.id, self.connection)
+                if self.synced.is_set():
+                    self.emit_changes(changes)
+
+                self.synced.set()
+
+                for ev in events:
                     self.logger.debug('Received docker event: {0}'.format(ev))
                     if ev['Type'] == 'container':
+                        details = self.context.docker_cache.update_container(self.vm.id, self.connection, ev['id'])
                         self.context.client.emit_event('containerd.docker.container.changed', {
-                            'operation': actions.get(ev['Action'], 'update'),
+                            'operation': actions.get(ev['Action'], 'update') if details else 'delete',
                             'ids': [ev['id']]
                         })
-                        details = self.connection.inspect_container(ev['id'])
 
+                        if not details:
+                            self.unmap_ports(ev['id'])
+                            continue
+
+                        name = details['Name'][1:]
                         if ev['Action'] == 'die':
                             state = details['State']
-                            name = details['Name'][1:]
                             if not state.get('Running') and state.get('ExitCode'):
                                 self.context.client.call_sync('alert.emit', {
                                     'class': 'DockerContainerDied',
@@ -790,13 +880,7 @@ class DockerHost(object):
                         p = pf.PF()
 
                         if ev['Action'] in ('destroy', 'die'):
-                            self.logger.debug(
-                                'Container {0} has been stopped - cleaning port redirections'.format(name)
-                            )
-                            for i in self.mapped_ports.get(ev['id'], {}):
-                                rule = first_or_default(lambda r: r.proxy_ports[0] == i, p.get_rules('rdr'))
-                                if rule:
-                                    p.delete_rule('rdr', rule.index)
+                            self.unmap_ports(ev['id'])
 
                         elif ev['Action'] == 'start':
                             if 'org.freenas.expose-ports-at-host' not in details['Config']['Labels']:
@@ -842,35 +926,14 @@ class DockerHost(object):
                             self.mapped_ports[ev['id']] = mapped_ports
 
                     if ev['Type'] == 'image':
-                        image = first_or_default(
-                            lambda i: ev['id'] in i['RepoTags'],
-                            self.connection.images(),
-                            default=ev
-                        )
-                        id = image.get('id') or image.get('Id')
-
-                        def transform_action(action):
-                            operation = actions.get(action, 'update')
-                            if operation in ('create', 'delete'):
-                                ref_cnt = self.context.client(
-                                    'containerd.docker.query_images',
-                                    [('id', '=', id)],
-                                    {'select': 'hosts', 'count': True}
-                                )
-
-                                if (ref_cnt and operation == 'delete') or (ref_cnt > 1 and operation == 'create'):
-                                    return 'update'
-
-                            return operation
-
-                        self.context.client.emit_event('containerd.docker.image.changed', {
-                            'operation': transform_action(ev['Action']),
-                            'ids': [id]
+                        # Image events refer to names or ids, relisting the host's images is simpler
+                        self.emit_changes({
+                            'images': self.context.docker_cache.sync_images(self.vm.id, self.connection)
                         })
 
                 self.logger.warning('Disconnected from Docker API endpoint on {0}'.format(self.vm.name))
 
-            except BaseException as err:
+            except Exception as err:
                 self.logger.info('Docker connection closed: {0}, retrying in 1 second'.format(str(err)))
                 time.sleep(1)
 
@@ -881,6 +944,10 @@ class DockerHost(object):
         return self.active_consoles[id]
 
     def shutdown(self):
+        if self.listener:
+            self.listener.kill()
+
+        self.emit_changes(self.context.docker_cache.remove_host(self.vm.id))
         p = pf.PF()
         for container_ports in self.mapped_ports.values():
             for i in container_ports:
@@ -907,7 +974,7 @@ class ContainerConsole(object):
         self.stdout = None
         self.stderr = None
         self.scrollback = None
-        self.console_queues = []
+        self.console_readers = []
         self.scrollback_t = None
         self.active = False
         self.lock = RLock()
@@ -953,20 +1020,21 @@ class ContainerConsole(object):
 
     def console_register(self):
         with self.lock:
-            queue = gevent.queue.Queue(4096)
-            self.console_queues.append(queue)
             if not self.active:
                 self.start_console()
 
-            self.logger.debug('Registered a new console queue')
-            return queue
+            reader = self.scrollback.subscribe()
+            self.console_readers.append(reader)
+            self.logger.debug('Registered a new console reader')
+            return reader
 
-    def console_unregister(self, queue):
+    def console_unregister(self, reader):
         with self.lock:
-            self.console_queues.remove(queue)
+            reader.close()
+            self.console_readers.remove(reader)
 
-            self.logger.debug('Stopped a console queue')
-            if not len(self.console_queues):
+            self.logger.debug('Stopped a console reader')
+            if not len(self.console_readers):
                 self.logger.debug('Last console queue stopped. Detaching console')
                 self.stop_console()
 
@@ -978,11 +1046,6 @@ class ContainerConsole(object):
 
         def write(data):
             self.scrollback.push(data)
-            try:
-                for i in self.console_queues:
-                    i.put(data, block=False)
-            except:
-                pass
 
         while True:
             try:
@@ -1125,6 +1188,10 @@ class ManagementService(RpcService):
     def get_mgmt_allocations(self):
         return [i.__getstate__() for i in self.context.mgmt.allocations.values()]
 
+    @private
+    def get_proxy_stats(self):
+        return self.context.proxy_server.get_stats()
+
     @private
     def call_vmtools(self, id, fn, *args):
         vm = self.context.vms.get(id)
@@ -1188,69 +1255,14 @@ class DockerService(RpcService):
 
     @generator
     def query_containers(self, filter=None, params=None):
-        result = []
-
-        def normalize_names(names):
-            for i in names:
-                if i[0] == '/':
-                    yield i[1:]
-                else:
-                    yield i
-
-        for host in self.context.iterate_docker_hosts():
-            for container in host.connection.containers(all=True):
-                try:
-                    details = host.connection.inspect_container(container['Id'])
-                except NotFound:
-                    continue
-
-                external = q.get(details, 'NetworkSettings.Networks.external')
-                result.append({
-                    'id': container['Id'],
-                    'image': container['Image'],
-                    'names': list(normalize_names(container['Names'])),
-                    'command': container['Command'] if isinstance(container['Command'], list) else [container['Command']],
-                    'status': container['Status'],
-                    'running': details['State'].get('Running', False),
-                    'host': host.vm.id,
-                    'ports': list(get_docker_ports(details)),
-                    'volumes': list(get_docker_volumes(details)),
-                    'interactive': get_interactive(details),
-                    'labels': details['Config']['Labels'],
-                    'expose_ports': 'org.freenas.expose-ports-at-host' in details['Config']['Labels'],
-                    'autostart': 'org.freenas.autostart' in details['Config']['Labels'],
-                    'environment': details['Config']['Env'],
-                    'hostname': details['Config']['Hostname'],
-                    'exec_ids': details['ExecIDs'] or [],
-                    'bridge': {
-                        'enabled': external is not None,
-                        'address': external['IPAddress'] if external else None
-                    }
-                })
-
-        return q.query(result, *(filter or []), stream=True, **(params or {}))
+        # Wait for all hosts to finish their initial sync
+        list(self.context.iterate_docker_hosts())
+        return self.context.docker_cache.query_containers(filter, params)
 
     @generator
     def query_images(self, filter=None, params=None):
-        result = []
-        for host in self.context.iterate_docker_hosts():
-            for image in host.connection.images():
-                old_img = first_or_default(lambda o: o['id'] == image['Id'], result)
-
-                if old_img:
-                    old_img['hosts'].append(host.vm.id)
-
-                else:
-                    result.append({
-                        'id': image['Id'],
-                        'names': image['RepoTags'],
-                        'size': image['VirtualSize'],
-                        'labels': image['Labels'],
-                        'hosts': [host.vm.id],
-                        'created_at': datetime.utcfromtimestamp(int(image['Created']))
-                    })
-
-        return q.query(result, *(filter or []), stream=True, **(params or {}))
+        list(self.context.iterate_docker_hosts())
+        return self.context.docker_cache.query_images(filter, params)
 
     @generator
     def pull(self, name, host):
@@ -1423,7 +1435,7 @@ class ConsoleConnection(WebSocketApplication, EventEmitter):
         self.context = context
         self.logger = logging.getLogger('ConsoleConnection')
         self.authenticated = False
-        self.console_queue = None
+        self.console_reader = None
         self.console_provider = None
         self.rd = None
         self.wr = None
@@ -1433,12 +1445,14 @@ class ConsoleConnection(WebSocketApplication, EventEmitter):
         self.logger.info('Opening console to %s...', self.console_provider.name)
 
         def read_worker():
-            for data in self.console_queue:
-                if data is None:
-                    return
+            for data, skipped in self.console_reader:
+                data = data.tobytes().replace(b'\n\n', b'\r\n')
+                if skipped:
+                    self.logger.debug('Console reader fell behind, {0} bytes skipped'.format(skipped))
+                    data = '\r\n[{0} bytes of console output skipped]\r\n'.format(skipped).encode('ascii') + data
 
                 try:
-                    self.ws.send(data.replace(b'\n\n', b'\r\n'))
+                    self.ws.send(data)
                 except WebSocketError as err:
                     self.logger.info('WebSocket connection terminated: {0}'.format(str(err)))
                     return
@@ -1459,11 +1473,8 @@ class ConsoleConnection(WebSocketApplication, EventEmitter):
 
     def on_close(self, *args, **kwargs):
         self.inq.put(StopIteration)
-        if self.console_queue:
-            self.console_queue.put(StopIteration)
-
-        if self.console_provider:
-            self.console_provider.console_unregister(self.console_queue)
+        if self.console_provider and self.console_reader:
+            self.console_provider.console_unregister(self.console_reader)
 
     def on_message(self, message, *args, **kwargs):
         if message is None:
@@ -1502,9 +1513,9 @@ class ConsoleConnection(WebSocketApplication, EventEmitter):
                         return
                     self.console_provider = self.context.vms[cid.id]
 
-            self.console_queue = self.console_provider.console_register()
+            # Reader starts with the scrollback, followed by new output
+            self.console_reader = self.console_provider.console_register()
             self.ws.send(json.dumps({'status': 'ok'}))
-            self.ws.send(self.console_provider.scrollback.read())
 
             gevent.spawn(self.worker)
             return
@@ -1580,6 +1591,7 @@ class Main(object):
         self.vm_started = Event()
         self.vms = {}
         self.docker_hosts = {}
+        self.docker_cache = DockerCache()
         self.tokens = {}
         self.logger = logging.getLogger('containerd')
         self.bridge_interface = None
@@ -1744,6 +1756,12 @@ class Main(object):
                 return i.vm()
 
     def docker_host_by_container_id(self, id):
+        host = self.docker_hosts.get(self.docker_cache.host_by_container(id))
+        if host:
+            host.ready.wait()
+            return host
+
+        # Not known yet, eg. created a moment ago - ask the hosts
         for host in self.docker_hosts.values():
             try:
                 if host.connection.containers(all=True, quiet=True, filters={'id': id}):
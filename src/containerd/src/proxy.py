@@ -25,72 +25,217 @@
 #
 #####################################################################
 
+import os
+import time
+import errno
 import gevent
+import gevent.socket
 import socket
 import logging
 from gevent.lock import RLock
 
 
-BUFSIZE = 4096
+BUFSIZE = 64 * 1024
+MAX_BUFSIZE = 1024 * 1024
+LISTEN_BACKLOG = 128
+IDLE_CHECK_INTERVAL = 5
+SPLICE_SUPPORTED = hasattr(os, 'splice')
 
 
-class ReverseProxyServer(object):
-    def __init__(self):
-        self.logger = logging.getLogger(self.__class__.__name__)
-        self.proxies = {}
-        self.rlock = RLock()
+class ProxyConnection(object):
+    def __init__(self, cfd, sfd, addr):
+        self.cfd = cfd
+        self.sfd = sfd
+        self.addr = addr
+        self.last_active = time.monotonic()
+
+    def shutdown(self):
+        # Wakes up both forwarding greenlets. Sockets are closed only once
+        # they are done, so a file descriptor never gets reused under them
+        for fd in (self.cfd, self.sfd):
+            try:
+                fd.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close(self):
+        self.shutdown()
+        self.cfd.close()
+        self.sfd.close()
+
 
-    def unix_to_tcp_proxy(self, listen, target):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind(('', listen))
-        s.listen(1)
+class Proxy(object):
+    """
+    Forwards connections accepted on a TCP port to a UNIX socket. Data is
+    moved with splice(2) through a pipe where available, otherwise through
+    a buffer which grows while reads keep filling it. If timeout is set,
+    connections idle for longer than timeout seconds are closed.
+    """
+    def __init__(self, listen, target, timeout=None, bufsize=BUFSIZE, max_bufsize=MAX_BUFSIZE, splice=SPLICE_SUPPORTED):
+        self.listen = listen
+        self.target = target
+        self.timeout = timeout
+        self.bufsize = bufsize
+        self.max_bufsize = max_bufsize
+        self.splice = splice and SPLICE_SUPPORTED
+        self.connections = set()
+        self.sock = None
+        self.stats = {
+            'connections': 0,
+            'errors': 0,
+            'bytes_in': 0,
+            'bytes_out': 0
+        }
+        self.logger = logging.getLogger('Proxy:{0}'.format(listen))
 
-        def reader(cfd, sfd):
-            buffer = bytearray(BUFSIZE)
+    def get_stats(self):
+        return dict(self.stats, active=len(self.connections), target=self.target)
+
+    def bind(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('', self.listen))
+        self.sock.listen(LISTEN_BACKLOG)
+
+    def serve(self):
+        if not self.sock:
+            self.bind()
+
+        watchdog = gevent.spawn(self.watchdog) if self.timeout else None
+        try:
             while True:
-                try:
-                    n = sfd.recv_into(buffer)
-                    if n == 0:
-                        break
+                cfd, addr = self.sock.accept()
+                gevent.spawn(self.handle, cfd, addr)
+        finally:
+            if watchdog:
+                watchdog.kill()
+
+            self.sock.close()
+            for conn in list(self.connections):
+                conn.shutdown()
+
+    def handle(self, cfd, addr):
+        self.logger.debug('New client {0} on {1}'.format(addr, self.listen))
+        sfd = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, 0)
+        try:
+            sfd.connect(self.target)
+        except OSError as err:
+            self.logger.warning('Cannot connect to {0}: {1}'.format(self.target, str(err)))
+            self.stats['errors'] += 1
+            sfd.close()
+            cfd.close()
+            return
+
+        cfd.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = ProxyConnection(cfd, sfd, addr)
+        self.connections.add(conn)
+        self.stats['connections'] += 1
+        forward = self.forward_splice if self.splice else self.forward
 
-                    cfd.sendall(buffer[:n])
-                except OSError:
+        try:
+            gevent.joinall([
+                gevent.spawn(forward, conn, cfd, sfd, 'bytes_in'),
+                gevent.spawn(forward, conn, sfd, cfd, 'bytes_out')
+            ])
+        finally:
+            self.connections.discard(conn)
+            conn.close()
+
+    def done(self, dst):
+        # Propagate EOF to the other side, the opposite direction may still be active
+        try:
+            dst.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    def forward(self, conn, src, dst, counter):
+        bufsize = self.bufsize
+        buffer = memoryview(bytearray(bufsize))
+        try:
+            while True:
+                n = src.recv_into(buffer)
+                if n == 0:
                     break
 
-        def writer(cfd, sfd):
-            buffer = bytearray(BUFSIZE)
+                dst.sendall(buffer[:n])
+                conn.last_active = time.monotonic()
+                self.stats[counter] += n
+
+                # Bulk transfer, use a bigger buffer
+                if n == bufsize and bufsize < self.max_bufsize:
+                    bufsize = min(bufsize * 2, self.max_bufsize)
+                    buffer = memoryview(bytearray(bufsize))
+        except OSError as err:
+            if err.errno not in (errno.ECONNRESET, errno.EPIPE, errno.EBADF, errno.ENOTCONN):
+                self.logger.debug('Forwarding for {0} failed: {1}'.format(conn.addr, str(err)))
+                self.stats['errors'] += 1
+        finally:
+            self.done(dst)
+
+    def forward_splice(self, conn, src, dst, counter):
+        # Data goes socket -> pipe -> socket without entering userspace
+        flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        rd, wr = os.pipe()
+        try:
             while True:
                 try:
-                    n = cfd.recv_into(buffer)
-                    if n == 0:
-                        break
+                    n = os.splice(src.fileno(), wr, self.max_bufsize, flags=flags)
+                except BlockingIOError:
+                    gevent.socket.wait_read(src.fileno())
+                    continue
 
-                    sfd.sendall(buffer[:n])
-                except OSError:
+                if n == 0:
                     break
 
+                pending = n
+                while pending:
+                    try:
+                        pending -= os.splice(rd, dst.fileno(), pending, flags=flags)
+                    except BlockingIOError:
+                        gevent.socket.wait_write(dst.fileno())
+
+                conn.last_active = time.monotonic()
+                self.stats[counter] += n
+        except OSError as err:
+            if err.errno not in (errno.ECONNRESET, errno.EPIPE, errno.EBADF, errno.ENOTCONN):
+                self.logger.debug('Forwarding for {0} failed: {1}'.format(conn.addr, str(err)))
+                self.stats['errors'] += 1
+        finally:
+            os.close(rd)
+            os.close(wr)
+            self.done(dst)
+
+    def watchdog(self):
         while True:
-            cfd, addr = s.accept()
-            self.logger.debug('New client {0} on {1}'.format(addr, listen))
+            gevent.sleep(min(IDLE_CHECK_INTERVAL, self.timeout))
+            now = time.monotonic()
+            for conn in list(self.connections):
+                if now - conn.last_active > self.timeout:
+                    self.logger.debug('Closing idle connection from {0}'.format(conn.addr))
+                    conn.shutdown()
 
-            sfd = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, 0)
-            sfd.connect(target)
-            gevent.spawn(reader, cfd, sfd)
-            gevent.spawn(writer, cfd, sfd)
 
-    def add_proxy(self, listen, target, timeout=300):
+class ReverseProxyServer(object):
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.proxies = {}
+        self.rlock = RLock()
+
+    def add_proxy(self, listen, target, timeout=None):
         with self.rlock:
             self.logger.debug('Adding proxy from {0} to 0.0.0.0:{1}'.format(target, listen))
-            worker = gevent.spawn(self.unix_to_tcp_proxy, listen, target)
-            self.proxies[listen] = worker
+            proxy = Proxy(listen, target, timeout)
+            self.proxies[listen] = (proxy, gevent.spawn(proxy.serve))
 
     def remove_proxy(self, listen):
         with self.rlock:
-            self.logger.debug('Adding proxy to 0.0.0.0:{0}'.format(listen))
-            worker = self.proxies.get(listen)
-            if not worker:
+            self.logger.debug('Removing proxy from 0.0.0.0:{0}'.format(listen))
+            proxy = self.proxies.pop(listen, None)
+            if not proxy:
                 return
 
-            gevent.kill(worker)
-            del self.proxies[listen]
+            gevent.kill(proxy[1])
+
+    def get_stats(self):
+        with self.rlock:
+            return {listen: proxy.get_stats() for listen, (proxy, worker) in self.proxies.items()}
@@ -0,0 +1,166 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+
+"""
+Minimal Docker Remote API server for tests. Serves container listing and
+inspection and image listing from in-memory state, which tests modify
+between calls to simulate containers being created, started or removed.
+"""
+
+import re
+import json
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+
+API_VERSION = '1.24'
+
+
+class FakeDockerState(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.containers = {}
+        self.images = {}
+        self.requests = []
+
+    def add_container(self, id, name, image='busybox:latest', running=True, labels=None, ports=None):
+        with self.lock:
+            self.containers[id] = {
+                'Id': id,
+                'Names': ['/' + name],
+                'Image': image,
+                'Command': 'sh',
+                'Status': 'Up 1 minute' if running else 'Exited (0) 1 minute ago',
+            }, {
+                'Id': id,
+                'Name': '/' + name,
+                'State': {'Running': running, 'ExitCode': 0},
+                'Config': {
+                    'Labels': labels or {},
+                    'Env': [],
+                    'Hostname': id[:12],
+                    'Tty': False,
+                    'OpenStdin': False
+                },
+                'HostConfig': {
+                    'PortBindings': {
+                        '{0}/tcp'.format(c): [{'HostPort': str(h)}] for c, h in (ports or {}).items()
+                    }
+                },
+                'Mounts': [],
+                'ExecIDs': None,
+                'NetworkSettings': {'Networks': {}}
+            }
+
+    def remove_container(self, id):
+        with self.lock:
+            self.containers.pop(id, None)
+
+    def add_image(self, id, tags, size=1024):
+        with self.lock:
+            self.images[id] = {
+                'Id': id,
+                'RepoTags': tags,
+                'VirtualSize': size,
+                'Labels': {},
+                'Created': 1476748800
+            }
+
+    def remove_image(self, id):
+        with self.lock:
+            self.images.pop(id, None)
+
+
+class FakeDockerHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, code, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        state = self.server.state
+        url = urlparse(self.path)
+        path = re.sub(r'^/v[0-9.]+', '', url.path)
+        args = parse_qs(url.query)
+
+        with state.lock:
+            state.requests.append(path)
+            if path == '/version':
+                self.reply(200, {'ApiVersion': API_VERSION, 'Version': '1.12.3'})
+                return
+
+            if path == '/containers/json':
+                filters = json.loads(args.get('filters', ['{}'])[0])
+                ids = filters.get('id')
+                self.reply(200, [
+                    c for id, (c, _) in state.containers.items()
+                    if not ids or id in (ids if isinstance(ids, list) else [ids])
+                ])
+                return
+
+            m = re.match(r'^/containers/([^/]+)/json$', path)
+            if m:
+                container = state.containers.get(m.group(1))
+                if container:
+                    self.reply(200, container[1])
+                else:
+                    self.reply(404, {'message': 'No such container: {0}'.format(m.group(1))})
+                return
+
+            if path == '/images/json':
+                self.reply(200, list(state.images.values()))
+                return
+
+        self.reply(404, {'message': 'page not found'})
+
+
+class FakeDockerServer(object):
+    def __init__(self):
+        self.state = FakeDockerState()
+        self.server = HTTPServer(('127.0.0.1', 0), FakeDockerHandler)
+        self.server.state = self.state
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
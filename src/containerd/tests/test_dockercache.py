@@ -0,0 +1,149 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+
+import os
+import sys
+import unittest
+import docker
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from dockercache import DockerCache  # noqa
+from fake_docker import FakeDockerServer, API_VERSION  # noqa
+
+
+WEB = 'a' * 64
+DB = 'b' * 64
+WORKER = 'c' * 64
+BUSYBOX = 'sha256:' + '1' * 64
+POSTGRES = 'sha256:' + '2' * 64
+
+
+class DockerCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.servers = {}
+        self.cache = DockerCache()
+
+    def tearDown(self):
+        for server, _ in self.servers.values():
+            server.stop()
+
+    def add_host(self, host_id):
+        server = FakeDockerServer()
+        server.start()
+        self.servers[host_id] = server, docker.Client(base_url=server.url, version=API_VERSION)
+        return server.state
+
+    def sync(self, host_id):
+        return self.cache.sync_host(host_id, self.servers[host_id][1])
+
+    def ids(self, *filter):
+        return sorted(i['id'] for i in self.cache.query_containers(list(filter)))
+
+    def test_sync_host(self):
+        state = self.add_host('vm0')
+        state.add_container(WEB, 'web', labels={'org.freenas.autostart': 'true'}, ports={80: 8080})
+        state.add_container(DB, 'db', image='postgres:9.6', running=False)
+        state.add_image(BUSYBOX, ['busybox:latest'])
+
+        changes = self.sync('vm0')
+        self.assertEqual(sorted(changes['containers']['create']), [WEB, DB])
+        self.assertEqual(changes['images']['create'], [BUSYBOX])
+
+        web, = self.cache.query_containers([('id', '=', WEB)])
+        self.assertEqual(web['names'], ['web'])
+        self.assertEqual(web['host'], 'vm0')
+        self.assertTrue(web['running'])
+        self.assertTrue(web['autostart'])
+        self.assertEqual(web['ports'], [{'protocol': 'TCP', 'container_port': 80, 'host_port': 8080}])
+
+        self.assertEqual(self.ids(('host', '=', 'vm0')), [WEB, DB])
+        self.assertEqual(self.ids(('names', 'contains', 'db')), [DB])
+        self.assertEqual(self.ids(('or', [('names', 'contains', 'db'), ('id', '=', WEB)])), [WEB, DB])
+        self.assertEqual(self.ids(('host', '=', 'vm0'), ('running', '=', False)), [DB])
+        self.assertEqual(self.cache.host_by_container(DB), 'vm0')
+
+    def test_resync(self):
+        state = self.add_host('vm0')
+        state.add_container(WEB, 'web')
+        state.add_container(DB, 'db')
+        self.sync('vm0')
+
+        # Changes made while the event stream was disconnected
+        state.remove_container(DB)
+        state.add_container(WORKER, 'worker')
+        changes = self.sync('vm0')['containers']
+
+        self.assertEqual(changes['create'], [WORKER])
+        self.assertEqual(changes['update'], [WEB])
+        self.assertEqual(changes['delete'], [DB])
+        self.assertEqual(self.ids(), [WEB, WORKER])
+
+    def test_update_container(self):
+        state = self.add_host('vm0')
+        state.add_container(WEB, 'web', running=False)
+        self.sync('vm0')
+        requests = len(state.requests)
+
+        # A start event refreshes only the container in question
+        state.add_container(WEB, 'web', running=True)
+        details = self.cache.update_container('vm0', self.servers['vm0'][1], WEB)
+        self.assertTrue(details['State']['Running'])
+        self.assertTrue(self.cache.query_containers([('id', '=', WEB)], {'single': True})['running'])
+        self.assertEqual(len(state.requests) - requests, 2)
+
+        # A destroy event drops it
+        state.remove_container(WEB)
+        self.assertIsNone(self.cache.update_container('vm0', self.servers['vm0'][1], WEB))
+        self.assertEqual(self.ids(), [])
+        self.assertIsNone(self.cache.host_by_container(WEB))
+
+    def test_images_across_hosts(self):
+        first = self.add_host('vm0')
+        second = self.add_host('vm1')
+        for state in (first, second):
+            state.add_image(BUSYBOX, ['busybox:latest'])
+
+        second.add_image(POSTGRES, ['postgres:9.6'])
+        self.sync('vm0')
+        self.sync('vm1')
+        self.assertEqual(self.cache.image_hosts(BUSYBOX), ['vm0', 'vm1'])
+        self.assertEqual(self.cache.image_hosts(POSTGRES), ['vm1'])
+
+        # Image removed from one host only is updated, not deleted
+        first.remove_image(BUSYBOX)
+        changes = self.cache.sync_images('vm0', self.servers['vm0'][1])
+        self.assertEqual(changes, {'create': [], 'update': [BUSYBOX], 'delete': []})
+        self.assertEqual(self.cache.image_hosts(BUSYBOX), ['vm1'])
+
+        changes = self.cache.remove_host('vm1')
+        self.assertEqual(sorted(changes['images']['delete']), [BUSYBOX, POSTGRES])
+        self.assertEqual(list(self.cache.query_images()), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -26,6 +26,9 @@
 #####################################################################
 
 import re
+import copy
+import time
+import threading
 from datastore import DatastoreException
 
 
@@ -90,8 +93,9 @@ class ConfigNode(object):
 
 
 class ConfigStore(object):
-    def __init__(self, datastore):
+    def __init__(self, datastore, notifier=None):
         self.__datastore = datastore
+        self.notifier = notifier
         if not self.__datastore.collection_exists('config'):
             raise DatastoreException("'config' collection doesn't exist")
 
@@ -108,6 +112,11 @@ class ConfigStore(object):
 
     def set(self, key, value):
         self.__datastore.upsert('config', key, value, config=True)
+        if self.notifier:
+            self.notifier([key])
+
+    def invalidate(self, keys=None):
+        pass
 
     def list_children(self, key=None):
         if key is None:
@@ -126,3 +135,79 @@ class ConfigStore(object):
             result[key][value] = item['value']
 
         return result
+
+
+class CachedConfigStore(ConfigStore):
+    """
+    ConfigStore serving reads from an in-memory copy of the config tree.
+
+    Writes through the same instance update the copy directly. Changes made by
+    other processes are picked up by calling invalidate(), normally wired to a
+    change notification, or after optional ttl seconds as a last resort.
+    """
+    def __init__(self, datastore, notifier=None, ttl=None):
+        super(CachedConfigStore, self).__init__(datastore, notifier)
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        self.cache = None
+        self.loaded_at = None
+
+    def __load(self):
+        with self.lock:
+            expired = self.ttl is not None and (self.loaded_at is None or time.time() - self.loaded_at > self.ttl)
+            if self.cache is None or expired:
+                items = super(CachedConfigStore, self).list_children()
+                self.cache = {i['id']: i['value'] for i in items}
+                self.loaded_at = time.time()
+
+            return self.cache
+
+    def invalidate(self, keys=None):
+        with self.lock:
+            if keys is None or self.cache is None:
+                self.cache = None
+                return
+
+            for key in keys:
+                ret = super(CachedConfigStore, self).get(key, self)
+                if ret is self:
+                    self.cache.pop(key, None)
+                else:
+                    self.cache[key] = ret
+
+    def exists(self, key):
+        return key in self.__load()
+
+    def get(self, key, default=None):
+        cache = self.__load()
+        if key not in cache:
+            return default
+
+        return copy.deepcopy(cache[key])
+
+    def set(self, key, value):
+        super(CachedConfigStore, self).set(key, value)
+        with self.lock:
+            if self.cache is not None:
+                self.cache[key] = copy.deepcopy(value)
+
+    def list_children(self, key=None):
+        cache = self.__load()
+        pattern = re.compile('^' + key + '\\..*') if key is not None else None
+        return [
+            {'id': k, 'value': copy.deepcopy(v)}
+            for k, v in cache.items() if not pattern or pattern.match(k)
+        ]
+
+    def children_dict(self, root):
+        result = {}
+        pattern = re.compile('^' + re.escape(root) + '\\.[a-zA-Z0-9_]+\\.')
+        for id, value in self.__load().items():
+            if not pattern.match(id):
+                continue
+
+            matched = id[len(root) + 1:]
+            key, _, subkey = matched.partition('.')
+            result.setdefault(key, {})[subkey] = copy.deepcopy(value)
+
+        return result
@@ -40,6 +40,9 @@ from datastore import DatastoreException, DuplicateKeyException
 from freenas.utils.query import get
 
 
+COUNTERS_COLLECTION = 'pkey_counters'
+
+
 def auto_retry(fn):
     def wrapped(*args, **kwargs):
         for i in range(0, 15):
@@ -65,6 +68,8 @@ class MongodbDatastore(object):
         self.db = None
         self.log_db = None
         self.connected = False
+        self.collections = {}
+        self.seeded_counters = set()
         self.operators_table = {
             '>': '$gt',
             '<': '$lt',
@@ -140,8 +145,21 @@ class MongodbDatastore(object):
 
         return {'$and': result} if len(result) > 0 else {}
 
+    def _get_collection(self, name):
+        c = self.collections.get(name)
+        if c is None:
+            c = self.db['collections'].find_one({"_id": name})
+            if c is not None:
+                self.collections[name] = c
+
+        return c
+
+    def _invalidate_collection(self, name):
+        self.collections.pop(name, None)
+        self.seeded_counters.discard(name)
+
     def _get_db(self, collection):
-        c = self.db['collections'].find_one({"_id": collection})
+        c = self._get_collection(collection)
         if not c:
             raise DatastoreException('Collection {0} not found'.format(collection))
 
@@ -174,6 +192,7 @@ class MongodbDatastore(object):
         unique_indexes = attributes.get('unique_indexes', [])
         cap = attributes.get('cap')
 
+        self._invalidate_collection(name)
         if not self.db['collections'].find_one(name):
             self.db['collections'].insert({
                 '_id': name,
@@ -202,35 +221,36 @@ class MongodbDatastore(object):
 
     @auto_retry
     def collection_exists(self, name):
-        return self.db['collections'].find_one({"_id": name}) is not None
+        return self._get_collection(name) is not None
 
     @auto_retry
     def collection_get_attrs(self, name):
-        item = self.db['collections'].find_one({"_id": name})
-        return item['attributes']
+        item = self._get_collection(name)
+        return copy.deepcopy(item['attributes'])
 
     @auto_retry
     def collection_set_attrs(self, name):
-        item = self.db['collections'].find_one({"_id": name})
-        return item['attributes']
+        item = self._get_collection(name)
+        return copy.deepcopy(item['attributes'])
 
     @auto_retry
     def collection_get_migration_policy(self, name):
-        item = self.db['collections'].find_one({"_id": name})
+        item = self._get_collection(name)
         return item.get('migration', 'keep')
 
     @auto_retry
     def collection_get_migrations(self, name):
-        item = self.db['collections'].find_one({"_id": name})
-        return item.get('migrations', [])
+        item = self._get_collection(name)
+        return list(item.get('migrations', []))
 
     @auto_retry
     def collection_has_migration(self, name, migration_name):
-        item = self.db['collections'].find_one({"_id": name})
+        item = self._get_collection(name)
         return migration_name in item.get('migrations', [])
 
     @auto_retry
     def collection_record_migration(self, name, migration_name):
+        self._invalidate_collection(name)
         item = self.db['collections'].find_one({"_id": name})
         migs = item.setdefault('migrations', [])
         migs.append(migration_name)
@@ -242,23 +262,87 @@ class MongodbDatastore(object):
 
     @auto_retry
     def collection_delete(self, name):
+        self._invalidate_collection(name)
         if not self.db['collections'].find_one({"_id": name}):
             return
 
-        self._get_db(name).drop()
+        db = self._get_db(name)
+        db.drop()
+        db.database[COUNTERS_COLLECTION].remove({'_id': name})
         self.db['collections'].remove({'_id': name})
+        self._invalidate_collection(name)
 
     @auto_retry
     def collection_get_pkey_type(self, name):
-        item = self.db['collections'].find_one({"_id": name})
+        item = self._get_collection(name)
         return item['pkey-type']
 
     @auto_retry
     def collection_set_pkey_type(self, name, type):
+        self._invalidate_collection(name)
         item = self.db['collections'].find_one({"_id": name})
         item['pkey-type'] = type
         self.db['collections'].update({'_id': name}, item)
 
+    def _allocate_serial(self, collection, count=1):
+        # Allocates a block of serial primary keys with a single atomic
+        # counter increment. The counter is seeded from the highest existing
+        # key the first time it's used by this process.
+        db = self._get_db(collection)
+        counters = db.database[COUNTERS_COLLECTION]
+
+        if collection not in self.seeded_counters:
+            ret = db.find_one(sort=[('_id', pymongo.DESCENDING)], projection={'_id': 1})
+            if ret and isinstance(ret['_id'], int):
+                counters.update_one({'_id': collection}, {'$max': {'seq': ret['_id']}}, upsert=True)
+
+            self.seeded_counters.add(collection)
+
+        ret = counters.find_one_and_update(
+            {'_id': collection},
+            {'$inc': {'seq': count}},
+            upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+
+        last = ret['seq']
+        return list(range(last - count + 1, last + 1))
+
+    def _prepare_insert(self, collection, obj, pkey, pkey_type, timestamp, config):
+        if hasattr(obj, '__getstate__'):
+            obj = obj.__getstate__()
+        elif type(obj) is not dict or config:
+            obj = {'value': obj}
+        else:
+            obj = copy.copy(obj)
+
+        autopkey = pkey is None and 'id' not in obj
+        if 'id' in obj:
+            pkey = obj.pop('id')
+
+        if pkey_type == 'uuid' and pkey:
+            pkey = pkey.lower()
+
+        if timestamp:
+            t = datetime.utcnow()
+            obj['updated_at'] = t
+            obj['created_at'] = t
+
+        return obj, pkey, autopkey
+
+    def _prepare_update(self, obj, timestamp, config):
+        if hasattr(obj, '__getstate__'):
+            obj = obj.__getstate__()
+        elif type(obj) is not dict or config:
+            obj = {'value': obj}
+        else:
+            obj = copy.deepcopy(obj)
+
+        if timestamp:
+            obj['updated_at'] = datetime.utcnow()
+
+        return obj
+
     @auto_retry
     def collection_get_next_pkey(self, name, prefix):
         counter = 0
@@ -390,42 +474,26 @@ class MongodbDatastore(object):
 
     @auto_retry
     def insert(self, collection, obj, pkey=None, timestamp=True, config=False):
-        if hasattr(obj, '__getstate__'):
-            obj = obj.__getstate__()
-        elif type(obj) is not dict or config:
-            obj = {'value': obj}
-        else:
-            obj = copy.copy(obj)
-
         pkey_type = self.collection_get_pkey_type(collection)
-        autopkey = pkey is None and 'id' not in obj
+        obj, pkey, autopkey = self._prepare_insert(collection, obj, pkey, pkey_type, timestamp, config)
         retries = 100
 
-        if 'id' in obj:
-            pkey = obj.pop('id')
-
-        if pkey_type == 'uuid' and pkey:
-            pkey = pkey.lower()
-
         while True:
             if autopkey:
                 if pkey_type in ('serial', 'integer'):
-                    ret = self._get_db(collection).find_one(sort=[('_id', pymongo.DESCENDING)])
-                    pkey = ret['_id'] + 1 if ret else 1
+                    pkey, = self._allocate_serial(collection)
                 elif pkey_type == 'uuid':
                     pkey = str(uuid.uuid4())
 
             obj['_id'] = pkey
-            if timestamp:
-                t = datetime.utcnow()
-                obj['updated_at'] = t
-                obj['created_at'] = t
 
             try:
                 db = self._get_db(collection)
                 db.insert(obj)
             except pymongo.errors.DuplicateKeyError:
                 if autopkey and retries > 0:
+                    # Counter fell behind keys inserted explicitly, reseed it
+                    self.seeded_counters.discard(collection)
                     retries -= 1
                     continue
 
@@ -433,17 +501,43 @@ class MongodbDatastore(object):
 
             return pkey
 
+    @auto_retry
+    def insert_many(self, collection, objs, timestamp=True, config=False):
+        pkey_type = self.collection_get_pkey_type(collection)
+        docs = []
+        for obj in objs:
+            obj, pkey, autopkey = self._prepare_insert(collection, obj, None, pkey_type, timestamp, config)
+            if autopkey and pkey_type == 'uuid':
+                pkey = str(uuid.uuid4())
+
+            obj['_id'] = pkey
+            docs.append(obj)
+
+        if not docs:
+            return []
+
+        if pkey_type in ('serial', 'integer'):
+            missing = [i for i in docs if i['_id'] is None]
+            for doc, pkey in zip(missing, self._allocate_serial(collection, len(missing)) if missing else []):
+                doc['_id'] = pkey
+
+        try:
+            self._get_db(collection).insert_many(docs, ordered=False)
+        except pymongo.errors.BulkWriteError as err:
+            if any(e.get('code') == 11000 for e in err.details.get('writeErrors', [])):
+                raise DuplicateKeyException('Document with given key already exists')
+
+            raise DatastoreException(str(err))
+
+        return [i['_id'] for i in docs]
+
     @auto_retry
     def update(self, collection, pkey, obj, upsert=False, timestamp=True, config=False):
-        if hasattr(obj, '__getstate__'):
-            obj = obj.__getstate__()
-        elif type(obj) is not dict or config:
-            obj = {'value': obj}
-        else:
-            obj = copy.deepcopy(obj)
+        obj = self._prepare_update(obj, timestamp, config)
 
         if 'id' in obj and pkey != obj['id']:
             # We gonna remove the document and reinsert it to change the id...
+            obj.pop('updated_at', None)
             full_obj = self.get_by_id(collection, pkey)
             full_obj.update(obj)
             self.delete(collection, pkey)
@@ -453,15 +547,50 @@ class MongodbDatastore(object):
         if 'id' in obj:
             del obj['id']
 
+        db = self._get_db(collection)
+        ret = db.replace_one({'_id': pkey}, obj)
+        if ret.matched_count or not upsert:
+            return
+
+        # Document doesn't exist yet, insert it with created_at set
         if timestamp:
-            t = datetime.utcnow()
-            obj['updated_at'] = t
+            obj['created_at'] = obj['updated_at']
 
-            if not self.get_by_id(collection, pkey):
-                obj['created_at'] = t
+        db.replace_one({'_id': pkey}, obj, upsert=True)
+
+    @auto_retry
+    def update_many(self, collection, objs, upsert=False, timestamp=True, config=False):
+        if isinstance(objs, dict):
+            objs = objs.items()
+
+        requests = []
+        for pkey, obj in objs:
+            obj = self._prepare_update(obj, timestamp, config)
+            if 'id' in obj and pkey != obj['id']:
+                # Changing the key can't be batched
+                self.update(collection, pkey, obj, upsert=upsert, timestamp=False, config=False)
+                continue
+
+            obj.pop('id', None)
+            requests.append((pkey, obj))
+
+        if not requests:
+            return
 
         db = self._get_db(collection)
-        db.update({'_id': pkey}, obj, upsert=upsert)
+        if upsert and timestamp:
+            existing = {i['_id'] for i in db.find({'_id': {'$in': [p for p, _ in requests]}}, projection={'_id': 1})}
+            for pkey, obj in requests:
+                if pkey not in existing:
+                    obj['created_at'] = obj['updated_at']
+
+        try:
+            db.bulk_write([pymongo.ReplaceOne({'_id': p}, o, upsert=upsert) for p, o in requests], ordered=False)
+        except pymongo.errors.BulkWriteError as err:
+            raise DatastoreException(str(err))
+
+    def upsert_many(self, collection, objs, config=False):
+        return self.update_many(collection, objs, upsert=True, config=config)
 
     def upsert(self, collection, pkey, obj, config=False):
         return self.update(collection, pkey, obj, upsert=True, config=config)
@@ -471,6 +600,15 @@ class MongodbDatastore(object):
         db = self._get_db(collection)
         db.remove(pkey)
 
+    @auto_retry
+    def delete_many(self, collection, pkeys):
+        pkeys = list(pkeys)
+        if not pkeys:
+            return 0
+
+        db = self._get_db(collection)
+        return db.delete_many({'_id': {'$in': pkeys}}).deleted_count
+
     def lock(self, data=True, log=False):
         if data:
             self.conn_db.fsync(lock=True)
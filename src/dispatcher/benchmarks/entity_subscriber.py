@@ -0,0 +1,181 @@
+#+
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+
+"""
+Entity subscriber benchmark. Fires a burst of single entity "changed"
+events, like a recursive snapshot or a pool import does, at
+EntitySubscriberEventSource backed by a fake dispatcher which charges a
+fixed latency per query and a small cost per returned entity. Reports
+queries issued, events broadcast, and bytes sent to clients receiving
+full entities and to clients which enabled the entity_deltas feature.
+Compares with the former one query per event worker.
+
+Usage: python3 entity_subscriber.py [-n 5000] [-l 0.002] [--legacy]
+"""
+
+import os
+import sys
+import json
+import time
+import copy
+import argparse
+import contextlib
+import gevent
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'plugins'))
+import EntitySubscriberPlugin  # noqa
+
+
+SERVICE = 'volume.snapshot'
+
+
+def make_snapshot(i):
+    return {
+        'id': 'tank/data/{0}@auto-20161018'.format(i),
+        'name': 'auto-20161018',
+        'dataset': 'tank/data/{0}'.format(i),
+        'pool': 'tank',
+        'replicable': True,
+        'lifetime': 1209600,
+        'holds': {},
+        'metadata': {'org.freenas:replicate': 'yes', 'org.freenas:uuid': str(i) * 8},
+        'properties': {
+            name: {'source': 'NONE', 'value': str(i), 'rawvalue': str(i), 'parsed': i}
+            for name in ('used', 'referenced', 'compressratio', 'written', 'creation', 'userrefs', 'clones')
+        }
+    }
+
+
+class FakeDispatcher(object):
+    def __init__(self, entities, latency, entity_cost=0.000005):
+        self.entities = entities
+        self.latency = latency
+        self.entity_cost = entity_cost
+        self.datastore = None
+        self.handlers = {}
+        self.queries = 0
+        self.events = 0
+        self.full_bytes = 0
+        self.delta_bytes = 0
+
+    def register_event_handler(self, name, handler):
+        self.handlers.setdefault(name, []).append(handler)
+        return handler
+
+    def register_event_type(self, name, source):
+        pass
+
+    def call_sync(self, name, filter):
+        ids = filter[0][2]
+        self.queries += 1
+        gevent.sleep(self.latency + len(ids) * self.entity_cost)
+        return [copy.deepcopy(self.entities[i]) for i in ids if i in self.entities]
+
+    def dispatch_event(self, name, args):
+        # Same split as DispatcherConnection.emit_event
+        full = {k: v for k, v in args.items() if k != 'delta'}
+        self.events += 1
+        self.full_bytes += len(json.dumps(full))
+        if 'delta' in args:
+            delta = {k: v for k, v in args.items() if k not in ('entities', 'data')}
+            self.delta_bytes += len(json.dumps(delta))
+        else:
+            self.delta_bytes += len(json.dumps(full))
+
+
+class LegacyEventSource(EntitySubscriberPlugin.EntitySubscriberEventSource):
+    def worker(self, service):
+        while True:
+            operation, ids = self.queues[service].get()
+            with contextlib.suppress(BaseException):
+                self.fetch(service, operation, ids)
+
+
+def run(cls, count, latency):
+    entities = {i['id']: i for i in (make_snapshot(n) for n in range(count))}
+    dispatcher = FakeDispatcher(entities, latency)
+    source = cls(dispatcher)
+    source.register(SERVICE)
+    ids = list(entities)
+
+    def burst(operation):
+        for i in ids:
+            source.changed(SERVICE, {'operation': operation, 'ids': [i]})
+
+        while dispatcher.events < expected or not source.queues[SERVICE].empty():
+            gevent.sleep(0.01)
+
+    results = []
+    for operation in ('create', 'update'):
+        if operation == 'update':
+            # A property changes on every snapshot
+            for i in entities.values():
+                i['properties']['userrefs']['parsed'] += 1
+
+        before = (dispatcher.queries, dispatcher.events, dispatcher.full_bytes, dispatcher.delta_bytes)
+        expected = dispatcher.events + (count if cls is LegacyEventSource else 1)
+        start = time.perf_counter()
+        burst(operation)
+        gevent.sleep(EntitySubscriberPlugin.COALESCE_WINDOW * 2)
+        elapsed = time.perf_counter() - start
+        results.append((
+            operation, elapsed,
+            dispatcher.queries - before[0],
+            dispatcher.events - before[1],
+            dispatcher.full_bytes - before[2],
+            dispatcher.delta_bytes - before[3]
+        ))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', metavar='EVENTS', type=int, default=5000)
+    parser.add_argument('-l', metavar='LATENCY', type=float, default=0.002)
+    parser.add_argument('--legacy', action='store_true')
+    args = parser.parse_args()
+
+    runs = [('coalesced', EntitySubscriberPlugin.EntitySubscriberEventSource)]
+    if args.legacy:
+        runs.insert(0, ('legacy', LegacyEventSource))
+
+    print('{0:>10} {1:>8} {2:>8} {3:>8} {4:>8} {5:>10} {6:>12} {7:>12}'.format(
+        'mode', 'op', 'seconds', 'queries', 'events', 'events/s', 'full KiB', 'delta KiB'
+    ))
+
+    for name, cls in runs:
+        for operation, elapsed, queries, events, full, delta in run(cls, args.n, args.l):
+            print('{0:>10} {1:>8} {2:>8.2f} {3:>8} {4:>8} {5:>10.0f} {6:>12.0f} {7:>12.0f}'.format(
+                name, operation, elapsed, queries, events, args.n / elapsed, full / 1024, delta / 1024
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#+
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+"""
+Measures event fan-out throughput of the dispatcher against the number of
+connected clients. Compares the legacy "enqueue everywhere, fnmatch on
+delivery" approach with SubscriptionRegistry.
+
+Usage: python3 event_dispatch.py [-c 10,100,500] [-n 20000]
+"""
+
+import os
+import sys
+import time
+import random
+import fnmatch
+import argparse
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from subscription import SubscriptionRegistry  # noqa
+
+
+EVENT_NAMES = [
+    'statd.cpu.pulse', 'statd.disk.ada0.pulse', 'statd.network.em0.pulse',
+    'task.progress', 'task.created', 'task.updated',
+    'entity-subscriber.disk.changed', 'entity-subscriber.volume.changed',
+    'server.client_login', 'server.client_logout', 'alert.changed'
+]
+
+MASK_PROFILES = [
+    ['entity-subscriber.*.changed', 'task.*', 'server.*'],     # GUI
+    ['entity-subscriber.task.changed', 'task.progress'],        # CLI
+    ['statd.*.pulse'],                                          # stats widget
+    ['alert.changed', 'server.shutdown'],                       # daemon
+]
+
+
+class FakeConnection(object):
+    def __init__(self, masks):
+        self.event_masks = set(masks)
+        self.outgoing_events = deque()
+        self.delivered = 0
+
+    def emit_legacy(self, name):
+        for mask in self.event_masks:
+            if fnmatch.fnmatch(name, mask):
+                self.delivered += 1
+
+
+def make_connections(count):
+    return [FakeConnection(random.choice(MASK_PROFILES)) for _ in range(count)]
+
+
+def run_legacy(conns, events):
+    for name in events:
+        for conn in conns:
+            conn.outgoing_events.append(name)
+
+    for conn in conns:
+        while conn.outgoing_events:
+            conn.emit_legacy(conn.outgoing_events.popleft())
+
+
+def run_indexed(conns, events):
+    registry = SubscriptionRegistry()
+    for conn in conns:
+        registry.subscribe(conn, conn.event_masks)
+
+    for name in events:
+        for conn in registry.match(name):
+            conn.outgoing_events.append(name)
+
+    for conn in conns:
+        while conn.outgoing_events:
+            name = conn.outgoing_events.popleft()
+            if registry.is_subscribed(conn, name):
+                conn.delivered += 1
+
+
+def measure(fn, count, events):
+    random.seed(count)
+    conns = make_connections(count)
+    start = time.perf_counter()
+    fn(conns, events)
+    elapsed = time.perf_counter() - start
+    return sum(c.delivered for c in conns), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', metavar='COUNTS', default='10,50,100,250,500')
+    parser.add_argument('-n', metavar='EVENTS', type=int, default=20000)
+    args = parser.parse_args()
+
+    events = [random.choice(EVENT_NAMES) for _ in range(args.n)]
+    print('{0:>8} {1:>14} {2:>14} {3:>8}'.format('conns', 'legacy ev/s', 'indexed ev/s', 'speedup'))
+
+    for count in (int(i) for i in args.c.split(',')):
+        delivered_legacy, t_legacy = measure(run_legacy, count, events)
+        delivered_indexed, t_indexed = measure(run_indexed, count, events)
+        assert delivered_indexed <= delivered_legacy
+
+        print('{0:>8} {1:>14.0f} {2:>14.0f} {3:>7.1f}x'.format(
+            count,
+            delivered_legacy / t_legacy,
+            delivered_indexed / t_indexed,
+            t_legacy / t_indexed
+        ))
+
+
+if __name__ == '__main__':
+    main()
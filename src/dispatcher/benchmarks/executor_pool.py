@@ -0,0 +1,207 @@
+#+
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+
+"""
+Executor pool benchmark. Runs the Balancer against fake task executor
+processes, which check in after a fixed spawn latency and "run" a task by
+sleeping. Tasks can start nested subtasks and join them, like snapshot or
+replication tasks do, while holding their own executor.
+
+Submits a burst of top level tasks at least as large as the pool limit and
+reports the time to finish them all, or a deadlock if they don't finish
+within the timeout.
+
+Usage: python3 executor_pool.py [-m 32] [-n 64] [-d 2] [-f 2] [-t 0.05]
+"""
+
+import os
+import sys
+import time
+import signal
+import argparse
+import collections
+import gevent
+from gevent.event import Event
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import balancer  # noqa
+from resources import ResourceGraph  # noqa
+
+
+class FakeDatastore(object):
+    def __init__(self):
+        self.serial = 0
+
+    def insert(self, collection, obj):
+        self.serial += 1
+        return self.serial
+
+    def update(self, collection, id, obj):
+        pass
+
+    def query(self, collection, *filter, **params):
+        return []
+
+
+class FakeConfigStore(object):
+    def __init__(self, config):
+        self.config = config
+
+    def get(self, key):
+        return self.config.get(key)
+
+
+class FakeProcess(object):
+    def __init__(self):
+        self.pid = os.getpid()
+        self.returncode = None
+        self.exited = Event()
+        self.stdout = iter(lambda: self.exited.wait() and b'', 0)
+
+    def wait(self):
+        self.returncode = -signal.SIGTERM
+        return self.returncode
+
+    def terminate(self):
+        self.exited.set()
+
+
+class FakeConnection(object):
+    def __init__(self, executor, duration, fanout):
+        self.executor = executor
+        self.duration = duration
+        self.fanout = fanout
+
+    def call_sync(self, method, args=None):
+        if method == 'taskproxy.run':
+            gevent.spawn(self.run, args)
+
+    def run(self, args):
+        b = self.executor.balancer
+        task = self.executor.task
+        depth = task.clazz.depth
+        if depth:
+            subtasks = [b.run_subtask(task, 'nested.{0}'.format(depth - 1), []) for _ in range(self.fanout)]
+            b.join_subtasks(*subtasks)
+
+        gevent.sleep(self.duration)
+        self.executor.result.set(None)
+
+
+def make_task_class(depth):
+    class NestedTask(object):
+        def __init__(self, dispatcher, datastore):
+            pass
+
+        def verify(self, *args):
+            return []
+
+        def describe(self, *args):
+            return None
+
+    NestedTask.depth = depth
+    return NestedTask
+
+
+class FakeDispatcher(object):
+    def __init__(self, args):
+        self.datastore = FakeDatastore()
+        self.configstore = FakeConfigStore({
+            'middleware.executors_count': 0,
+            'middleware.executors_max': args.m,
+            'middleware.executors_spare': 0,
+        })
+        self.resource_graph = ResourceGraph()
+        self.tasks = {'nested.{0}'.format(d): make_task_class(d) for d in range(args.d + 1)}
+        self.task_hooks = {}
+
+    def require_collection(self, *args, **kwargs):
+        pass
+
+    def register_event_type(self, *args, **kwargs):
+        pass
+
+    def dispatch_event(self, name, args):
+        pass
+
+    def get_task_filename(self, clazz):
+        return None
+
+
+def run(args):
+    dispatcher = FakeDispatcher(args)
+    b = dispatcher.balancer = balancer.Balancer(dispatcher)
+    peak = [0]
+
+    def spawn_worker_process(key):
+        def checkin():
+            executor = first(e for e in b.executors if e.key == key)
+            executor.checkin(FakeConnection(executor, args.t, args.f))
+            peak[0] = max(peak[0], len(b.executors))
+
+        gevent.spawn_later(args.l, checkin)
+        return FakeProcess()
+
+    b.spawn_worker_process = spawn_worker_process
+    start = time.perf_counter()
+    tasks = [b.run_subtask(None, 'nested.{0}'.format(args.d), []) for _ in range(args.n)]
+    finished = gevent.spawn(b.join_subtasks, *tasks).join(timeout=args.timeout)
+    elapsed = time.perf_counter() - start
+    states = collections.Counter(t.state for t in tasks)
+    b.dispose_executors()
+    return finished is not None or all(t.ended.is_set() for t in tasks), elapsed, peak[0], states
+
+
+def first(iterable):
+    return next(iter(iterable))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', metavar='MAX', type=int, default=32, help='executors_max')
+    parser.add_argument('-n', metavar='TASKS', type=int, default=64, help='top level tasks')
+    parser.add_argument('-d', metavar='DEPTH', type=int, default=2, help='subtask nesting depth')
+    parser.add_argument('-f', metavar='FANOUT', type=int, default=2, help='subtasks per task')
+    parser.add_argument('-t', metavar='DURATION', type=float, default=0.05, help='task run time')
+    parser.add_argument('-l', metavar='LATENCY', type=float, default=0.05, help='executor spawn latency')
+    parser.add_argument('--timeout', type=float, default=30)
+    args = parser.parse_args()
+
+    total = args.n * sum(args.f ** i for i in range(args.d + 1))
+    ok, elapsed, peak, states = run(args)
+    print('{0} top level tasks, {1} in total, executors_max {2}'.format(args.n, total, args.m))
+    if ok:
+        print('finished in {0:.2f}s, {1:.0f} tasks/s, peak pool size {2}'.format(elapsed, total / elapsed, peak))
+    else:
+        print('DEADLOCK: not finished after {0:.0f}s, peak pool size {1}, states {2}'.format(
+            elapsed, peak, dict(states)
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+#+
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+"""
+File indexer benchmark. Builds a synthetic directory tree and indexes it
+with the scandir/bulk write pipeline of IndexPlugin, against a fake
+datastore which charges a fixed latency per round trip and a small cost
+per document. Also times the former os.walk + per-file stat and upsert
+loop on the same tree.
+
+Parallel scanning pays off when directory reads have to hit the disks;
+with a warm cache the walk is CPU bound. --cold drops the page cache
+before each run (Linux only, needs root).
+
+Usage: python3 file_index.py [-d 3] [-f 8] [-n 16] [-l 0.0003] [--legacy] [--cold]
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'plugins'))
+import IndexPlugin  # noqa
+
+
+class FakeDatastore(object):
+    def __init__(self, latency, doc_cost=0.000002):
+        self.latency = latency
+        self.doc_cost = doc_cost
+        self.lock = threading.Lock()
+        self.docs = {}
+        self.round_trips = 0
+
+    def roundtrip(self, docs=0):
+        self.round_trips += 1
+        time.sleep(self.latency + docs * self.doc_cost)
+
+    def upsert(self, collection, pkey, obj):
+        # replace_one, then an upserting replace_one for new documents
+        self.roundtrip(1)
+        if pkey not in self.docs:
+            self.roundtrip(1)
+
+        self.docs[pkey] = obj
+
+    def upsert_many(self, collection, objs):
+        # Existing keys lookup, then an unordered bulk_write
+        self.roundtrip(len(objs))
+        self.roundtrip(len(objs))
+        with self.lock:
+            self.docs.update(objs)
+
+    def delete(self, collection, pkey):
+        self.roundtrip(1)
+        self.docs.pop(pkey, None)
+
+    def delete_many(self, collection, pkeys):
+        self.roundtrip(len(pkeys))
+        for i in pkeys:
+            self.docs.pop(i, None)
+
+
+def generate(root, depth, fanout, files):
+    count = 0
+    for i in range(files):
+        with open(os.path.join(root, 'file{0}'.format(i)), 'w'):
+            count += 1
+
+    if depth > 0:
+        for i in range(fanout):
+            path = os.path.join(root, 'dir{0}'.format(i))
+            os.mkdir(path)
+            count += 1 + generate(path, depth - 1, fanout, files)
+
+    return count
+
+
+def legacy_index(datastore, mountpoint):
+    # Former IndexDatasetFullTask loop
+    def collect(path):
+        try:
+            st = os.stat(path, follow_symlinks=False)
+        except OSError:
+            datastore.delete('fileindex', path)
+            return
+
+        datastore.upsert('fileindex', path, IndexPlugin.file_record(path, st))
+
+    for root, dirs, files in os.walk(mountpoint, topdown=True):
+        dirs[:] = [dir for dir in dirs if not os.path.ismount(os.path.join(root, dir))]
+        for d in dirs:
+            collect(os.path.join(root, d))
+
+        for f in files:
+            collect(os.path.join(root, f))
+
+
+def index(datastore, mountpoint, workers):
+    writer = IndexPlugin.IndexWriter(datastore)
+    try:
+        for path, entries, errors in IndexPlugin.walk_tree(mountpoint, workers):
+            for p, st in entries:
+                writer.add(p, st)
+
+            for p in errors:
+                writer.remove(p)
+    finally:
+        writer.close()
+
+
+def drop_caches():
+    os.sync()
+    with open('/proc/sys/vm/drop_caches', 'w') as f:
+        f.write('3')
+
+
+def run(label, fn, datastore, count, cold):
+    if cold:
+        drop_caches()
+
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print('{0}: {1:.2f}s, {2:.0f} files/s, {3} round trips, {4} documents'.format(
+        label, elapsed, count / elapsed, datastore.round_trips, len(datastore.docs)
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', metavar='DEPTH', type=int, default=3)
+    parser.add_argument('-f', metavar='FANOUT', type=int, default=8)
+    parser.add_argument('-n', metavar='FILES', type=int, default=16, help='Files per directory')
+    parser.add_argument('-l', metavar='LATENCY', type=float, default=0.0003, help='Datastore round trip latency in seconds')
+    parser.add_argument('-w', metavar='WORKERS', default='1,4', help='Comma separated scan worker counts')
+    parser.add_argument('--legacy', action='store_true', help='Also time the former implementation')
+    parser.add_argument('--cold', action='store_true', help='Drop the page cache before each run')
+    args = parser.parse_args()
+
+    # Paths are expected to look like /mnt/<volume>/...
+    tmpdir = tempfile.mkdtemp()
+    try:
+        mountpoint = os.path.join(tmpdir, 'tank', 'data')
+        os.makedirs(mountpoint)
+        count = generate(mountpoint, args.d, args.f, args.n)
+        print('{0} files and directories'.format(count))
+
+        if args.legacy:
+            datastore = FakeDatastore(args.l)
+            run('legacy', lambda: legacy_index(datastore, mountpoint), datastore, count, args.cold)
+
+        for workers in (int(i) for i in args.w.split(',')):
+            datastore = FakeDatastore(args.l)
+            run('pipeline, {0} workers'.format(workers), lambda: index(datastore, mountpoint, workers), datastore, count, args.cold)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
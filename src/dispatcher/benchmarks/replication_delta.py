@@ -0,0 +1,146 @@
+#+
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+
+"""
+Replication delta calculation benchmark. Builds a synthetic tree of local
+datasets with snapshots, a remote snapshot list that's partially in sync
+with it, and runs CalculateReplicationDeltaTask against a fake dispatcher.
+Also times the former per-dataset regex query + O(local x remote) matching
+on the same data.
+
+Usage: python3 replication_delta.py [-d 1000] [-s 100]
+"""
+
+import os
+import re
+import sys
+import time
+import random
+import logging
+import argparse
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'plugins'))
+import ReplicationPlugin  # noqa
+
+
+class FakeDispatcher(object):
+    def __init__(self, datasets):
+        self.datasets = datasets
+
+    def call_sync(self, method, *args):
+        if method == 'zfs.dataset.query':
+            return list(self.datasets.keys())
+
+        if method == 'zfs.dataset.get_snapshots':
+            return self.datasets[args[0]]
+
+        if method == 'zfs.dataset.estimate_send_size':
+            return 0
+
+        raise ValueError(method)
+
+
+def generate(count, snapshots):
+    base = datetime(2016, 1, 1)
+    local = {}
+    remote = []
+    for d in range(count):
+        name = 'tank/data' if d == 0 else 'tank/data/ds{0}'.format(d)
+        local[name] = []
+        remote_name = name.replace('tank/data', 'backup/data', 1)
+        synced = random.randint(0, snapshots)
+        for s in range(snapshots):
+            created = base + timedelta(hours=s)
+            snapname = 'auto-{0:%Y%m%d.%H%M}'.format(created)
+            local[name].append({
+                'name': '{0}@{1}'.format(name, snapname),
+                'snapshot_name': snapname,
+                'properties': {
+                    'creation': {'parsed': created},
+                    'createtxg': {'rawvalue': str(1000 + s)},
+                    'org.freenas:uuid': None
+                }
+            })
+
+            if s < synced:
+                remote.append({'name': '{0}@{1}'.format(remote_name, snapname), 'created_at': created})
+
+    return local, remote
+
+
+def legacy_match(local, remote):
+    # Former algorithm: regex query over the whole remote list and
+    # first_or_default() matching, for every dataset
+    matched = 0
+    for name, snapshots in local.items():
+        remotefs = name.replace('tank/data', 'backup/data', 1)
+        regex = re.compile('^{0}@'.format(remotefs))
+        remote_snapshots = [s for s in remote if regex.match(s['name'])]
+        for i in snapshots:
+            snapname = i['name'].split('@')[-1]
+            created = i['properties']['creation']['parsed']
+            for s in remote_snapshots:
+                if s['name'].split('@')[-1] == snapname and s['created_at'] == created:
+                    matched += 1
+                    break
+
+    return matched
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', metavar='DATASETS', type=int, default=1000)
+    parser.add_argument('-s', metavar='SNAPSHOTS', type=int, default=100)
+    parser.add_argument('--legacy', action='store_true', help='Also time the former matching')
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    random.seed(args.d)
+    local, remote = generate(args.d, args.s)
+    print('{0} datasets, {1} local and {2} remote snapshots'.format(
+        len(local),
+        sum(len(i) for i in local.values()),
+        len(remote)
+    ))
+
+    task = ReplicationPlugin.CalculateReplicationDeltaTask.__new__(ReplicationPlugin.CalculateReplicationDeltaTask)
+    task.dispatcher = FakeDispatcher(local)
+    start = time.perf_counter()
+    actions, _ = task.run('tank/data', 'backup/data', remote, recursive=True, followdelete=True)
+    print('delta: {0} actions in {1:.3f}s'.format(len(actions), time.perf_counter() - start))
+
+    if args.legacy:
+        start = time.perf_counter()
+        matched = legacy_match(local, remote)
+        print('legacy matching: {0} matches in {1:.3f}s'.format(matched, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
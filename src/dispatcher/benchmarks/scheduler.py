@@ -0,0 +1,117 @@
+#+
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+"""
+Scheduler micro-benchmark for ResourceGraph. Builds a synthetic resource
+tree (pools, datasets, shares and zvols below 'system'), then simulates
+the balancer scheduling a queue of waiting tasks against it.
+
+Usage: python3 scheduler.py [-n 10000] [-t 500]
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from resources import Resource, ResourceGraph  # noqa
+
+
+def build_graph(count, pools=4, fanout=8):
+    graph = ResourceGraph()
+    graph.add_resource(Resource('system'))
+    names = []
+
+    for p in range(pools):
+        pool = 'zpool:pool{0}'.format(p)
+        graph.add_resource(Resource(pool), parents=['system'])
+        names.append(pool)
+
+    parents = list(names)
+    while len(names) < count:
+        parent = random.choice(parents)
+        name = '{0}/ds{1}'.format(parent, len(names))
+        graph.add_resource(Resource(name), parents=[parent])
+        names.append(name)
+        if len(parents) < count // fanout:
+            parents.append(name)
+
+    return graph, names
+
+
+def schedule(graph, tasks):
+    # Mimics Balancer.schedule_tasks() being called on every task exit
+    started = 0
+    waiting = list(tasks)
+    while waiting:
+        running = []
+        still_waiting = []
+        for resources in waiting:
+            if graph.can_acquire(*resources):
+                graph.acquire(*resources)
+                running.append(resources)
+                started += 1
+            else:
+                still_waiting.append(resources)
+
+        for resources in running:
+            graph.release(*resources)
+
+        waiting = still_waiting
+
+    return started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', metavar='RESOURCES', type=int, default=10000)
+    parser.add_argument('-t', metavar='TASKS', type=int, default=500)
+    args = parser.parse_args()
+
+    random.seed(args.n)
+    start = time.perf_counter()
+    graph, names = build_graph(args.n)
+    print('Built graph of {0} resources in {1:.2f}s'.format(len(names), time.perf_counter() - start))
+
+    start = time.perf_counter()
+    for name in random.sample(names, min(len(names), 10000)):
+        graph.get_resource(name)
+
+    print('get_resource: {0:.0f} lookups/s'.format(min(len(names), 10000) / (time.perf_counter() - start)))
+
+    # Parents go first, like tasks locking a pool and some of its datasets do
+    tasks = [sorted(random.sample(names, random.randint(1, 3)), key=len) for _ in range(args.t)]
+    start = time.perf_counter()
+    started = schedule(graph, tasks)
+    elapsed = time.perf_counter() - start
+    print('Scheduled {0} tasks in {1:.3f}s ({2:.0f} tasks/s)'.format(started, elapsed, started / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+#+
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+
+"""
+Replication transport compression benchmark. Pushes a synthetic,
+partially compressible stream through compress_blocks() and
+decompress_blocks() connected by a local socketpair, and reports
+end-to-end throughput for each codec and worker thread count.
+
+Build the transport plugin in place first:
+    python3 setup_plugins.py build_ext --inplace
+
+Usage: python3 transport_compress.py [-s 256] [-t 1,2,4,8] [-c zlib,lz4]
+"""
+
+import os
+import sys
+import time
+import socket
+import random
+import hashlib
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import ReplicationTransportPlugin as transport  # noqa
+
+
+def generate(size):
+    # Mix of random and repetitive chunks, roughly 2:1 compressible
+    rnd = random.Random(size)
+    words = [bytes(rnd.choice(b'abcdefghijklmnopqrstuvwxyz') for _ in range(rnd.randint(3, 10))) for _ in range(512)]
+    chunks = []
+    done = 0
+    while done < size:
+        if rnd.random() < 0.3:
+            chunk = os.urandom(64 * 1024)
+        else:
+            chunk = b' '.join(rnd.choice(words) for _ in range(8192))[:64 * 1024]
+
+        chunks.append(chunk)
+        done += len(chunk)
+
+    return b''.join(chunks)[:size]
+
+
+def run(data, codec, level, threads, block_size):
+    src_rd, src_wr = os.pipe()
+    dst_rd, dst_wr = os.pipe()
+    left, right = socket.socketpair()
+    result = {}
+
+    def feed():
+        transport.write_all(src_wr, data)
+        os.close(src_wr)
+
+    def compress():
+        transport.compress_blocks(src_rd, left.fileno(), codec, level, threads, block_size)
+        left.shutdown(socket.SHUT_WR)
+
+    def decompress():
+        transport.decompress_blocks(right.fileno(), dst_wr, threads)
+        os.close(dst_wr)
+
+    def drain():
+        digest = hashlib.md5()
+        while True:
+            chunk = os.read(dst_rd, 1024 * 1024)
+            if not chunk:
+                break
+
+            digest.update(chunk)
+
+        result['digest'] = digest.digest()
+
+    workers = [threading.Thread(target=fn) for fn in (feed, compress, decompress, drain)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+
+    for t in workers:
+        t.join()
+
+    elapsed = time.perf_counter() - start
+    for fd in (src_rd, dst_rd):
+        os.close(fd)
+
+    left.close()
+    right.close()
+    return elapsed, result['digest']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', metavar='MB', type=int, default=256)
+    parser.add_argument('-t', metavar='THREADS', default='1,2,4,8')
+    parser.add_argument('-c', metavar='CODECS', default=','.join(sorted(transport.block_codecs())))
+    parser.add_argument('-l', metavar='LEVEL', default='DEFAULT', choices=['FAST', 'DEFAULT', 'BEST'])
+    parser.add_argument('-b', metavar='BLOCK_SIZE', type=int, default=transport.BLOCK_DEFAULT_SIZE)
+    args = parser.parse_args()
+
+    data = generate(args.s * 1024 * 1024)
+    expected = hashlib.md5(data).digest()
+    print('{0} MB stream, {1} byte blocks, zlib level {2}'.format(args.s, args.b, args.l))
+
+    for codec in args.c.split(','):
+        for threads in (int(i) for i in args.t.split(',')):
+            elapsed, digest = run(data, codec, args.l, threads, args.b)
+            print('{0:>5} x{1:<3} {2:8.1f} MB/s{3}'.format(
+                codec,
+                threads,
+                args.s / elapsed,
+                '' if digest == expected else '  MISMATCH'
+            ))
+
+
+if __name__ == '__main__':
+    main()
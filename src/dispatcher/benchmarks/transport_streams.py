@@ -0,0 +1,181 @@
+#+
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+
+"""
+Multi-stream replication transport benchmark. Stripes a synthetic stream
+with StripeSender over N loopback TCP connections and reassembles it with
+StripeReceiver. Every connection goes through a proxy adding artificial
+delay with a bounded in-flight window, so a single stream is capped at
+roughly window / delay, like a TCP stream on a long fat link.
+
+For a test with real TCP behaviour, drop the proxy (-d 0) and add delay
+with dummynet instead, eg.:
+    ipfw pipe 1 config delay 50ms && ipfw add pipe 1 ip from any to any via lo0
+
+Build the transport plugin in place first:
+    python3 setup_plugins.py build_ext --inplace
+
+Usage: python3 transport_streams.py [-s 32] [-n 1,2,4,8] [-d 50] [-w 256]
+"""
+
+import os
+import sys
+import time
+import socket
+import hashlib
+import argparse
+import threading
+import collections
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import ReplicationTransportPlugin as transport  # noqa
+
+
+def delay_proxy(src, dst, delay, window):
+    cv = threading.Condition()
+    pending = collections.deque()
+    inflight = [0]
+
+    def reader():
+        while True:
+            data = src.recv(65536)
+            with cv:
+                cv.wait_for(lambda: inflight[0] < window)
+                pending.append((time.monotonic() + delay, data))
+                inflight[0] += len(data)
+                cv.notify_all()
+
+            if not data:
+                return
+
+    def writer():
+        while True:
+            with cv:
+                cv.wait_for(lambda: pending)
+                due, data = pending.popleft()
+
+            time.sleep(max(due - time.monotonic(), 0))
+            if not data:
+                dst.shutdown(socket.SHUT_WR)
+                return
+
+            dst.sendall(data)
+            with cv:
+                inflight[0] -= len(data)
+                cv.notify_all()
+
+    for fn in (reader, writer):
+        threading.Thread(target=fn, daemon=True).start()
+
+
+def connect(streams, delay, window):
+    # Returns pairs of (sending, receiving) sockets
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(streams)
+    pairs = []
+    for i in range(streams):
+        client = socket.create_connection(server.getsockname())
+        conn, _ = server.accept()
+        if delay:
+            inner, outer = socket.socketpair()
+            delay_proxy(conn, outer, delay, window)
+            pairs.append((client, inner))
+        else:
+            pairs.append((conn, client))
+
+    server.close()
+    return pairs
+
+
+def run(data, streams, chunk_size, delay, window):
+    pairs = connect(streams, delay, window)
+    src_rd, src_wr = os.pipe()
+    dst_rd, dst_wr = os.pipe()
+    sender = transport.StripeSender(src_rd, [p[0] for p in pairs], chunk_size)
+    receiver = transport.StripeReceiver([p[1] for p in pairs], dst_wr, streams * 4)
+    digest = hashlib.md5()
+
+    def feed():
+        transport.write_all(src_wr, data)
+        os.close(src_wr)
+
+    start = time.perf_counter()
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+    sender.start()
+    receiver.start()
+    while True:
+        chunk = os.read(dst_rd, 1024 * 1024)
+        if not chunk:
+            break
+
+        digest.update(chunk)
+
+    elapsed = time.perf_counter() - start
+    feeder.join()
+    error = sender.join() or receiver.join()
+    os.close(dst_rd)
+    stats = receiver.get_status()
+    for s, r in pairs:
+        s.close()
+        r.close()
+
+    return elapsed, digest.digest(), error, stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', metavar='MB', type=int, default=32)
+    parser.add_argument('-n', metavar='STREAMS', default='1,2,4,8')
+    parser.add_argument('-d', metavar='DELAY_MS', type=float, default=50)
+    parser.add_argument('-w', metavar='WINDOW_KB', type=int, default=256)
+    parser.add_argument('-c', metavar='CHUNK_KB', type=int, default=1024)
+    parser.add_argument('-v', action='store_true', help='Print per-stream statistics')
+    args = parser.parse_args()
+
+    data = os.urandom(args.s * 1024 * 1024)
+    expected = hashlib.md5(data).digest()
+    print('{0} MB stream, {1} KB chunks, {2} ms delay, {3} KB window'.format(args.s, args.c, args.d, args.w))
+
+    for streams in (int(i) for i in args.n.split(',')):
+        elapsed, digest, error, stats = run(data, streams, args.c * 1024, args.d / 1000, args.w * 1024)
+        print('{0:>3} streams {1:8.1f} MB/s{2}'.format(
+            streams,
+            args.s / elapsed,
+            ' ERROR: {0}'.format(error) if error else '' if digest == expected else '  MISMATCH'
+        ))
+
+        if args.v:
+            for i in stats:
+                print('    stream {stream}: {bytes} bytes in {chunks} chunks, {throughput} B/s'.format(**i))
+
+
+if __name__ == '__main__':
+    main()
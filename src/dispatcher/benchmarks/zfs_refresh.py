@@ -0,0 +1,231 @@
+#+
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+
+"""
+Benchmarks the periodic refresh of volatile ZFS properties against a fake
+libzfs holding a synthetic pool/dataset hierarchy. Compares the former
+per-dataset refresh loop with VolatileRefresher.
+
+Usage: python3 zfs_refresh.py [-p 4] [-d 20000] [-c 0.05]
+"""
+
+import os
+import sys
+import time
+import types
+import random
+import argparse
+import importlib.util
+from gevent.threadpool import ThreadPool
+from gevent.lock import RLock
+
+
+class ZFSException(Exception):
+    pass
+
+
+class FakeProperty(object):
+    def __init__(self, value):
+        self.rawvalue = str(value)
+
+    def __getstate__(self):
+        return {'rawvalue': self.rawvalue, 'value': self.rawvalue, 'parsed': int(self.rawvalue), 'source': 'NONE'}
+
+
+class FakeDataset(object):
+    def __init__(self, name):
+        self.name = name
+        self.children = []
+        self.properties = {}
+
+    def __getstate__(self, recursive=True):
+        return {
+            'id': self.name,
+            'name': self.name,
+            'pool': self.name.split('/')[0],
+            'type': 'FILESYSTEM',
+            'properties': {k: v.__getstate__() for k, v in self.properties.items()}
+        }
+
+
+class FakePool(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __getstate__(self, recursive=True):
+        return {'id': self.name, 'name': self.name, 'status': 'ONLINE'}
+
+
+class FakeZFS(object):
+    def __init__(self, pools, count, volatile):
+        self.pools_dict = {}
+        self.datasets_dict = {}
+        self.volatile = volatile
+
+        for p in range(pools):
+            name = 'pool{0}'.format(p)
+            self.pools_dict[name] = FakePool(name)
+            self.add_dataset(name, None)
+
+        parents = list(self.datasets_dict.values())
+        while len(self.datasets_dict) < count:
+            parent = random.choice(parents)
+            ds = self.add_dataset('{0}/ds{1}'.format(parent.name, len(self.datasets_dict)), parent)
+            if len(parents) < count // 8:
+                parents.append(ds)
+
+    def add_dataset(self, name, parent):
+        ds = FakeDataset(name)
+        for prop in self.volatile:
+            ds.properties[prop] = FakeProperty(random.randint(0, 1 << 40))
+
+        self.datasets_dict[name] = ds
+        if parent:
+            parent.children.append(ds)
+
+        return ds
+
+    @property
+    def datasets(self):
+        return iter(self.datasets_dict.values())
+
+    def get(self, name):
+        return self.pools_dict[name]
+
+    def get_dataset(self, name):
+        try:
+            return self.datasets_dict[name]
+        except KeyError:
+            raise ZFSException(name)
+
+    def mutate(self, fraction):
+        for ds in random.sample(list(self.datasets_dict.values()), int(len(self.datasets_dict) * fraction)):
+            ds.properties['used'] = FakeProperty(random.randint(0, 1 << 40))
+
+
+class FakeDispatcher(object):
+    def __init__(self):
+        self.threadpool = ThreadPool(20)
+        self.lock = RLock()
+        self.events = 0
+
+    def threaded(self, fn, *args, **kwargs):
+        return self.threadpool.apply(fn, args, kwargs)
+
+    def get_lock(self, name):
+        return self.lock
+
+    def emit_event(self, name, args):
+        self.events += 1
+
+
+# ZfsPlugin gets imported against the fake libzfs
+sys.modules['libzfs'] = types.SimpleNamespace(ZFSException=ZFSException, ZFS=FakeZFS)
+if importlib.util.find_spec('bsd') is None:
+    sys.modules['bsd'] = types.ModuleType('bsd')
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'plugins'))
+from cache import EventCacheStore  # noqa
+import ZfsPlugin  # noqa
+
+
+def legacy_refresh(dispatcher, zfs, pools, datasets):
+    with dispatcher.get_lock('zfs-cache'):
+        for key, i in pools.itervalid():
+            zfspool = dispatcher.threaded(lambda: zfs.get(key).__getstate__(False))
+            if zfspool != i:
+                pools.put(key, zfspool)
+
+        for key, i in datasets.itervalid():
+            def doit():
+                props = i['properties']
+                ds = zfs.get_dataset(i['id'])
+                changed = False
+
+                for prop in ZfsPlugin.VOLATILE_ZFS_PROPERTIES:
+                    if props[prop]['rawvalue'] != ds.properties[prop].rawvalue:
+                        props[prop] = ds.properties[prop].__getstate__()
+                        changed = True
+
+                return changed
+
+            if dispatcher.threaded(doit):
+                datasets.put(key, i)
+
+
+def setup(args):
+    random.seed(args.d)
+    zfs = FakeZFS(args.p, args.d, ZfsPlugin.VOLATILE_ZFS_PROPERTIES)
+    dispatcher = FakeDispatcher()
+    pools = EventCacheStore(dispatcher, 'zfs.pool')
+    datasets = EventCacheStore(dispatcher, 'zfs.dataset', hash_indexes=['name', 'pool', 'type'])
+    pools.update(**{k: v.__getstate__() for k, v in zfs.pools_dict.items()})
+    datasets.update(**{d.name: d.__getstate__() for d in zfs.datasets})
+    pools.ready = True
+    datasets.ready = True
+    return zfs, dispatcher, pools, datasets
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', metavar='POOLS', type=int, default=4)
+    parser.add_argument('-d', metavar='DATASETS', type=int, default=20000)
+    parser.add_argument('-c', metavar='CHANGED', type=float, default=0.05)
+    parser.add_argument('-n', metavar='PASSES', type=int, default=3)
+    args = parser.parse_args()
+
+    zfs, dispatcher, pools, datasets = setup(args)
+    start = time.perf_counter()
+    for _ in range(args.n):
+        zfs.mutate(args.c)
+        legacy_refresh(dispatcher, zfs, pools, datasets)
+
+    elapsed = (time.perf_counter() - start) / args.n
+    print('legacy: {0:.3f}s per pass, {1} events'.format(elapsed, dispatcher.events))
+
+    zfs, dispatcher, pools, datasets = setup(args)
+    refresher = ZfsPlugin.VolatileRefresher(dispatcher, lambda: zfs, pools, datasets)
+    start = time.perf_counter()
+    for _ in range(args.n):
+        zfs.mutate(args.c)
+        refresher.refresh()
+
+    elapsed = (time.perf_counter() - start) / args.n
+    stats = refresher.get_stats()
+    print('batched: {0:.3f}s per pass (fetch {1:.3f}s), {2} events, {3} of {4} datasets changed in last pass'.format(
+        elapsed,
+        stats['last_fetch_duration'],
+        dispatcher.events,
+        stats['last_changed_datasets'],
+        stats['last_datasets']
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -35,9 +35,14 @@ import logging
 import tempfile
 import base64
 import gevent
+import gevent.lock
+import gevent.event
+import gevent.pool
+import gevent.threadpool
 import time
 import libzfs
 import contextlib
+from collections import OrderedDict
 from xml.etree import ElementTree
 from bsd import geom, getswapinfo
 from resources import Resource
@@ -59,12 +64,19 @@ from pySMART import Device, smart_health_assement
 
 EXPIRE_TIMEOUT = timedelta(hours=24)
 SMART_CHECK_INTERVAL = 600  # in seconds (i.e. 10 minutes)
+SMART_STAGGER_RATIO = 0.5  # fraction of SMART_CHECK_INTERVAL polls are spread across
+SMART_MAX_WORKERS = 8
+SMART_CONTROLLER_CONCURRENCY = 2
+GEOM_DEBOUNCE_INTERVAL = 0.5
+GEOM_BATCH_CONCURRENCY = 8
 SMART_ALERT_MAP = {
     'WARN': ('SmartWarn', 'S.M.A.R.T status warning'),
     'FAIL': ('SmartFail', 'S.M.A.R.T status failing')
 }
 multipaths = -1
 diskinfo_cache = CacheStore()
+smart_poller = None
+geom_batcher = None
 logger = logging.getLogger('DiskPlugin')
 
 
@@ -109,6 +121,10 @@ class DiskProvider(Provider):
     def is_online(self, name):
         return os.path.exists(name)
 
+    @private
+    def get_smart_stats(self):
+        return smart_poller.get_stats() if smart_poller else None
+
     @accepts(str)
     @returns(str)
     def partition_to_disk(self, part_name):
@@ -1203,8 +1219,10 @@ def generate_multipath_info(gmultipath):
     }
 
 
-def update_disk_cache(dispatcher, path):
-    dispatcher.threaded(geom.scan)
+def update_disk_cache(dispatcher, path, rescan=True):
+    if rescan:
+        dispatcher.threaded(geom.scan)
+
     name = re.match('/dev/(.*)', path).group(1)
     gdisk = geom.geom_by_name('DISK', name)
     gpart = geom.geom_by_name('PART', name)
@@ -1305,8 +1323,10 @@ def update_disk_cache(dispatcher, path):
     persist_disk(dispatcher, disk)
 
 
-def generate_disk_cache(dispatcher, path):
-    dispatcher.threaded(geom.scan)
+def generate_disk_cache(dispatcher, path, rescan=True):
+    if rescan:
+        dispatcher.threaded(geom.scan)
+
     name = os.path.basename(path)
     gdisk = geom.geom_by_name('DISK', name)
     multipath_info = None
@@ -1360,14 +1380,16 @@ def generate_disk_cache(dispatcher, path):
 
         diskinfo_cache.put(identifier, disk)
 
-    update_disk_cache(dispatcher, path)
+    update_disk_cache(dispatcher, path, rescan=rescan or multipath_info is not None)
     configure_disk(dispatcher.datastore, identifier)
 
     logger.info('Added <%s> (%s) to disk cache', identifier, disk['description'])
 
 
-def purge_disk_cache(dispatcher, path):
-    dispatcher.threaded(geom.scan)
+def purge_disk_cache(dispatcher, path, rescan=True):
+    if rescan:
+        dispatcher.threaded(geom.scan)
+
     delete = False
     disk = get_disk_by_path(path)
 
@@ -1481,59 +1503,276 @@ def configure_disk(datastore, id):
         gevent.spawn_later(60, configure_standby, standby_mode)
 
 
-def update_smart_info(dispatcher, disk):
-    updated = False
+def query_smart_info(disk_name):
     # setting all_info to False below makes pySMART skip over fields we already
     # have in the disk dict (like name, path, serial number, is_ssd, max_roation and so on)
-    smart_info = Device(disk['gdisk_name']).__getstate__(all_info=False)
-    disk_name = disk['gdisk_name']
-    smart_status = smart_info['smart_status']
-
-    if disk.get('smart_info') != smart_info:
-        disk['smart_info'] = smart_info
-        diskinfo_cache.update_one(disk['id'], smart_info=smart_info)
-        updated = True
-
-    existing_smart_alerts = dispatcher.call_sync(
-        'alert.query',
-        [
-            ('active', '=', True),
-            ('dismissed', '=', False),
-            ('class', 'in', ('SmartFail', 'SmartWarn')),
-            ('target', '=', disk_name)
-        ]
-    )
+    return Device(disk_name).__getstate__(all_info=False)
+
+
+def query_smart_alerts(dispatcher, disk_name=None):
+    filter = [
+        ('active', '=', True),
+        ('dismissed', '=', False),
+        ('class', 'in', ('SmartFail', 'SmartWarn'))
+    ]
+
+    if disk_name:
+        filter.append(('target', '=', disk_name))
+
+    return dispatcher.call_sync('alert.query', filter)
+
+
+def smart_alert_diff(disk_name, smart_status, existing_smart_alerts):
+    # Returns alert to emit (or None) and ids of alerts to cancel
+    emit = None
+    cancel = []
 
     if smart_status in ('FAIL', 'WARN'):
         # We need to issue a S.M.A.R.T alert for this disk
         alert_class, title = SMART_ALERT_MAP[smart_status]
-        alert_payload = {
-            'class': alert_class,
-            'title': title,
-            'target': disk_name,
-            'description': 'Disk {0} S.M.A.R.T status: {1}.\
-            See disk info in GUI/CLI for details'.format(disk_name, smart_status)
-        }
-
         alert_exists = False
 
         for smart_alert in existing_smart_alerts:
             if smart_alert['class'] == alert_class and smart_alert['target'] == disk_name:
                 alert_exists = True
                 continue
-            dispatcher.call_sync('alert.cancel', smart_alert['id'])
+            cancel.append(smart_alert['id'])
 
         if not alert_exists:
-            dispatcher.call_sync('alert.emit', alert_payload)
+            emit = {
+                'class': alert_class,
+                'title': title,
+                'target': disk_name,
+                'description': 'Disk {0} S.M.A.R.T status: {1}.\
+                See disk info in GUI/CLI for details'.format(disk_name, smart_status)
+            }
     elif smart_status == 'PASS':
         # for various reasons the SMART status of this disk (or a disk with this name)
         # may have a previous 'FAIL' | 'WARN' smart status in which case clear those alerts
-        for smart_alert in existing_smart_alerts:
-            dispatcher.call_sync('alert.cancel', smart_alert['id'])
+        cancel = [a['id'] for a in existing_smart_alerts]
+
+    return emit, cancel
+
+
+def apply_smart_alerts(dispatcher, emit, cancel):
+    for id in cancel:
+        dispatcher.call_sync('alert.cancel', id)
 
+    if emit:
+        dispatcher.call_sync('alert.emit', emit)
+
+
+def set_smart_info(disk, smart_info):
+    if disk.get('smart_info') == smart_info:
+        return False
+
+    disk['smart_info'] = smart_info
+    diskinfo_cache.update_one(disk['id'], smart_info=smart_info)
+    return True
+
+
+def update_smart_info(dispatcher, disk):
+    disk_name = disk['gdisk_name']
+    smart_info = dispatcher.threaded(query_smart_info, disk_name)
+    updated = set_smart_info(disk, smart_info)
+    emit, cancel = smart_alert_diff(disk_name, smart_info['smart_status'], query_smart_alerts(dispatcher, disk_name))
+    apply_smart_alerts(dispatcher, emit, cancel)
     return updated
 
 
+class SmartPoller(object):
+    """
+    Polls S.M.A.R.T status of all disks. Device queries run on a dedicated
+    thread pool, limited per controller and staggered across the sweep
+    window. Alerts are diffed against a single alert snapshot per sweep and
+    changed disks are announced with one disk.changed event.
+    """
+    def __init__(self, dispatcher, window):
+        self.dispatcher = dispatcher
+        self.window = window
+        self.threadpool = gevent.threadpool.ThreadPool(SMART_MAX_WORKERS)
+        self.controllers = {}
+        self.stats = {
+            'sweeps': 0,
+            'last_sweep_duration': None,
+            'last_polled': 0,
+            'last_failed': 0,
+            'last_changed': 0,
+            'last_alerts_emitted': 0,
+            'last_alerts_cancelled': 0,
+            'query_latency_avg': None,
+            'query_latency_max': None
+        }
+
+    @staticmethod
+    def controller_key(disk):
+        controller = disk.get('controller')
+        if controller and controller.get('controller_name') is not None:
+            return controller.get('controller_name'), controller.get('controller_unit')
+
+        # Fall back to the device driver (ada, da, nvd...)
+        return re.sub(r'[0-9]+$', '', disk['gdisk_name']), None
+
+    def poll(self, disk, delay):
+        gevent.sleep(delay)
+        key = self.controller_key(disk)
+        sem = self.controllers.setdefault(key, gevent.lock.Semaphore(SMART_CONTROLLER_CONCURRENCY))
+        with sem:
+            start = time.time()
+            try:
+                return self.threadpool.apply(query_smart_info, (disk['gdisk_name'],)), time.time() - start
+            except Exception as err:
+                logger.warning('Cannot query S.M.A.R.T status of {0}: {1}'.format(disk['gdisk_name'], str(err)))
+                return None, time.time() - start
+
+    def sweep(self):
+        start = time.time()
+        disks = [d for d in diskinfo_cache.validvalues() if d.get('gdisk_name')]
+        step = self.window / len(disks) if disks else 0
+        jobs = [gevent.spawn(self.poll, d, i * step) for i, d in enumerate(disks)]
+        gevent.joinall(jobs)
+
+        alerts = {}
+        for a in query_smart_alerts(self.dispatcher):
+            alerts.setdefault(a['target'], []).append(a)
+
+        updated = []
+        latencies = []
+        failed = emitted = cancelled = 0
+        for disk, job in zip(disks, jobs):
+            smart_info, latency = job.value
+            latencies.append(latency)
+            if smart_info is None:
+                failed += 1
+                continue
+
+            if set_smart_info(disk, smart_info):
+                updated.append(disk['id'])
+
+            emit, cancel = smart_alert_diff(
+                disk['gdisk_name'],
+                smart_info['smart_status'],
+                alerts.get(disk['gdisk_name'], [])
+            )
+
+            try:
+                apply_smart_alerts(self.dispatcher, emit, cancel)
+                emitted += 1 if emit else 0
+                cancelled += len(cancel)
+            except RpcException as err:
+                logger.warning('Cannot update S.M.A.R.T alerts of {0}: {1}'.format(disk['gdisk_name'], str(err)))
+
+        if updated:
+            self.dispatcher.dispatch_event('disk.changed', {
+                'operation': 'update',
+                'ids': updated
+            })
+
+        self.stats.update({
+            'sweeps': self.stats['sweeps'] + 1,
+            'last_sweep_duration': time.time() - start,
+            'last_polled': len(disks),
+            'last_failed': failed,
+            'last_changed': len(updated),
+            'last_alerts_emitted': emitted,
+            'last_alerts_cancelled': cancelled,
+            'query_latency_avg': sum(latencies) / len(latencies) if latencies else None,
+            'query_latency_max': max(latencies) if latencies else None
+        })
+
+        return updated
+
+    def get_stats(self):
+        return dict(self.stats)
+
+
+class GeomEventBatcher(object):
+    """
+    Coalesces device attach/detach/mediachange events arriving within
+    a short window, so that a whole batch (ie. all disks at boot time or
+    an enclosure being hot-plugged) is processed against a single GEOM scan.
+
+    Disk cache updates for a path go through attach(), detach() and
+    mediachange(), which tests override to replay recorded confxml snapshots.
+    """
+    def __init__(self, dispatcher, scan=None, interval=GEOM_DEBOUNCE_INTERVAL):
+        self.dispatcher = dispatcher
+        self.scan = scan or geom.scan
+        self.interval = interval
+        self.lock = gevent.lock.Semaphore()
+        self.pending = OrderedDict()
+        self.done = None
+        self.worker = None
+        self.scans = 0
+        self.batches = 0
+
+    def submit(self, op, path):
+        # Last event for given path wins, except mediachange doesn't
+        # override a pending attach (which does a full update anyway) and
+        # attach after a pending detach still purges the stale entry first
+        current = self.pending.get(path)
+        if op == 'attach' and current in ('detach', 'reattach'):
+            op = 'reattach'
+
+        if not (op == 'mediachange' and current in ('attach', 'reattach')):
+            self.pending.pop(path, None)
+            self.pending[path] = op
+
+        if not self.worker:
+            self.done = gevent.event.Event()
+            self.worker = gevent.spawn(self.run)
+
+        self.done.wait()
+
+    def run(self):
+        gevent.sleep(self.interval)
+        batch, self.pending = self.pending, OrderedDict()
+        done, self.done = self.done, None
+        self.worker = None
+
+        try:
+            with self.lock:
+                self.process(batch)
+        finally:
+            done.set()
+
+    def process(self, batch):
+        start = time.time()
+        self.dispatcher.threaded(self.scan)
+        self.scans += 1
+        self.batches += 1
+
+        def doit(path, op):
+            try:
+                with self.dispatcher.get_lock('diskcache:{0}'.format(path)):
+                    if op == 'reattach':
+                        self.detach(path)
+                        self.attach(path)
+                    else:
+                        getattr(self, op)(path)
+            except Exception as err:
+                logger.error('Cannot process {0} of {1}: {2}'.format(op, path, str(err)), exc_info=True)
+
+        pool = gevent.pool.Pool(GEOM_BATCH_CONCURRENCY)
+        for path, op in batch.items():
+            pool.spawn(doit, path, op)
+
+        pool.join()
+        logger.debug('Processed {0} device events using single GEOM scan in {1:.0f} ms'.format(
+            len(batch),
+            (time.time() - start) * 1000
+        ))
+
+    def attach(self, path):
+        generate_disk_cache(self.dispatcher, path, rescan=False)
+
+    def detach(self, path):
+        purge_disk_cache(self.dispatcher, path, rescan=False)
+
+    def mediachange(self, path):
+        update_disk_cache(self.dispatcher, path, rescan=False)
+
+
 def collect_debug(dispatcher):
     yield AttachCommandOutput('gpart', ['/sbin/gpart', 'show'])
     yield AttachData('disk-cache-state', json.dumps(diskinfo_cache.query(), indent=4))
@@ -1545,6 +1784,10 @@ def _depends():
 
 
 def _init(dispatcher, plugin):
+    global geom_batcher
+
+    geom_batcher = GeomEventBatcher(dispatcher)
+
     def on_device_attached(args):
         path = args['path']
         if re.match(r'^/dev/(da|ada|vtbd|nvd|multipath/mpath)[0-9]+$', path):
@@ -1554,14 +1797,13 @@ def _init(dispatcher, plugin):
         if re.match(r'^/dev/(da|ada|vtbd|nvd)[0-9]+$', path):
             # Regenerate disk cache
             logger.info("New disk attached: {0}".format(path))
-            with dispatcher.get_lock('diskcache:{0}'.format(path)):
-                generate_disk_cache(dispatcher, path)
+            geom_batcher.submit('attach', path)
 
     def on_device_detached(args):
         path = args['path']
         if re.match(r'^/dev/(da|ada|vtbd|nvd)[0-9]+$', path):
             logger.info("Disk %s detached", path)
-            purge_disk_cache(dispatcher, path)
+            geom_batcher.submit('detach', path)
 
         if re.match(r'^/dev/(da|ada|vtbd|nvd|multipath/mpath)[0-9]+$', path):
             dispatcher.unregister_resource('disk:{0}'.format(path))
@@ -1570,24 +1812,21 @@ def _init(dispatcher, plugin):
         # Regenerate caches
         path = args['path']
         if re.match(r'^/dev/(da|ada|vtbd|nvd|multipath/mpath)[0-9]+$', path):
-            with dispatcher.get_lock('diskcache:{0}'.format(path)):
-                logger.info('Updating disk cache for device %s', args['path'])
-                update_disk_cache(dispatcher, args['path'])
+            logger.info('Updating disk cache for device %s', args['path'])
+            geom_batcher.submit('mediachange', path)
 
     def smart_updater():
+        global smart_poller
+
+        smart_poller = SmartPoller(dispatcher, SMART_CHECK_INTERVAL * SMART_STAGGER_RATIO)
         while True:
-            updated_disks = [
-                disk['id'] for disk in diskinfo_cache.validvalues() if update_smart_info(dispatcher, disk)
-            ]
-            if updated_disks:
-                dispatcher.dispatch_event(
-                    'disk.changed',
-                    {
-                        'operation': 'update',
-                        'ids': updated_disks
-                    }
-                )
-            gevent.sleep(SMART_CHECK_INTERVAL)
+            start = time.time()
+            try:
+                smart_poller.sweep()
+            except Exception as err:
+                logger.warning('S.M.A.R.T sweep failed: {0}'.format(str(err)))
+
+            gevent.sleep(max(0, SMART_CHECK_INTERVAL - (time.time() - start)))
 
     plugin.register_schema_definition('disk', {
         'type': 'object',
@@ -1873,5 +2112,8 @@ def _init(dispatcher, plugin):
         greenlets.append(gevent.spawn(on_device_attached, {'path': i['path']}))
 
     gevent.wait(greenlets)
-    logger.info("Syncing disk cache took {0:.0f} ms".format((time.time() - disk_cache_start) * 1000))
+    logger.info("Syncing disk cache took {0:.0f} ms ({1} GEOM scans)".format(
+        (time.time() - disk_cache_start) * 1000,
+        geom_batcher.scans
+    ))
     gevent.spawn(smart_updater)
@@ -29,36 +29,40 @@ import logging
 import re
 import gevent
 import contextlib
+from collections import OrderedDict
 from gevent.queue import Queue
 from freenas.utils.trace_logger import TRACE
 from event import EventSource, sync
 
 
-class ScheduledQueryUpdate(object):
-    def __init__(self, parent, service, keys):
-        self.parent = parent
-        self.dispatcher = parent.dispatcher
-        self.service = service
-        self.keys = keys
-        gevent.spawn_later(1, self.run)
+COALESCE_WINDOW = 0.1  # in seconds
+ENTITY_CACHE_SIZE = 10000  # per service
 
-    def run(self):
-        logging.log(TRACE, 'Running update for {0}'.format(self.service))
-        try:
-            entities = list(self.dispatcher.call_sync('{0}.query'.format(self.service), [('id', 'in', list(self.keys))]))
-        except BaseException as e:
-            logging.warning('Cannot fetch changed entities from service {0}: {1}'.format(self.service, str(e)))
-            return
 
-        self.dispatcher.dispatch_event('entity-subscriber.{0}.changed'.format(self.service), {
-            'service': self.service,
-            'operation': 'update',
-            'ids': list(self.keys),
-            'entities': entities,
-            'nolog': True
-        })
+def escape_pointer(key):
+    return str(key).replace('~', '~0').replace('/', '~1')
 
-        del self.parent.scheduled_updates[self.service]
+
+def diff_entity(old, new, path=''):
+    """
+    Returns JSON patch style operations turning old into new. Nested
+    objects are compared recursively, anything else is replaced as a whole.
+    """
+    ops = []
+    for key in old:
+        if key not in new:
+            ops.append({'op': 'remove', 'path': '{0}/{1}'.format(path, escape_pointer(key))})
+
+    for key, value in new.items():
+        keypath = '{0}/{1}'.format(path, escape_pointer(key))
+        if key not in old:
+            ops.append({'op': 'add', 'path': keypath, 'value': value})
+        elif isinstance(value, dict) and isinstance(old[key], dict):
+            ops.extend(diff_entity(old[key], value, keypath))
+        elif type(value) is not type(old[key]) or value != old[key]:
+            ops.append({'op': 'replace', 'path': keypath, 'value': value})
+
+    return ops
 
 
 class EntitySubscriberEventSource(EventSource):
@@ -67,16 +71,45 @@ class EntitySubscriberEventSource(EventSource):
         self.handles = {}
         self.queues = {}
         self.services = []
-        self.scheduled_updates = {}
+        self.entities = {}
         self.logger = logging.getLogger(self.__class__.__name__)
         dispatcher.register_event_handler('server.event.added', self.event_added)
         dispatcher.register_event_handler('server.event.removed', self.event_removed)
 
     def worker(self, service):
+        queue = self.queues[service]
         while True:
-            fn, operation, ids = self.queues[service].get()
-            with contextlib.suppress(BaseException):
-                fn(service, operation, ids)
+            # Events arriving within the window are merged, so that a burst
+            # results in a single query
+            batches = []
+            self.merge(batches, queue.get())
+            gevent.sleep(COALESCE_WINDOW)
+            while not queue.empty():
+                self.merge(batches, queue.get_nowait())
+
+            for operation, rename, keys in batches:
+                logging.log(TRACE, 'Running update for {0}: {1} {2} entities'.format(service, operation, len(keys or [])))
+                with contextlib.suppress(BaseException):
+                    if keys is None:
+                        self.fetch_one(service, operation, None)
+                    else:
+                        self.fetch(service, operation, keys if rename else list(keys))
+
+    def merge(self, batches, event):
+        # Consecutive events of the same operation are merged, different
+        # operations stay in order
+        operation, ids = event
+        rename = isinstance(ids, dict)
+        if batches and batches[-1][:2] == (operation, rename):
+            keys = batches[-1][2]
+            if keys is None and ids is None:
+                return
+
+            if keys is not None and ids is not None:
+                keys.update(ids if rename else dict.fromkeys(ids))
+                return
+
+        batches.append((operation, rename, None if ids is None else OrderedDict(ids if rename else dict.fromkeys(ids))))
 
     def event_added(self, args):
         if args['name'].startswith('entity-subscriber'):
@@ -93,6 +126,7 @@ class EntitySubscriberEventSource(EventSource):
         service, _, changed = args['name'].rpartition('.')
         if changed == 'changed':
             self.services.remove(service)
+            self.entities.pop(service, None)
 
     def changed(self, service, event):
         ids = event.get('ids', None)
@@ -102,26 +136,51 @@ class EntitySubscriberEventSource(EventSource):
             self.logger.warn('Bogus event {0}: no ids and operation is {1}'.format(event, operation))
             return
 
-        self.queues[service].put((self.fetch if ids is not None else self.fetch_one, operation, ids))
+        self.queues[service].put((operation, ids))
+
+    def remember(self, service, key, entity):
+        # Returns the delta against the previously sent version of entity
+        cache = self.entities.setdefault(service, OrderedDict())
+        old = cache.pop(key, None)
+        cache[key] = entity
+        if len(cache) > ENTITY_CACHE_SIZE:
+            cache.popitem(last=False)
+
+        if old is None:
+            return [{'op': 'replace', 'path': '', 'value': entity}]
+
+        return diff_entity(old, entity)
 
     def fetch(self, service, operation, ids):
         entities = None
+        delta = None
+        keys = set(ids.keys() if isinstance(ids, dict) else ids)
 
         if operation in ('create', 'update'):
             try:
-                keys = set(ids.keys() if isinstance(ids, dict) else ids)
                 entities = list(self.dispatcher.call_sync('{0}.query'.format(service), [('id', 'in', list(keys))]))
             except BaseException as e:
                 self.logger.warn('Cannot fetch changed entities from service {0}: {1}'.format(service, str(e)))
                 return
 
-        self.dispatcher.dispatch_event('entity-subscriber.{0}.changed'.format(service), {
+            delta = [{'id': i['id'], 'patch': self.remember(service, i['id'], i)} for i in entities]
+        else:
+            cache = self.entities.get(service, {})
+            for i in keys:
+                cache.pop(i, None)
+
+        args = {
             'service': service,
             'operation': operation,
             'ids': ids,
             'entities': entities,
             'nolog': True
-        })
+        }
+
+        if operation == 'update':
+            args['delta'] = [i for i in delta if i['patch']]
+
+        self.dispatcher.dispatch_event('entity-subscriber.{0}.changed'.format(service), args)
 
     def fetch_one(self, service, operation, ids):
         assert operation == 'update'
@@ -132,6 +191,7 @@ class EntitySubscriberEventSource(EventSource):
             'service': service,
             'operation': operation,
             'data': entity,
+            'delta': self.remember(service, None, entity),
             'nolog': True
         })
 
@@ -144,6 +204,7 @@ class EntitySubscriberEventSource(EventSource):
     def disable(self, event):
         service = re.match(r'^entity-subscriber\.([\.\w]+)\.changed$', event).group(1)
         self.dispatcher.unregister_event_handler('{0}.changed'.format(service), self.handles[service])
+        self.entities.pop(service, None)
 
     def register(self, service):
         self.dispatcher.register_event_type('entity-subscriber.{0}.changed'.format(service), self)
@@ -26,15 +26,25 @@
 #####################################################################
 
 import os
+import stat
+import time
 import errno
 import libzfs
 import bsd
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 from task import Provider, TaskDescription, TaskException, ProgressTask, query
 from freenas.dispatcher.rpc import generator, description, accepts, private
 from freenas.utils.permissions import get_type, get_unix_permissions
 
 
+INDEX_WORKERS = 4
+INDEX_QUEUE_DEPTH = 4  # outstanding directory scans per worker
+INDEX_BATCH_SIZE = 2000
+PROGRESS_INTERVAL = 1  # in seconds
+
+
 @description("Provides access to the filesystem index")
 class IndexProvider(Provider):
     @generator
@@ -119,8 +129,12 @@ class IndexDatasetIncrementalTask(ProgressTask):
         if not ds:
             raise TaskException(errno.ENOENT, 'Dataset {0} not found'.format(dataset))
 
-        for rec in ds.diff('{0}@org.freenas.indexer:ref'.format(dataset), '{0}@org.freenas.indexer:now'.format(dataset)):
-            collect(self.datastore, rec.path)
+        writer = IndexWriter(self.datastore)
+        try:
+            for rec in ds.diff('{0}@org.freenas.indexer:ref'.format(dataset), '{0}@org.freenas.indexer:now'.format(dataset)):
+                writer.collect(rec.path)
+        finally:
+            writer.close()
 
         self.join_subtasks(self.run_subtask('volume.snapshot.delete', '{0}@org.freenas.indexer:ref'.format(dataset)))
         self.join_subtasks(self.run_subtask('volume.snapshot.update', '{0}@org.freenas.indexer:now'.format(dataset), {
@@ -146,22 +160,25 @@ class IndexDatasetFullTask(ProgressTask):
 
         # Estimate number of files
         statfs = bsd.statfs(mountpoint)
-        total_files = statfs.files - statfs.free_files
+        total_files = max(statfs.files - statfs.free_files, 1)
         done_files = 0
+        last_progress = 0
 
-        for root, dirs, files in os.walk(mountpoint, topdown=True):
-            dirs[:] = [dir for dir in dirs if not os.path.ismount(os.path.join(root, dir))]
+        writer = IndexWriter(self.datastore)
+        try:
+            for path, entries, errors in walk_tree(mountpoint):
+                for p, st in entries:
+                    writer.add(p, st)
 
-            for d in dirs:
-                path = os.path.join(root, d)
-                collect(self.datastore, path)
-                done_files += 1
-                self.set_progress(done_files / total_files * 100, 'Processing directory {0}'.format(path))
+                for p in errors:
+                    writer.remove(p)
 
-            for f in files:
-                path = os.path.join(root, f)
-                collect(self.datastore, path)
-                done_files += 1
+                done_files += len(entries)
+                if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                    last_progress = time.monotonic()
+                    self.set_progress(min(done_files / total_files * 100, 100), 'Processing directory {0}'.format(path))
+        finally:
+            writer.close()
 
         self.join_subtasks(self.run_subtask('volume.snapshot.create', {
             'dataset': dataset,
@@ -170,18 +187,71 @@ class IndexDatasetFullTask(ProgressTask):
         }))
 
 
-def collect(datastore, path):
-    try:
-        st = os.stat(path, follow_symlinks=False)
-    except OSError as err:
-        # Can't access the file - delete index entry
-        datastore.delete('fileindex', path)
-        return
-
-    volume = path.split('/')[2]
-    datastore.upsert('fileindex', path, {
+class IndexWriter(object):
+    """
+    Buffers fileindex changes and writes them in unordered bulk batches.
+    One batch is written in the background while the next one fills up.
+    """
+
+    def __init__(self, datastore, batch_size=INDEX_BATCH_SIZE):
+        self.datastore = datastore
+        self.batch_size = batch_size
+        self.upserts = []
+        self.deletes = []
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def add(self, path, st):
+        self.upserts.append((path, file_record(path, st)))
+        if len(self.upserts) >= self.batch_size:
+            self.flush()
+
+    def remove(self, path):
+        self.deletes.append(path)
+        if len(self.deletes) >= self.batch_size:
+            self.flush()
+
+    def collect(self, path):
+        try:
+            st = os.stat(path, follow_symlinks=False)
+        except OSError:
+            # Can't access the file - delete index entry
+            self.remove(path)
+            return
+
+        self.add(path, st)
+
+    def flush(self):
+        upserts, deletes = self.upserts, self.deletes
+        self.upserts = []
+        self.deletes = []
+        self.wait()
+        self.pending = self.executor.submit(self.write, upserts, deletes)
+
+    def write(self, upserts, deletes):
+        if upserts:
+            self.datastore.upsert_many('fileindex', upserts)
+
+        if deletes:
+            self.datastore.delete_many('fileindex', deletes)
+
+    def wait(self):
+        if self.pending:
+            self.pending.result()
+            self.pending = None
+
+    def close(self):
+        try:
+            self.flush()
+            self.wait()
+        finally:
+            self.executor.shutdown()
+
+
+def file_record(path, st):
+    return {
         'id': path,
-        'volume': volume,
+        'volume': path.split('/')[2],
         'type': get_type(st),
         'atime': datetime.utcfromtimestamp(st.st_atime),
         'mtime': datetime.utcfromtimestamp(st.st_mtime),
@@ -189,7 +259,58 @@ def collect(datastore, path):
         'uid': st.st_uid,
         'gid': st.st_gid,
         'permissions': get_unix_permissions(st.st_mode)
-    })
+    }
+
+
+def scan_directory(path, dev):
+    # Returns stat results of directory entries, subdirectories to descend
+    # into and entries which vanished. Directories on a different device
+    # are mountpoints of other datasets and are skipped.
+    entries = []
+    subdirs = []
+    errors = []
+    try:
+        it = os.scandir(path)
+    except OSError:
+        return entries, subdirs, errors
+
+    with it:
+        for entry in it:
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                errors.append(entry.path)
+                continue
+
+            if stat.S_ISDIR(st.st_mode):
+                if st.st_dev != dev:
+                    continue
+
+                subdirs.append(entry.path)
+
+            entries.append((entry.path, st))
+
+    return entries, subdirs, errors
+
+
+def walk_tree(root, workers=INDEX_WORKERS):
+    # Scans directories on a thread pool, depth first, and yields
+    # (path, entries, errors) for each of them as scans complete
+    dev = os.stat(root).st_dev
+    queue = deque([root])
+    pending = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while queue or pending:
+            while queue and len(pending) < workers * INDEX_QUEUE_DEPTH:
+                path = queue.pop()
+                pending[executor.submit(scan_directory, path, dev)] = path
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                path = pending.pop(f)
+                entries, subdirs, errors = f.result()
+                queue.extend(subdirs)
+                yield path, entries, errors
 
 
 def _init(dispatcher, plugin):
@@ -1055,14 +1055,19 @@ class CalculateReplicationDeltaTask(Task):
         remote_datasets = list(filter(lambda s: '@' not in s['name'], snapshots_list))
         actions = []
 
-        def matches(src, tgt):
-            return src['snapshot_name'] == tgt['snapshot_name'] and src['created_at'] == tgt['created_at']
+        def find_last_common(local, remote):
+            # Returns index of the most recent local snapshot present on the
+            # remote side (same name and creation time), or None
+            remote_keys = {(s['snapshot_name'], s['created_at']) for s in remote}
+            found = None
+            for idx, snap in enumerate(local):
+                if (snap['snapshot_name'], snap['created_at']) not in remote_keys:
+                    continue
+
+                if found is None or snap['created_at'] > local[found]['created_at']:
+                    found = idx
 
-        def match_snapshots(local, remote):
-            for i in local:
-                match = first_or_default(lambda s: matches(i, s), remote)
-                if match:
-                    yield i, match
+            return found
 
         def convert_snapshot(snap):
             return {
@@ -1076,8 +1081,13 @@ class CalculateReplicationDeltaTask(Task):
         def extend_with_snapshot_name(snap):
             snap['snapshot_name'] = snap['name'].split('@')[-1] if '@' in snap['name'] else None
 
+        # Group remote snapshots by dataset once, instead of scanning
+        # the whole list for every local dataset
+        remote_by_dataset = {}
         for i in snapshots_list:
             extend_with_snapshot_name(i)
+            if i['snapshot_name'] is not None:
+                remote_by_dataset.setdefault(i['name'].split('@', 1)[0], []).append(i)
 
         if recursive:
             datasets = self.dispatcher.call_sync(
@@ -1098,30 +1108,19 @@ class CalculateReplicationDeltaTask(Task):
                 key=lambda x: x['txg']
             )
 
-            remote_snapshots = q.query(
-                snapshots_list,
-                ('name', '~', '^{0}@'.format(remotefs))
-            )
-
+            remote_snapshots = remote_by_dataset.get(remotefs, [])
             snapshots = local_snapshots[:]
-            found = None
 
             if remote_snapshots:
                 # Find out the last common snapshot.
-                pairs = list(match_snapshots(local_snapshots, remote_snapshots))
-                if pairs:
-                    pairs.sort(key=lambda p: p[0]['created_at'], reverse=True)
-                    found, _ = first_or_default(None, pairs)
-
+                index = find_last_common(local_snapshots, remote_snapshots)
+                found = local_snapshots[index] if index is not None else None
                 logger.info('found = {0}'.format(found))
 
                 if found:
                     if followdelete:
-                        delete = []
-                        for snap in remote_snapshots:
-                            rsnap = snap['snapshot_name']
-                            if not first_or_default(lambda s: s['snapshot_name'] == rsnap, local_snapshots):
-                                delete.append(rsnap)
+                        local_names = {s['snapshot_name'] for s in local_snapshots}
+                        delete = [s['snapshot_name'] for s in remote_snapshots if s['snapshot_name'] not in local_names]
 
                         if delete:
                             actions.append(ReplicationAction(
@@ -1131,8 +1130,6 @@ class CalculateReplicationDeltaTask(Task):
                                 snapshots=delete
                             ))
 
-                    index = local_snapshots.index(found)
-
                     for idx in range(index + 1, len(local_snapshots)):
                         actions.append(ReplicationAction(
                             ReplicationActionType.SEND_STREAM,
@@ -1350,6 +1347,7 @@ class ReplicateDatasetTask(ProgressTask):
                         FileDescriptor(self.rd_fd),
                         {
                             'client_address': remote,
+                            'streams': self.configstore.get('replication.transport.streams'),
                             'transport_plugins': transport_plugins,
                             'receive_properties': {
                                 'name': action['remotefs'],
@@ -1675,7 +1673,10 @@ def _init(dispatcher, plugin):
         'type': 'object',
         'properties': {
             '%type': {'enum': ['compress-replication-transport-option']},
-            'level': {'$ref': 'compress-plugin-level'}
+            'level': {'$ref': 'compress-plugin-level'},
+            'codec': {'$ref': 'compress-plugin-codec'},
+            'threads': {'type': 'integer', 'minimum': 1},
+            'buffer_size': {'type': 'integer'}
         },
         'additionalProperties': False
     })
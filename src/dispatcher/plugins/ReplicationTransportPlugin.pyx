@@ -31,6 +31,10 @@ import os
 import threading
 import time
 import base64
+import queue
+import struct
+import collections
+import concurrent.futures
 from freenas.dispatcher import AsyncResult
 from freenas.utils import first_or_default
 from freenas.dispatcher.fd import FileDescriptor
@@ -86,6 +90,35 @@ cdef extern from "openssl/err.h" nogil:
     void ERR_print_errors_fp(FILE *fp)
 
 
+#TCP statistics imports
+cdef extern from "sys/socket.h" nogil:
+    ctypedef uint32_t socklen_t
+    int getsockopt(int s, int level, int optname, void *optval, socklen_t *optlen)
+
+
+cdef extern from "netinet/in.h" nogil:
+    enum:
+        IPPROTO_TCP
+
+
+IF UNAME_SYSNAME == 'FreeBSD':
+    cdef extern from "netinet/tcp.h" nogil:
+        enum:
+            TCP_INFO
+
+        struct tcp_info:
+            uint32_t tcpi_rtt
+            uint32_t tcpi_snd_rexmitpack
+ELSE:
+    cdef extern from "netinet/tcp.h" nogil:
+        enum:
+            TCP_INFO
+
+        struct tcp_info:
+            uint32_t tcpi_rtt
+            uint32_t tcpi_total_retrans
+
+
 #Compression imports
 cdef extern from "zlib.h" nogil:
     enum:
@@ -96,6 +129,7 @@ cdef extern from "zlib.h" nogil:
         Z_ERRNO
         Z_DATA_ERROR
         Z_MEM_ERROR
+        Z_BUF_ERROR
 
         Z_NO_COMPRESSION
         Z_BEST_SPEED
@@ -130,12 +164,35 @@ cdef extern from "zlib.h" nogil:
     int inflate(z_stream *strm, int flush)
     int inflateEnd(z_stream *strm)
 
+    unsigned long compressBound(unsigned long sourceLen)
+    int compress2(uint8_t *dest, unsigned long *destLen, const uint8_t *source, unsigned long sourceLen, int level)
+    int uncompress(uint8_t *dest, unsigned long *destLen, const uint8_t *source, unsigned long sourceLen)
+
+
+IF HAVE_LZ4:
+    cdef extern from "lz4.h" nogil:
+        int LZ4_compressBound(int inputSize)
+        int LZ4_compress_default(const char *src, char *dst, int srcSize, int dstCapacity)
+        int LZ4_decompress_safe(const char *src, char *dst, int compressedSize, int dstCapacity)
+
 
 #Globals declaration
 cdef uint32_t encrypt_transfer_magic = 0xbadbeef0
 cdef uint32_t encrypt_rekey_magic = 0xbeefd00d
 cdef uint32_t transport_header_magic = 0xdeadbeef
 
+# Block compression framing: magic, sequence number, codec, raw length, compressed length
+BLOCK_HEADER = struct.Struct('!IIIII')
+BLOCK_MAGIC = 0xb10cc0de
+BLOCK_DEFAULT_SIZE = 1024 * 1024
+BLOCK_CODEC_NONE = 0
+BLOCK_CODEC_ZLIB = 1
+BLOCK_CODEC_LZ4 = 2
+
+# Multi-stream transport framing: magic, sequence number, payload length
+STRIPE_HEADER = struct.Struct('!III')
+STRIPE_MAGIC = 0x5721be00
+
 
 logger = logging.getLogger('ReplicationTransportPlugin')
 
@@ -196,6 +253,423 @@ cdef uint32_t write_fd(int fd, void *buf, uint32_t nbytes) nogil:
             return done
 
 
+def block_codecs():
+    IF HAVE_LZ4:
+        return {'zlib': BLOCK_CODEC_ZLIB, 'lz4': BLOCK_CODEC_LZ4}
+    ELSE:
+        return {'zlib': BLOCK_CODEC_ZLIB}
+
+
+def block_compress(bytes data, int codec, int level):
+    # Compresses a single block with the GIL released, so it can run on
+    # several threads at once. Blocks which don't shrink are sent as-is.
+    cdef const uint8_t *src = data
+    cdef unsigned long src_len = len(data)
+    cdef unsigned long dst_len
+    cdef uint8_t *dst = NULL
+    cdef int ret = Z_OK
+    cdef bint use_zlib = codec == BLOCK_CODEC_ZLIB
+
+    if codec not in block_codecs().values():
+        raise ValueError('Unsupported codec {0}'.format(codec))
+
+    if use_zlib:
+        dst_len = compressBound(src_len)
+    else:
+        IF HAVE_LZ4:
+            dst_len = LZ4_compressBound(src_len)
+
+    dst = <uint8_t *>malloc(dst_len)
+    if dst == NULL:
+        raise MemoryError()
+
+    try:
+        with nogil:
+            if use_zlib:
+                ret = compress2(dst, &dst_len, src, src_len, level)
+            else:
+                IF HAVE_LZ4:
+                    dst_len = LZ4_compress_default(<const char *>src, <char *>dst, src_len, dst_len)
+                    if dst_len == 0:
+                        ret = Z_BUF_ERROR
+
+        if ret != Z_OK:
+            raise ValueError('Block compression failed with error {0}'.format(ret))
+
+        if dst_len >= src_len:
+            return BLOCK_CODEC_NONE, data
+
+        return codec, <bytes>dst[:dst_len]
+    finally:
+        free(dst)
+
+
+def block_decompress(bytes data, int codec, unsigned long raw_len):
+    cdef const uint8_t *src = data
+    cdef unsigned long src_len = len(data)
+    cdef unsigned long dst_len = raw_len
+    cdef uint8_t *dst = NULL
+    cdef int ret = Z_OK
+    cdef bint use_zlib = codec == BLOCK_CODEC_ZLIB
+
+    if codec == BLOCK_CODEC_NONE:
+        return data
+
+    if codec not in block_codecs().values():
+        raise ValueError('Unsupported codec {0}'.format(codec))
+
+    dst = <uint8_t *>malloc(raw_len)
+    if dst == NULL:
+        raise MemoryError()
+
+    try:
+        with nogil:
+            if use_zlib:
+                ret = uncompress(dst, &dst_len, src, src_len)
+            else:
+                IF HAVE_LZ4:
+                    ret = LZ4_decompress_safe(<const char *>src, <char *>dst, src_len, raw_len)
+                    if ret >= 0:
+                        dst_len = ret
+                        ret = Z_OK
+
+        if ret != Z_OK or dst_len != raw_len:
+            raise ValueError('Block decompression failed with error {0}'.format(ret))
+
+        return <bytes>dst[:dst_len]
+    finally:
+        free(dst)
+
+
+def read_block(fd, size):
+    # Reads up to size bytes, short only at the end of the stream
+    chunks = []
+    done = 0
+    while done < size:
+        chunk = os.read(fd, size - done)
+        if not chunk:
+            break
+
+        chunks.append(chunk)
+        done += len(chunk)
+
+    return b''.join(chunks)
+
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def compress_blocks(rd_fd, wr_fd, codec='zlib', level='DEFAULT', threads=1, block_size=BLOCK_DEFAULT_SIZE):
+    """
+    Cuts the input stream into blocks, compresses them independently on
+    a pool of worker threads and writes them out in order, framed with
+    their sequence numbers. Returns number of blocks written.
+    """
+    codec_id = block_codecs()[codec]
+    zlevel = {'FAST': Z_BEST_SPEED, 'BEST': Z_BEST_COMPRESSION}.get(level, Z_DEFAULT_COMPRESSION)
+    pending = collections.deque()
+    seq = 0
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        while True:
+            data = read_block(rd_fd, block_size)
+            if data:
+                pending.append((seq, len(data), executor.submit(block_compress, data, codec_id, zlevel)))
+                seq += 1
+
+            # Keep a couple of blocks in flight per worker
+            while pending and (not data or len(pending) >= threads * 2):
+                num, raw_len, future = pending.popleft()
+                used, payload = future.result()
+                write_all(wr_fd, BLOCK_HEADER.pack(BLOCK_MAGIC, num, used, raw_len, len(payload)))
+                write_all(wr_fd, payload)
+
+            if not data:
+                break
+
+    write_all(wr_fd, BLOCK_HEADER.pack(BLOCK_MAGIC, seq, BLOCK_CODEC_NONE, 0, 0))
+    return seq
+
+
+def decompress_blocks(rd_fd, wr_fd, threads=1):
+    """
+    Reverse of compress_blocks(). Blocks are decompressed in parallel and
+    reassembled in sequence order. Returns number of blocks read.
+    """
+    pending = collections.deque()
+    seq = 0
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        while True:
+            header = read_block(rd_fd, BLOCK_HEADER.size)
+            if len(header) != BLOCK_HEADER.size:
+                raise ValueError('Compressed stream ended unexpectedly')
+
+            magic, num, codec, raw_len, comp_len = BLOCK_HEADER.unpack(header)
+            if magic != BLOCK_MAGIC:
+                raise ValueError('Bad block magic {0:#x}'.format(magic))
+
+            if num != seq:
+                raise ValueError('Block {0} received out of sequence, expected {1}'.format(num, seq))
+
+            end = raw_len == 0 and comp_len == 0
+            if not end:
+                payload = read_block(rd_fd, comp_len)
+                if len(payload) != comp_len:
+                    raise ValueError('Compressed stream ended unexpectedly')
+
+                pending.append(executor.submit(block_decompress, payload, codec, raw_len))
+                seq += 1
+
+            while pending and (end or len(pending) >= threads * 2):
+                write_all(wr_fd, pending.popleft().result())
+
+            if end:
+                return seq
+
+
+def is_block_compression(plugin):
+    return 'codec' in plugin or 'threads' in plugin
+
+
+def tcp_stats(sock):
+    cdef tcp_info info
+    cdef socklen_t size = sizeof(info)
+
+    if getsockopt(sock.fileno(), IPPROTO_TCP, TCP_INFO, &info, &size) != 0:
+        return {}
+
+    IF UNAME_SYSNAME == 'FreeBSD':
+        retransmits = info.tcpi_snd_rexmitpack
+    ELSE:
+        retransmits = info.tcpi_total_retrans
+
+    return {'rtt': info.tcpi_rtt, 'retransmits': retransmits}
+
+
+def recv_exact(sock, size):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    while view:
+        ret = sock.recv_into(view)
+        if ret == 0:
+            raise ValueError('Connection closed unexpectedly')
+
+        view = view[ret:]
+
+    return bytes(buf)
+
+
+class StreamStats(object):
+    def __init__(self, index, sock):
+        self.index = index
+        self.sock = sock
+        self.bytes = 0
+        self.chunks = 0
+        self.started = time.time()
+        self.tcp = {}
+
+    def update(self, nbytes):
+        self.bytes += nbytes
+        self.chunks += 1
+
+    def get_status(self):
+        try:
+            self.tcp = tcp_stats(self.sock)
+        except OSError:
+            # Socket already closed, keep the last known values
+            pass
+
+        elapsed = max(time.time() - self.started, 1)
+        return {
+            'stream': self.index,
+            'bytes': self.bytes,
+            'chunks': self.chunks,
+            'throughput': int(self.bytes / elapsed),
+            'rtt': self.tcp.get('rtt'),
+            'retransmits': self.tcp.get('retransmits')
+        }
+
+
+class StripeSender(object):
+    """
+    Reads the outgoing stream from a pipe in chunks and spreads them over
+    several connections. Every connection is served by its own thread
+    pulling from a shared queue, so faster streams carry more chunks.
+    Owns rd_fd.
+    """
+    def __init__(self, rd_fd, conns, chunk_size):
+        self.rd_fd = rd_fd
+        self.conns = conns
+        self.chunk_size = chunk_size
+        self.queue = queue.Queue(len(conns) * 2)
+        self.stats = [StreamStats(i, c) for i, c in enumerate(conns)]
+        self.threads = []
+        self.error = None
+
+    def start(self):
+        self.threads.append(threading.Thread(target=self.read_loop, daemon=True))
+        for i in range(len(self.conns)):
+            self.threads.append(threading.Thread(target=self.send_loop, args=(i,), daemon=True))
+
+        for t in self.threads:
+            t.start()
+
+    def join(self):
+        for t in self.threads:
+            t.join()
+
+        return self.error
+
+    def get_status(self):
+        return [s.get_status() for s in self.stats]
+
+    def put(self, item):
+        while not self.error:
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def fail(self, err):
+        if not self.error:
+            self.error = err
+
+        for conn in self.conns:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def read_loop(self):
+        seq = 0
+        try:
+            while not self.error:
+                data = read_block(self.rd_fd, self.chunk_size)
+                if not data:
+                    break
+
+                self.put((seq, data))
+                seq += 1
+        except OSError as err:
+            self.fail(err)
+        finally:
+            # Closing the pipe early unblocks the writer side on failure
+            close_fds(self.rd_fd)
+            for i in self.conns:
+                self.put((seq, None))
+
+    def send_loop(self, index):
+        conn = self.conns[index]
+        stats = self.stats[index]
+        try:
+            while True:
+                seq, data = self.queue.get()
+                if data is None:
+                    conn.sendall(STRIPE_HEADER.pack(STRIPE_MAGIC, seq, 0))
+                    return
+
+                conn.sendall(STRIPE_HEADER.pack(STRIPE_MAGIC, seq, len(data)))
+                conn.sendall(data)
+                stats.update(len(data))
+        except OSError as err:
+            self.fail(err)
+
+
+class StripeReceiver(object):
+    """
+    Reads chunks sent by StripeSender from all connections and writes them
+    to a pipe in sequence order. At most window chunks are kept waiting for
+    reordering. Owns wr_fd.
+    """
+    def __init__(self, conns, wr_fd, window):
+        self.conns = conns
+        self.wr_fd = wr_fd
+        self.window = window
+        self.cv = threading.Condition()
+        self.pending = {}
+        self.next_seq = 0
+        self.end = None
+        self.stats = [StreamStats(i, c) for i, c in enumerate(conns)]
+        self.threads = []
+        self.error = None
+
+    def start(self):
+        self.threads.append(threading.Thread(target=self.write_loop, daemon=True))
+        for i in range(len(self.conns)):
+            self.threads.append(threading.Thread(target=self.recv_loop, args=(i,), daemon=True))
+
+        for t in self.threads:
+            t.start()
+
+    def join(self):
+        for t in self.threads:
+            t.join()
+
+        return self.error
+
+    def get_status(self):
+        return [s.get_status() for s in self.stats]
+
+    def fail(self, err):
+        with self.cv:
+            if not self.error:
+                self.error = err
+
+            self.cv.notify_all()
+
+    def recv_loop(self, index):
+        conn = self.conns[index]
+        stats = self.stats[index]
+        try:
+            while True:
+                magic, seq, length = STRIPE_HEADER.unpack(recv_exact(conn, STRIPE_HEADER.size))
+                if magic != STRIPE_MAGIC:
+                    raise ValueError('Bad magic {0:#x} received on stream {1}'.format(magic, index))
+
+                if length == 0:
+                    with self.cv:
+                        self.end = seq
+                        self.cv.notify_all()
+                    return
+
+                data = recv_exact(conn, length)
+                stats.update(length)
+                with self.cv:
+                    self.cv.wait_for(lambda: seq < self.next_seq + self.window or self.error)
+                    if self.error:
+                        return
+
+                    self.pending[seq] = data
+                    self.cv.notify_all()
+        except (OSError, ValueError) as err:
+            self.fail(err)
+
+    def write_loop(self):
+        try:
+            while True:
+                with self.cv:
+                    self.cv.wait_for(
+                        lambda: self.next_seq in self.pending or self.next_seq == self.end or self.error
+                    )
+                    if self.error or self.next_seq not in self.pending:
+                        return
+
+                    data = self.pending.pop(self.next_seq)
+                    self.next_seq += 1
+                    self.cv.notify_all()
+
+                write_all(self.wr_fd, data)
+        except OSError as err:
+            self.fail(err)
+        finally:
+            close_fds(self.wr_fd)
+
+
 @description('Provides information about replication transport layer')
 class TransportProvider(Provider):
     def __init__(self):
@@ -237,6 +711,10 @@ class TransportSendTask(Task):
         self.fds = []
         self.sock = None
         self.conn = None
+        self.conns = []
+        self.striper = None
+        self.send_stats = None
+        self.recv_stats = None
 
     @classmethod
     def early_describe(cls):
@@ -255,9 +733,60 @@ class TransportSendTask(Task):
 
         return []
 
-    def run(self, fd, transport):
+    def accept_connection(self, client_address, token, uint32_t token_size, uint32_t buffer_size):
         cdef uint8_t *token_buffer = NULL
         cdef int ret
+
+        conn, addr = self.sock.accept()
+        try:
+            for addr_info in socket.getaddrinfo(client_address, addr[1], socket.AF_UNSPEC, socket.SOCK_STREAM):
+                _, _, _, _, desired_address = addr_info
+
+                if addr[0] == desired_address[0]:
+                    break
+
+            else:
+                raise TaskException(
+                    EINVAL,
+                    'Connection from an unexpected address {0} - desired {1}'.format(
+                        addr[0],
+                        client_address
+                    )
+                )
+
+            logger.debug('New connection from {0}:{1} to {2}:{3}'.format(*(addr + self.sock.getsockname()[:2])))
+
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
+            conn.settimeout(self.configstore.get('replication.connection.timeout'))
+
+            token_buffer = <uint8_t *>malloc(token_size * sizeof(uint8_t))
+            ret = read_fd(conn.fileno(), token_buffer, token_size, 0)
+            if ret != token_size:
+                raise TaskException(
+                    ECONNABORTED,
+                    'Connection with {0} aborted before authentication'.format(client_address)
+                )
+            recvd_token = <bytes> token_buffer[:token_size]
+
+            if base64.b64decode(token.encode('utf-8')) != recvd_token:
+                raise TaskException(
+                    ECONNABORTED,
+                    'Transport layer authentication failed. Expected token {0}, was {1}'.format(
+                        token,
+                        recvd_token.decode('utf-8')
+                    )
+                )
+            logger.debug('{0}:{1} connection authentication finished successfully'.format(*addr))
+        except:
+            conn.close()
+            raise
+        finally:
+            free(token_buffer)
+
+        return conn, addr
+
+    def run(self, fd, transport):
+        cdef int ret
         cdef uint32_t token_size
         cdef uint32_t *buffer = NULL
         cdef int ret_wr
@@ -268,8 +797,10 @@ class TransportSendTask(Task):
         cdef int header_wr = -1
 
         conn_fd = None
+        out_fd = None
         try:
             buffer_size = transport.get('buffer_size', 1024*1024)
+            streams = transport.get('streams', 1)
             client_address = transport.get('client_address')
             remote_client = get_freenas_peer_client(self, client_address)
             server_address = remote_client.local_address[0]
@@ -285,7 +816,7 @@ class TransportSendTask(Task):
                 try:
                     self.sock.bind(addr)
                     self.sock.settimeout(30)
-                    self.sock.listen(1)
+                    self.sock.listen(streams)
                 except socket.timeout:
                     raise TaskException(
                         ETIMEDOUT,
@@ -323,6 +854,7 @@ class TransportSendTask(Task):
             transport['server_port'] = sock_addr[1]
             transport['buffer_size'] = buffer_size
             transport['auth_token_size'] = token_size
+            transport['streams'] = streams
 
             recv_task_id = remote_client.call_task_async(
                 'replication.transport.receive',
@@ -331,49 +863,22 @@ class TransportSendTask(Task):
                 timeout=604800
             )
 
-            self.conn, addr = self.sock.accept()
-
-            for addr_info in socket.getaddrinfo(client_address, addr[1], socket.AF_UNSPEC, socket.SOCK_STREAM):
-                _, _, _, _, desired_address = addr_info
-
-                if addr[0] == desired_address[0]:
-                    break
-
-            else:
-                raise TaskException(
-                    EINVAL,
-                    'Connection from an unexpected address {0} - desired {1}'.format(
-                        addr[0],
-                        client_address
-                    )
-                )
-
-            logger.debug('New connection from {0}:{1} to {2}:{3}'.format(*(addr + sock_addr)))
-
-            self.conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
-            self.conn.settimeout(self.configstore.get('replication.connection.timeout'))
-
+            self.conn, addr = self.accept_connection(client_address, token, token_size, buffer_size)
             conn_fd = os.dup(self.conn.fileno())
             self.fds.append(conn_fd)
+            out_fd = conn_fd
 
-            token_buffer = <uint8_t *>malloc(token_size * sizeof(uint8_t))
-            ret = read_fd(conn_fd, token_buffer, token_size, 0)
-            if ret != token_size:
-                raise TaskException(
-                    ECONNABORTED,
-                    'Connection with {0} aborted before authentication'.format(client_address)
-                )
-            recvd_token = <bytes> token_buffer[:token_size]
+            if streams > 1:
+                # Stripe the outgoing stream over additional connections
+                self.conns.append(self.conn)
+                for i in range(1, streams):
+                    self.conns.append(self.accept_connection(client_address, token, token_size, buffer_size)[0])
 
-            if base64.b64decode(token.encode('utf-8')) != recvd_token:
-                raise TaskException(
-                    ECONNABORTED,
-                    'Transport layer authentication failed. Expected token {0}, was {1}'.format(
-                        token,
-                        recvd_token.decode('utf-8')
-                    )
-                )
-            logger.debug('{0}:{1} connection authentication finished successfully'.format(*addr))
+                stripe_rd, out_fd = os.pipe()
+                self.fds.append(out_fd)
+                self.striper = StripeSender(stripe_rd, self.conns, buffer_size)
+                self.striper.start()
+                logger.debug('Striping transfer to {0}:{1} over {2} connections'.format(addr[0], addr[1], streams))
 
             plugins = transport.get('transport_plugins', [])
             header_rd, header_wr = os.pipe()
@@ -401,11 +906,11 @@ class TransportSendTask(Task):
 
             if len(raw_subtasks):
                 logger.debug('Starting plugins for {0}:{1} connection'.format(*addr))
-                raw_subtasks[-1][-1]['write_fd'] = FileDescriptor(conn_fd)
+                raw_subtasks[-1][-1]['write_fd'] = FileDescriptor(out_fd)
                 for subtask in raw_subtasks:
                     subtasks.append(self.run_subtask(*subtask))
             else:
-                header_wr = conn_fd
+                header_wr = out_fd
 
             logger.debug(
                 'Transport layer plugins registration finished for {0}:{1} connection. Starting transfer.'.format(*addr)
@@ -442,10 +947,15 @@ class TransportSendTask(Task):
                     logger.debug('Written {0} bytes -> TCP socket ({1}:{2})'.format(ret, *self.addr))
 
         finally:
-            if conn_fd and header_wr != conn_fd:
+            if out_fd and header_wr != out_fd:
                 close_fds(header_wr)
 
             if not self.aborted and self.conn and addr:
+                if self.striper and self.striper.error:
+                    raise TaskException(
+                        EIO,
+                        'Striped transmission to {0}:{1} failed: {2}'.format(addr[0], addr[1], str(self.striper.error))
+                    )
                 if ret_wr == -1:
                     raise TaskException(
                         errno,
@@ -458,6 +968,19 @@ class TransportSendTask(Task):
                     )
                 logger.debug('All data fetched for transfer to {0}:{1}. Waiting for plugins to close.'.format(*addr))
                 self.join_subtasks(*subtasks)
+                if self.striper:
+                    # Let the striper drain the pipe and send end markers
+                    self.fds.remove(out_fd)
+                    close_fds(out_fd)
+                    error = self.striper.join()
+                    self.send_stats = self.striper.get_status()
+                    if error:
+                        raise TaskException(
+                            EIO,
+                            'Striped transmission to {0}:{1} failed: {2}'.format(addr[0], addr[1], str(error))
+                        )
+
+                self.close_streams()
                 if self.conn:
                     self.conn.shutdown(socket.SHUT_RDWR)
                     self.conn.close()
@@ -469,17 +992,38 @@ class TransportSendTask(Task):
                 remote_client.disconnect()
 
             free(buffer)
-            free(token_buffer)
+            self.close_streams()
             if self.sock:
                 self.sock.shutdown(socket.SHUT_RDWR)
                 self.sock.close()
                 self.sock = None
             close_fds(self.fds)
 
+        if self.striper:
+            return {'streams': self.send_stats, 'remote_streams': self.recv_stats}
+
+    def close_streams(self):
+        # Additional connections of a striped transfer, first one is self.conn
+        for conn in self.conns[1:]:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            conn.close()
+
+        self.conns = self.conns[:1]
+
     def get_recv_status(self, status):
+        result = status.get('result')
+        if isinstance(result, dict) and result.get('streams'):
+            self.recv_stats = result['streams']
+            for i in self.recv_stats:
+                logger.debug('Stream {0} received {1} bytes at {2} B/s'.format(i['stream'], i['bytes'], i['throughput']))
+
         if status.get('state') != 'FINISHED':
             error = status.get('error')
             close_fds(self.fds)
+            self.close_streams()
             if self.conn:
                 self.conn.shutdown(socket.SHUT_RDWR)
                 self.conn.close()
@@ -505,6 +1049,7 @@ class TransportSendTask(Task):
         self.aborted = True
         self.finished.set(True)
         close_fds(self.fds)
+        self.close_streams()
         if self.conn:
             self.conn.shutdown(socket.SHUT_RDWR)
             self.conn.close()
@@ -528,6 +1073,8 @@ class TransportReceiveTask(ProgressTask):
         self.aborted = False
         self.fds = []
         self.sock = None
+        self.socks = []
+        self.receiver = None
 
     @classmethod
     def early_describe(cls):
@@ -548,6 +1095,32 @@ class TransportReceiveTask(ProgressTask):
 
         return []
 
+    def connect(self, server_address, server_port, buffer_size):
+        sock = None
+        for conn_option in socket.getaddrinfo(server_address, server_port, socket.AF_UNSPEC, socket.SOCK_STREAM):
+            af, sock_type, proto, canonname, addr = conn_option
+            try:
+                sock = socket.socket(af, sock_type, proto)
+            except OSError:
+                sock = None
+                continue
+            try:
+                sock.connect(addr)
+            except OSError:
+                sock.close()
+                sock = None
+                continue
+            break
+
+        if sock is None:
+            raise TaskException(EACCES, 'Could not connect to a socket at address {0}'.format(server_address))
+
+        logger.debug('Connected to a TCP socket at {0}:{1}'.format(*addr))
+
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+        sock.settimeout(self.configstore.get('replication.connection.timeout'))
+        return sock, addr
+
     def run(self, transport):
         cdef uint8_t *token_buf
         cdef int ret
@@ -562,11 +1135,13 @@ class TransportReceiveTask(ProgressTask):
 
         progress_t = None
         addr = None
+        stats = None
 
         server_address = self.environment['SENDER_ADDRESS'].split(',')[0]
         logger.debug('Receive from {0} has started'.format(server_address))
         try:
             buffer_size = transport.get('buffer_size', 1024*1024)
+            streams = transport.get('streams', 1)
 
             self.estimated_size = transport.get('estimated_size', 0)
             server_port = transport.get('server_port')
@@ -580,34 +1155,25 @@ class TransportReceiveTask(ProgressTask):
                     'Token size {0} does not match token size field {1}'.format(len(token), token_size)
                 )
 
-            for conn_option in socket.getaddrinfo(server_address, server_port, socket.AF_UNSPEC, socket.SOCK_STREAM):
-                af, sock_type, proto, canonname, addr = conn_option
-                try:
-                    self.sock = socket.socket(af, sock_type, proto)
-                except OSError:
-                    self.sock = None
-                    continue
-                try:
-                    self.sock.connect(addr)
-                except OSError:
-                    self.sock.close()
-                    self.sock = None
-                    continue
-                break
-
-            if self.sock is None:
-                raise TaskException(EACCES, 'Could not connect to a socket at address {0}'.format(server_address))
+            self.sock, addr = self.connect(server_address, server_port, buffer_size)
             self.addr = addr
-            logger.debug('Connected to a TCP socket at {0}:{1}'.format(*addr))
-
-            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
-            self.sock.settimeout(self.configstore.get('replication.connection.timeout'))
 
             conn_fd = os.dup(self.sock.fileno())
             self.fds.append(conn_fd)
+            in_fd = conn_fd
+
+            if streams > 1:
+                # Reassemble the stream striped over additional connections
+                self.socks.append(self.sock)
+                for i in range(1, streams):
+                    self.socks.append(self.connect(server_address, server_port, buffer_size)[0])
+
+                in_fd, stripe_wr = os.pipe()
+                self.fds.append(in_fd)
+                self.receiver = StripeReceiver(self.socks, stripe_wr, streams * 4)
 
             plugins = transport.get('transport_plugins', [])
-            last_rd_fd = conn_fd
+            last_rd_fd = in_fd
             subtasks = []
 
             for type in ['encrypt', 'compress']:
@@ -635,13 +1201,17 @@ class TransportReceiveTask(ProgressTask):
                         )
                     )
 
-            ret = write_fd(self.sock.fileno(), token_buf, token_size)
-            if ret == -1:
-                raise TaskException(ECONNABORTED, 'Transport connection closed unexpectedly')
-            elif ret != token_size:
-                raise TaskException(EINVAL, 'Transport failed to write token to socket')
+            for sock in self.socks or [self.sock]:
+                ret = write_fd(sock.fileno(), token_buf, token_size)
+                if ret == -1:
+                    raise TaskException(ECONNABORTED, 'Transport connection closed unexpectedly')
+                elif ret != token_size:
+                    raise TaskException(EINVAL, 'Transport failed to write token to socket')
             logger.debug('Authentication token sent to {0}:{1}'.format(*addr))
 
+            if self.receiver:
+                self.receiver.start()
+
             zfs_rd, zfs_wr = os.pipe()
             self.fds.append(zfs_wr)
             self.fds.append(zfs_rd)
@@ -702,6 +1272,15 @@ class TransportReceiveTask(ProgressTask):
         finally:
             try:
                 if not self.aborted:
+                    if self.receiver and self.receiver.error:
+                        raise TaskException(
+                            EIO,
+                            'Striped transmission from {0}:{1} failed: {2}'.format(
+                                self.addr[0],
+                                self.addr[1],
+                                str(self.receiver.error)
+                            )
+                        )
                     if header_buffer:
                         if header_buffer[0] != transport_header_magic:
                             raise TaskException(
@@ -724,10 +1303,16 @@ class TransportReceiveTask(ProgressTask):
                             'All data fetched for transfer from {0}:{1}. Waiting for plugins to close.'.format(*addr)
                         )
                     self.join_subtasks(*subtasks)
+                    if self.receiver:
+                        self.receiver.join()
+                        stats = self.receiver.get_status()
             finally:
                 self.running = False
                 if progress_t:
                     progress_t.join()
+                if self.receiver and not self.receiver.threads:
+                    close_fds(self.receiver.wr_fd)
+                self.close_streams()
                 if addr:
                     logger.debug('Receive from {0}:{1} finished. Closing connection'.format(*addr))
                     if self.sock:
@@ -740,6 +1325,20 @@ class TransportReceiveTask(ProgressTask):
                 free(header_buffer)
                 close_fds(self.fds)
 
+        if self.receiver:
+            return {'streams': stats}
+
+    def close_streams(self):
+        # Additional connections of a striped transfer, first one is self.sock
+        for sock in self.socks[1:]:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+        self.socks = self.socks[:1]
+
     def count_progress(self):
         last_done = 0
         progress = 0
@@ -749,7 +1348,11 @@ class TransportReceiveTask(ProgressTask):
                 progress = int((float(self.done) / float(self.estimated_size)) * 100)
                 if progress > 100:
                     progress = 100
-            self.set_progress(progress, 'Transfer speed {0} B/s'.format(self.done - last_done))
+            self.set_progress(
+                progress,
+                'Transfer speed {0} B/s'.format(self.done - last_done),
+                {'streams': self.receiver.get_status()} if self.receiver else None
+            )
             last_done = self.done
             time.sleep(1)
             total_time += 1
@@ -763,6 +1366,7 @@ class TransportReceiveTask(ProgressTask):
     def abort(self):
         self.aborted = True
         close_fds(self.fds)
+        self.close_streams()
         if self.sock:
             self.sock.shutdown(socket.SHUT_RDWR)
             self.sock.close()
@@ -795,9 +1399,40 @@ class TransportCompressTask(Task):
         if 'write_fd' not in plugin:
             raise VerifyException(ENOENT, 'Write file descriptor is not specified')
 
+        if plugin.get('codec', 'zlib') not in block_codecs():
+            raise VerifyException(EINVAL, 'Compression codec {0} is not supported'.format(plugin['codec']))
+
         return []
 
     def run(self, plugin):
+        if is_block_compression(plugin):
+            return self.run_blocks(plugin)
+
+        return self.run_stream(plugin)
+
+    def run_blocks(self, plugin):
+        rd_fd = plugin['read_fd'].fd
+        wr_fd = plugin['write_fd'].fd
+        self.fds.append(rd_fd)
+        self.fds.append(wr_fd)
+
+        try:
+            count = compress_blocks(
+                rd_fd,
+                wr_fd,
+                plugin.get('codec', 'zlib'),
+                plugin.get('level', 'DEFAULT'),
+                plugin.get('threads', 1),
+                plugin.get('buffer_size', BLOCK_DEFAULT_SIZE)
+            )
+            logger.debug('Block compression task finished, {0} blocks sent'.format(count))
+        except (OSError, ValueError) as err:
+            if not self.aborted:
+                raise TaskException(EIO, 'Block compression failed: {0}'.format(str(err)))
+        finally:
+            close_fds(self.fds)
+
+    def run_stream(self, plugin):
         cdef int ret
         cdef int ret_rd = 0
         cdef int ret_wr = 0
@@ -918,6 +1553,27 @@ class TransportDecompressTask(Task):
         return []
 
     def run(self, plugin):
+        if is_block_compression(plugin):
+            return self.run_blocks(plugin)
+
+        return self.run_stream(plugin)
+
+    def run_blocks(self, plugin):
+        rd_fd = plugin['read_fd'].fd
+        wr_fd = plugin['write_fd'].fd
+        self.fds.append(rd_fd)
+        self.fds.append(wr_fd)
+
+        try:
+            count = decompress_blocks(rd_fd, wr_fd, plugin.get('threads', 1))
+            logger.debug('Block decompression task finished, {0} blocks received'.format(count))
+        except (OSError, ValueError) as err:
+            if not self.aborted:
+                raise TaskException(EIO, 'Block decompression failed: {0}'.format(str(err)))
+        finally:
+            close_fds(self.fds)
+
+    def run_stream(self, plugin):
         cdef int ret
         cdef int ret_rd = 0
         cdef int ret_wr = 0
@@ -1643,6 +2299,7 @@ def _init(dispatcher, plugin):
             'client_address': {'type': 'string'},
             'server_port': {'type': 'integer'},
             'buffer_size': {'type': 'integer'},
+            'streams': {'type': 'integer', 'minimum': 1},
             'auth_token': {'type': 'string'},
             'auth_token_size': {'type': 'integer'},
             'estimated_size': {'type': 'integer'},
@@ -1668,6 +2325,8 @@ def _init(dispatcher, plugin):
             'read_fd': {'type': 'fd'},
             'write_fd': {'type': 'fd'},
             'level': {'$ref': 'compress-plugin-level'},
+            'codec': {'$ref': 'compress-plugin-codec'},
+            'threads': {'type': 'integer', 'minimum': 1},
             'buffer_size': {'type': 'integer'}
         },
         'additionalProperties': False
@@ -1678,6 +2337,11 @@ def _init(dispatcher, plugin):
         'enum': ['FAST', 'DEFAULT', 'BEST']
     })
 
+    plugin.register_schema_definition('compress-plugin-codec', {
+        'type': 'string',
+        'enum': sorted(block_codecs().keys())
+    })
+
     plugin.register_schema_definition('encrypt-replication-transport-plugin', {
         'type': 'object',
         'properties': {
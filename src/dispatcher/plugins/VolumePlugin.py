@@ -3464,7 +3464,11 @@ def _init(dispatcher, plugin):
         })
 
     global snapshots
-    snapshots = EventCacheStore(dispatcher, 'volume.snapshot')
+    snapshots = EventCacheStore(
+        dispatcher, 'volume.snapshot',
+        hash_indexes=['id', 'volume', 'dataset'],
+        sorted_indexes=['properties.creation.parsed']
+    )
     snapshots.populate(dispatcher.call_sync('zfs.snapshot.query'), callback=convert_snapshot)
     snapshots.ready = True
     plugin.register_event_handler(
@@ -3473,7 +3477,7 @@ def _init(dispatcher, plugin):
     )
 
     global datasets
-    datasets = EventCacheStore(dispatcher, 'volume.dataset')
+    datasets = EventCacheStore(dispatcher, 'volume.dataset', hash_indexes=['id', 'name', 'volume'])
     datasets.populate(dispatcher.call_sync('zfs.dataset.query'), callback=convert_dataset)
     datasets.ready = True
     plugin.register_event_handler(
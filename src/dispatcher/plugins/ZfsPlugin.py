@@ -60,6 +60,7 @@ logger = logging.getLogger('ZfsPlugin')
 pools = None
 datasets = None
 snapshots = None
+refresher = None
 zfs = None
 
 
@@ -256,6 +257,10 @@ class ZfsDatasetProvider(Provider):
         except libzfs.ZFSException as err:
             raise RpcException(zfs_error_to_errno(err.code), str(err))
 
+    @private
+    def get_refresh_stats(self):
+        return refresher.get_stats() if refresher else None
+
 
 @description('Provides information about ZFS snapshots')
 class ZfsSnapshotProvider(Provider):
@@ -1438,6 +1443,111 @@ def zfs_error_to_errno(code):
     return mapping.get(code, errno.EFAULT)
 
 
+class VolatileRefresher(object):
+    """
+    Periodically refreshes volatile properties (space usage and such) of
+    cached pools and datasets. Every pool is walked in a single worker
+    call, pools are fetched in parallel, and the zfs-cache lock is held
+    only while the results are merged into the caches.
+
+    libzfs handles aren't thread safe, so every worker call opens its own
+    handle through open_zfs.
+    """
+    def __init__(self, dispatcher, open_zfs, pools, datasets):
+        self.dispatcher = dispatcher
+        self.open_zfs = open_zfs
+        self.pools = pools
+        self.datasets = datasets
+        self.stats = {
+            'passes': 0,
+            'last_duration': None,
+            'last_fetch_duration': None,
+            'last_datasets': 0,
+            'last_changed_pools': 0,
+            'last_changed_datasets': 0
+        }
+
+    def fetch(self, pool_name):
+        # Runs in a worker thread
+        zfs = self.open_zfs()
+        pool = zfs.get(pool_name).__getstate__(False)
+        result = {}
+        stack = [zfs.get_dataset(pool_name)]
+        while stack:
+            ds = stack.pop()
+            props = ds.properties
+            result[ds.name] = {p: props[p].__getstate__() for p in VOLATILE_ZFS_PROPERTIES}
+            stack.extend(ds.children)
+
+        return pool, result
+
+    def refresh(self):
+        start = time.time()
+        names = [k for k, _ in self.pools.itervalid()]
+        jobs = [gevent.spawn(self.dispatcher.threaded, self.fetch, n) for n in names]
+        gevent.joinall(jobs)
+        fetched = time.time()
+
+        changed_pools = {}
+        changed_datasets = {}
+        count = 0
+
+        with self.dispatcher.get_lock('zfs-cache'):
+            for name, job in zip(names, jobs):
+                if not job.successful():
+                    if not isinstance(job.exception, libzfs.ZFSException):
+                        logger.warning('Cannot refresh pool {0}: {1}'.format(name, str(job.exception)))
+                    continue
+
+                zfspool, volatile = job.value
+                cached = self.pools.get(name, timeout=0)
+                if cached is not None and zfspool != cached:
+                    changed_pools[name] = zfspool
+
+                count += len(volatile)
+                for ds_name, props in volatile.items():
+                    ds = self.datasets.get(ds_name, timeout=0)
+                    if not ds:
+                        continue
+
+                    current = ds['properties']
+                    changed = False
+                    for prop, value in props.items():
+                        if current[prop]['rawvalue'] != value['rawvalue']:
+                            current[prop] = value
+                            changed = True
+
+                    if changed:
+                        changed_datasets[ds_name] = ds
+
+            if changed_pools:
+                self.pools.update(**changed_pools)
+
+            if changed_datasets:
+                self.datasets.update(**changed_datasets)
+
+        end = time.time()
+        self.stats.update({
+            'passes': self.stats['passes'] + 1,
+            'last_duration': end - start,
+            'last_fetch_duration': fetched - start,
+            'last_datasets': count,
+            'last_changed_pools': len(changed_pools),
+            'last_changed_datasets': len(changed_datasets)
+        })
+
+        logger.log(TRACE, 'Refreshed {0} datasets in {1:.0f} ms, {2} changed'.format(
+            count,
+            (end - start) * 1000,
+            len(changed_datasets)
+        ))
+
+        return changed_pools, changed_datasets
+
+    def get_stats(self):
+        return dict(self.stats)
+
+
 def get_zfs():
     global zfs
     if not zfs:
@@ -1598,37 +1708,22 @@ def _init(dispatcher, plugin):
                     zpool_try_clear(dispatcher, p['name'], vd)
 
     def sync_sizes():
-        zfs = get_zfs()
+        global refresher
+
+        refresher = VolatileRefresher(dispatcher, libzfs.ZFS, pools, datasets)
         interval = dispatcher.configstore.get('middleware.zfs_refresh_interval')
         while True:
             gevent.sleep(interval)
-            with dispatcher.get_lock('zfs-cache'):
-                for key, i in pools.itervalid():
-                    try:
-                        zfspool = dispatcher.threaded(lambda: zfs.get(key).__getstate__(False))
-                        if zfspool != i:
-                            pools.put(key, zfspool)
-                    except libzfs.ZFSException:
-                        pass
-
-                for key, i in datasets.itervalid():
-                    def doit():
-                        props = i['properties']
-                        ds = zfs.get_dataset(i['id'])
-                        changed = False
-
-                        for prop in VOLATILE_ZFS_PROPERTIES:
-                            if props[prop]['rawvalue'] != ds.properties[prop].rawvalue:
-                                props[prop] = ds.properties[prop].__getstate__()
-                                changed = True
-
-                        return changed
+            try:
+                refresher.refresh()
+            except Exception as err:
+                logger.warning('Cannot refresh ZFS caches: {0}'.format(str(err)))
+                continue
 
-                    try:
-                        if dispatcher.threaded(doit):
-                            datasets.put(key, i)
-                    except libzfs.ZFSException:
-                        pass
+            if refresher.stats['last_duration'] > interval:
+                logger.warning('Refreshing ZFS caches took {0:.1f} s, longer than refresh interval'.format(
+                    refresher.stats['last_duration']
+                ))
 
     plugin.register_schema_definition('zfs-vdev', {
         'type': 'object',
@@ -1949,8 +2044,15 @@ def _init(dispatcher, plugin):
             return par, base, snap
 
         pools = EventCacheStore(dispatcher, 'zfs.pool', sort_func)
-        datasets = EventCacheStore(dispatcher, 'zfs.dataset', sort_func)
-        snapshots = EventCacheStore(dispatcher, 'zfs.snapshot', snap_sort_func)
+        datasets = EventCacheStore(
+            dispatcher, 'zfs.dataset', sort_func,
+            hash_indexes=['name', 'pool', 'type']
+        )
+        snapshots = EventCacheStore(
+            dispatcher, 'zfs.snapshot', snap_sort_func,
+            hash_indexes=['name', 'pool', 'dataset'],
+            sorted_indexes=['properties.createtxg.parsed']
+        )
 
         pools_dict = {}
         for i in dispatcher.threaded(lambda: [p.__getstate__(False) for p in zfs.pools]):
@@ -41,6 +41,7 @@ files = [
     "src/main.py",
     "src/query.py",
     "src/resources.py",
+    "src/subscription.py",
     "src/schemas.py",
     "src/services.py",
     "src/task.py",
@@ -33,6 +33,7 @@ from Cython.Distutils.extension import Extension
 from Cython.Distutils import build_ext
 
 freebsd_version = int(subprocess.check_output("uname -K", shell=True).strip())
+have_lz4 = os.path.exists('/usr/local/include/lz4.h')
 
 
 setup(
@@ -43,12 +44,15 @@ setup(
         Extension(
             "ReplicationTransportPlugin",
             ["plugins/ReplicationTransportPlugin.pyx"],
-            libraries=['crypto', 'z'],
+            libraries=['crypto', 'z'] + (['lz4'] if have_lz4 else []),
+            include_dirs=['/usr/local/include'] if have_lz4 else [],
+            library_dirs=['/usr/local/lib'] if have_lz4 else [],
             extra_compile_args=["-g", "-O0"],
             cython_compile_time_env={
                 'FREEBSD_VERSION': freebsd_version,
                 'TRUEOS': os.getenv('TRUEOS'),
-                'REPLICATION_TRANSPORT_DEBUG': os.getenv('REPLICATION_TRANSPORT_DEBUG')
+                'REPLICATION_TRANSPORT_DEBUG': os.getenv('REPLICATION_TRANSPORT_DEBUG'),
+                'HAVE_LZ4': have_lz4
             },
             extra_link_args=["-g"],
         )
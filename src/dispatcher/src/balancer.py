@@ -26,6 +26,7 @@
 #####################################################################
 
 import os
+import time
 import gevent
 import logging
 import traceback
@@ -33,8 +34,9 @@ import errno
 import copy
 import uuid
 import fnmatch
-import inspect
 import subprocess
+import socket
+import array
 import bsd
 import signal
 from threading import Condition
@@ -42,6 +44,7 @@ from datetime import datetime
 from freenas.dispatcher import validator
 from freenas.dispatcher.fd import FileDescriptor
 from freenas.dispatcher.rpc import RpcException
+from freenas.dispatcher.jsonenc import dumps
 from gevent.queue import Queue
 from gevent.lock import RLock
 from gevent.event import Event, AsyncResult
@@ -58,6 +61,10 @@ import collections
 
 
 TASKWORKER_PATH = '/usr/local/libexec/taskworker'
+FORKSERVER_SOCKET = '/var/run/taskworker.sock'
+DEFAULT_PROGRESS_PERSIST_INTERVAL = 2
+POOL_MANAGER_INTERVAL = 5
+SPAWN_LATENCY_SAMPLES = 100
 ERROR_TYPES = {
     'RpcException': RpcException,
     'TaskException': TaskException,
@@ -86,6 +93,52 @@ class WorkerState(object):
     STARTING = 'STARTING'
 
 
+class ForkServerProcess(object):
+    """
+    Popen-like handle of a task executor forked by the taskworker fork server.
+    Worker output is received over a pipe passed to the fork server, exit status
+    is reported back over the control connection.
+    """
+    def __init__(self, path, key):
+        self.pid = None
+        self.returncode = None
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        rfd, wfd = os.pipe()
+
+        try:
+            self.sock.connect(path)
+            self.sock.sendmsg(
+                [key.encode('utf-8') + b'\n'],
+                [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [wfd]))]
+            )
+            self.control = self.sock.makefile('rb')
+            line = self.control.readline()
+            if not line:
+                raise OSError(errno.ECHILD, 'Fork server did not spawn executor')
+
+            self.pid = int(line)
+        except OSError:
+            os.close(rfd)
+            self.sock.close()
+            raise
+        finally:
+            os.close(wfd)
+
+        self.stdout = FileObjectPosix(rfd, 'rb', close=True)
+
+    def wait(self):
+        if self.returncode is None:
+            line = self.control.readline()
+            self.returncode = int(line) if line else -signal.SIGKILL
+            self.control.close()
+            self.sock.close()
+
+        return self.returncode
+
+    def terminate(self):
+        os.kill(self.pid, signal.SIGTERM)
+
+
 class TaskExecutor(object):
     def __init__(self, balancer, index):
         self.balancer = balancer
@@ -99,17 +152,59 @@ class TaskExecutor(object):
         self.result = AsyncResult()
         self.exiting = False
         self.killed = False
-        self.thread = gevent.spawn(self.executor)
+        self.spawned_at = None
+        self.idle_since = None
+        self.tasks_run = 0
         self.cv = Condition()
         self.status_lock = RLock()
+        self.thread = gevent.spawn(self.executor)
 
     def checkin(self, conn):
         with self.cv:
             self.balancer.logger.debug('Check-in of worker #{0} (key {1})'.format(self.index, self.key))
             self.conn = conn
             self.state = WorkerState.IDLE
+            self.idle_since = time.time()
+            self.cv.notify_all()
+
+        if self.spawned_at:
+            self.balancer.executor_started(self, time.time() - self.spawned_at)
+
+        self.balancer.executor_released(self)
+
+    def set_idle(self):
+        with self.cv:
+            if self.state != WorkerState.EXECUTING:
+                return
+
+            self.tasks_run += 1
+            max_tasks = self.balancer.pool_config['max_tasks']
+            if max_tasks and self.tasks_run >= max_tasks and not self.exiting:
+                # Recycle worker process to cap its memory growth
+                self.balancer.logger.debug('Recycling executor #{0} after {1} tasks'.format(self.index, self.tasks_run))
+                self.tasks_run = 0
+                self.state = WorkerState.STARTING
+                self.cv.notify_all()
+                self.terminate()
+                return
+
+            self.state = WorkerState.IDLE
+            self.idle_since = time.time()
+            self.cv.notify_all()
+
+        self.balancer.executor_released(self)
+
+    def unassign(self):
+        with self.cv:
+            if self.state != WorkerState.ASSIGNED:
+                return
+
+            self.state = WorkerState.IDLE
+            self.idle_since = time.time()
             self.cv.notify_all()
 
+        self.balancer.executor_released(self)
+
     def put_progress(self, progress):
         st = TaskStatus(None)
         st.__setstate__(progress)
@@ -156,10 +251,6 @@ class TaskExecutor(object):
         self.task.add_warning(warning)
 
     def run(self, task):
-        def match_file(module, f):
-            name, ext = os.path.splitext(f)
-            return module == name and ext in ['.py', '.pyc', '.so']
-
         with self.cv:
             self.cv.wait_for(lambda: self.state == WorkerState.ASSIGNED)
             self.result = AsyncResult()
@@ -170,22 +261,7 @@ class TaskExecutor(object):
 
         self.balancer.logger.debug('Actually starting task {0}'.format(task.id))
 
-        filename = None
-        module_name = inspect.getmodule(task.clazz).__name__
-        for dir in self.balancer.dispatcher.plugin_dirs:
-            found = False
-            try:
-                for root, _, files in os.walk(dir):
-                    file = first_or_default(lambda f: match_file(module_name, f), files)
-                    if file:
-                        filename = os.path.join(root, file)
-                        found = True
-                        break
-
-                if found:
-                    break
-            except OSError:
-                continue
+        filename = self.balancer.dispatcher.get_task_filename(task.clazz)
 
         try:
             self.conn.call_sync('taskproxy.run', {
@@ -232,10 +308,7 @@ class TaskExecutor(object):
             with self.cv:
                 self.task.ended.set()
 
-                if self.state == WorkerState.EXECUTING:
-                    self.state = WorkerState.IDLE
-                    self.cv.notify_all()
-
+            self.set_idle()
             self.balancer.task_exited(self.task)
             return
 
@@ -243,10 +316,8 @@ class TaskExecutor(object):
             self.task.result = self.result.value
             self.task.set_state(TaskState.FINISHED, TaskStatus(100, ''))
             self.task.ended.set()
-            if self.state == WorkerState.EXECUTING:
-                self.state = WorkerState.IDLE
-                self.cv.notify_all()
 
+        self.set_idle()
         self.balancer.task_exited(self.task)
 
     def abort(self):
@@ -279,18 +350,24 @@ class TaskExecutor(object):
     def executor(self):
         while not self.exiting:
             try:
-                self.proc = Popen(
-                    [TASKWORKER_PATH, self.key],
-                    close_fds=True,
-                    preexec_fn=os.setpgrp,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT)
-
+                self.spawned_at = time.time()
+                self.proc = self.balancer.spawn_worker_process(self.key)
                 self.pid = self.proc.pid
                 self.balancer.logger.debug('Started executor #{0} as PID {1}'.format(self.index, self.pid))
             except OSError:
                 self.result.set_exception(TaskException(errno.EFAULT, 'Cannot spawn task executor'))
                 self.balancer.logger.error('Cannot spawn task executor #{0}'.format(self.index))
+
+                # Back off before letting waiters spawn a replacement
+                gevent.sleep(1)
+                with self.cv:
+                    self.exiting = True
+                    self.cv.notify_all()
+
+                if self in self.balancer.executors:
+                    self.balancer.executors.remove(self)
+
+                self.balancer.executor_released(self)
                 return
 
             for line in self.proc.stdout:
@@ -329,6 +406,76 @@ class TaskExecutor(object):
             self.terminate()
 
 
+class TaskStateWriter(object):
+    """
+    Write-behind layer for the tasks collection. State transitions are
+    persisted immediately, progress-only updates are coalesced per task
+    and written at most once per interval.
+    """
+    def __init__(self, dispatcher, interval):
+        self.dispatcher = dispatcher
+        self.interval = interval
+        self.pending = {}
+        self.lock = RLock()
+        self.flusher = None
+        self.stats = {
+            'writes': 0,
+            'deferred': 0,
+            'saved': 0,
+            'flushes': 0
+        }
+
+    def __persist(self, task, operation='update'):
+        self.stats['writes'] += 1
+        self.dispatcher.datastore.update('tasks', task.id, task)
+        self.dispatcher.dispatch_event('task.changed', {
+            'operation': operation,
+            'ids': [task.id]
+        })
+
+    def write(self, task, operation='update'):
+        with self.lock:
+            if self.pending.pop(task.id, None):
+                # Pending progress update is superseded by this write
+                self.stats['saved'] += 1
+
+        self.__persist(task, operation)
+
+    def defer(self, task):
+        if not self.interval:
+            self.write(task)
+            return
+
+        with self.lock:
+            self.stats['deferred'] += 1
+            if task.id in self.pending:
+                self.stats['saved'] += 1
+                return
+
+            self.pending[task.id] = task
+            if not self.flusher:
+                self.flusher = gevent.spawn_later(self.interval, self.flush)
+
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            self.flusher = None
+
+        if pending:
+            self.stats['flushes'] += 1
+
+        for task in pending.values():
+            try:
+                self.__persist(task)
+            except BaseException as err:
+                self.dispatcher.logger.warning('Cannot persist state of task {0}: {1}'.format(task.id, str(err)))
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, pending=len(self.pending), interval=self.interval)
+
+
 class Task(object):
     def __init__(self, dispatcher, name=None):
         self.dispatcher = dispatcher
@@ -396,15 +543,29 @@ class Task(object):
         })
 
     def start(self):
-        try:
-            self.balancer.assign_executor(self)
-        except OverflowError:
-            self.set_state(TaskState.FAILED, error='Out of executors')
-            self.ended.set()
-            self.balancer.task_exited(self)
+        def run():
+            try:
+                self.balancer.assign_executor(self)
+            except OverflowError:
+                self.set_state(TaskState.FAILED, error='Out of executors')
+                self.ended.set()
+                self.balancer.task_exited(self)
+                return
+
+            if self.ended.is_set():
+                # Aborted while waiting for an executor
+                self.executor.unassign()
+                self.executor = None
+                self.balancer.task_exited(self)
+                return
+
+            # Start actual task
+            self.executor.run(self)
 
-        # Start actual task
-        return gevent.spawn(self.executor.run, self)
+        # Waiting for an executor happens off the scheduling path, the task
+        # is ASSIGNING until then so that it doesn't get scheduled again
+        self.set_state(TaskState.ASSIGNING)
+        return gevent.spawn(run)
 
     def join(self, timeout=None):
         self.ended.wait(timeout)
@@ -432,12 +593,12 @@ class Task(object):
             if self.state in (TaskState.FAILED, TaskState.ABORTED):
                 self.progress = TaskStatus(0)
 
-            self.dispatcher.dispatch_event('task.created' if self.state == TaskState.CREATED else 'task.updated', event)
-            self.dispatcher.datastore.update('tasks', self.id, self)
-            self.dispatcher.dispatch_event('task.changed', {
-                'operation': 'create' if state == TaskState.CREATED else 'update',
-                'ids': [self.id]
-            })
+            if state or error:
+                self.dispatcher.dispatch_event('task.created' if self.state == TaskState.CREATED else 'task.updated', event)
+                self.balancer.task_writer.write(self, 'create' if state == TaskState.CREATED else 'update')
+            else:
+                # Progress-only update, coalesced by the write-behind layer
+                self.balancer.task_writer.defer(self)
 
             if progress and self.state not in (TaskState.FINISHED, TaskState.FAILED, TaskState.ABORTED):
                 self.progress = progress
@@ -458,19 +619,15 @@ class Task(object):
 
     def set_env(self, key, value):
         self.environment[key] = value
-        self.dispatcher.datastore.update('tasks', self.id, self)
+        self.balancer.task_writer.write(self)
 
     def set_output(self, output):
         self.output = output
-        self.dispatcher.datastore.update('tasks', self.id, self)
+        self.balancer.task_writer.write(self)
 
     def add_warning(self, warning):
         self.warnings.append(warning)
-        self.dispatcher.datastore.update('tasks', self.id, self)
-        self.dispatcher.dispatch_event('task.changed', {
-            'operation': 'update',
-            'ids': [self.id]
-        })
+        self.balancer.task_writer.write(self)
 
     def get_description(self):
         if not self.description:
@@ -493,21 +650,35 @@ class Balancer(object):
         self.resource_graph = dispatcher.resource_graph
         self.threads = []
         self.executors = []
+        self.executor_index = 0
+        self.executor_waiters = 0
+        self.subtask_waiters = 0
+        self.executor_available = Event()
+        self.pool_config = {}
+        self.pool_stats = {
+            'spawned': 0,
+            'reaped': 0,
+            'spawn_latency': collections.deque(maxlen=SPAWN_LATENCY_SAMPLES)
+        }
+        self.forkserver = None
         self.logger = logging.getLogger('Balancer')
         self.dispatcher.require_collection('tasks', 'serial', type='log')
+        self.task_writer = TaskStateWriter(dispatcher, self.get_progress_persist_interval())
         self.create_initial_queues()
-        self.start_executors()
+        self.load_pool_config()
+        if not self.dispatcher.configstore.get('middleware.taskworker_forkserver'):
+            self.start_executors()
         self.schedule_lock = RLock()
         self.distribution_lock = RLock()
         self.debugger = None
         self.debugged_tasks = None
         self.dispatcher.register_event_type('task.changed')
 
-        # Lets try to get `EXECUTING|WAITING|CREATED` state tasks
+        # Lets try to get `EXECUTING|ASSIGNING|WAITING|CREATED` state tasks
         # from the previous dispatcher instance and set their
         # states to 'FAILED' since they are no longer running
         # in this instance of the dispatcher
-        for stale_task in dispatcher.datastore.query('tasks', ('state', 'in', ['EXECUTING', 'WAITING', 'CREATED'])):
+        for stale_task in dispatcher.datastore.query('tasks', ('state', 'in', ['EXECUTING', 'ASSIGNING', 'WAITING', 'CREATED'])):
             self.logger.info('Stale task ID: {0}, name: {1} being set to FAILED'.format(
                 stale_task['id'],
                 stale_task['name']
@@ -526,16 +697,171 @@ class Balancer(object):
 
             dispatcher.datastore.update('tasks', stale_task['id'], stale_task)
 
+    def get_progress_persist_interval(self):
+        interval = self.dispatcher.configstore.get('middleware.task_progress_persist_interval')
+        if interval is None:
+            return DEFAULT_PROGRESS_PERSIST_INTERVAL
+
+        return interval
+
     def create_initial_queues(self):
         self.resource_graph.add_resource(Resource('system'))
 
+    def load_pool_config(self):
+        configstore = self.dispatcher.configstore
+        minimum = configstore.get('middleware.executors_count') or 0
+        self.pool_config = {
+            'min': minimum,
+            'max': max(minimum, configstore.get('middleware.executors_max') or 0),
+            'spare': configstore.get('middleware.executors_spare') or 0,
+            'idle_ttl': configstore.get('middleware.executors_idle_ttl') or 0,
+            'max_tasks': configstore.get('middleware.executors_max_tasks') or 0
+        }
+
     def start_executors(self):
-        for i in range(0, self.dispatcher.configstore.get('middleware.executors_count')):
-            self.logger.info('Starting task executor #{0}...'.format(i))
-            self.executors.append(TaskExecutor(self, i))
+        for i in range(0, self.pool_config['min']):
+            self.spawn_executor()
+
+    def spawn_executor(self):
+        index = self.executor_index
+        self.executor_index += 1
+        self.logger.info('Starting task executor #{0}...'.format(index))
+        executor = TaskExecutor(self, index)
+        self.executors.append(executor)
+        self.pool_stats['spawned'] += 1
+        return executor
+
+    def reap_executor(self, executor):
+        self.logger.info('Reaping idle task executor #{0}'.format(executor.index))
+        self.executors.remove(executor)
+        self.pool_stats['reaped'] += 1
+        executor.die()
+
+    def executor_started(self, executor, latency):
+        self.pool_stats['spawn_latency'].append(latency)
+
+    def executor_released(self, executor):
+        self.executor_available.set()
+
+    def pool_manager_thread(self):
+        while True:
+            gevent.sleep(POOL_MANAGER_INTERVAL)
+            self.manage_pool()
+
+    def manage_pool(self):
+        config = self.pool_config
+        maximum = config['max'] or None
+        idle = [e for e in self.executors if e.state == WorkerState.IDLE]
+        spare = idle + [e for e in self.executors if e.state == WorkerState.STARTING and not e.exiting]
+
+        # Prewarm executors in the background, so tasks don't have to wait
+        # for interpreter startup after a burst
+        while len(spare) < config['spare'] and (maximum is None or len(self.executors) < maximum):
+            spare.append(self.spawn_executor())
+
+        if not config['idle_ttl']:
+            return
+
+        now = time.time()
+        for executor in sorted(idle, key=lambda e: e.idle_since or now):
+            if len(self.executors) <= config['min'] or len(spare) <= config['spare']:
+                break
+
+            if now - (executor.idle_since or now) < config['idle_ttl']:
+                continue
+
+            with executor.cv:
+                if executor.state != WorkerState.IDLE:
+                    continue
+
+                executor.state = WorkerState.STARTING
+                executor.exiting = True
+
+            spare.remove(executor)
+            self.reap_executor(executor)
+
+    def get_pool_stats(self):
+        latency = list(self.pool_stats['spawn_latency'])
+        states = collections.Counter(e.state for e in self.executors)
+        return {
+            'config': dict(self.pool_config),
+            'size': len(self.executors),
+            'idle': states[WorkerState.IDLE],
+            'busy': states[WorkerState.ASSIGNED] + states[WorkerState.EXECUTING],
+            'starting': states[WorkerState.STARTING],
+            'spawned': self.pool_stats['spawned'],
+            'reaped': self.pool_stats['reaped'],
+            'spawn_latency': {
+                'samples': len(latency),
+                'average': sum(latency) / len(latency) if latency else None,
+                'min': min(latency) if latency else None,
+                'max': max(latency) if latency else None,
+            }
+        }
+
+    def start_forkserver(self):
+        # Preload all modules providing tasks, so forked executors don't
+        # have to import them again on their first task
+        filenames = {self.dispatcher.get_task_filename(c) for c in self.dispatcher.tasks.values()}
+        filenames.discard(None)
+
+        try:
+            proc = Popen(
+                [TASKWORKER_PATH, '--forkserver', FORKSERVER_SOCKET],
+                close_fds=True,
+                preexec_fn=os.setpgrp,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT)
+
+            proc.stdin.write(dumps(sorted(filenames)).encode('utf-8'))
+            proc.stdin.close()
+        except OSError as err:
+            self.logger.error('Cannot start task executor fork server: {0}'.format(str(err)))
+            return
+
+        for line in proc.stdout:
+            line = line.decode('utf8').strip()
+            if line == 'READY':
+                self.forkserver = proc
+                self.logger.info('Task executor fork server started as PID {0}'.format(proc.pid))
+                break
+
+            self.logger.debug('Fork server: {0}'.format(line))
+        else:
+            self.logger.error('Task executor fork server exited with code {0}'.format(proc.wait()))
+            return
+
+        def drain():
+            for line in proc.stdout:
+                self.logger.debug('Fork server: {0}'.format(line.decode('utf8').strip()))
+
+            self.logger.warning('Task executor fork server exited with code {0}'.format(proc.wait()))
+            self.forkserver = None
+
+        self.threads.append(gevent.spawn(drain))
+
+    def spawn_worker_process(self, key):
+        if self.forkserver:
+            try:
+                return ForkServerProcess(FORKSERVER_SOCKET, key)
+            except OSError as err:
+                self.logger.warning('Cannot fork executor from fork server, spawning it directly: {0}'.format(str(err)))
+
+        return Popen(
+            [TASKWORKER_PATH, key],
+            close_fds=True,
+            preexec_fn=os.setpgrp,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
 
     def start(self):
+        if self.dispatcher.configstore.get('middleware.taskworker_forkserver'):
+            self.start_forkserver()
+            self.start_executors()
+
         self.threads.append(gevent.spawn(self.distribution_thread))
+        self.threads.append(gevent.spawn(self.pool_manager_thread))
         self.logger.info("Started")
 
     def schema_to_list(self, schema):
@@ -725,7 +1051,7 @@ class Balancer(object):
         """
         with self.schedule_lock:
             started = 0
-            executing_tasks = [t for t in self.task_list if t.state == TaskState.EXECUTING]
+            executing_tasks = [t for t in self.task_list if t.state in (TaskState.ASSIGNING, TaskState.EXECUTING)]
             waiting_tasks = [t for t in self.task_list if t.state == TaskState.WAITING]
 
             for task in waiting_tasks:
@@ -788,31 +1114,57 @@ class Balancer(object):
                 self.logger.debug("Task %d assigned to resources %s", task.id, ','.join(task.resources))
 
     def assign_executor(self, task):
-        for i in self.executors:
-            with i.cv:
-                if i.state == WorkerState.IDLE:
-                    self.logger.info("Task %d assigned to executor #%d", task.id, i.index)
-                    task.executor = i
-                    i.state = WorkerState.ASSIGNED
-                    return
-
-        # Out of executors! Need to spawn new one
-        executor = TaskExecutor(self, len(self.executors))
-        self.executors.append(executor)
-        with executor.cv:
-            executor.cv.wait_for(lambda: executor.state == WorkerState.IDLE)
-            executor.state = WorkerState.ASSIGNED
-            task.executor = executor
-            self.logger.info("Task %d assigned to executor #%d", task.id, executor.index)
+        # Parents hold their executors while joining subtasks, so subtasks
+        # aren't subject to the pool limit and go before top level tasks
+        subtask = task.parent is not None
+        while True:
+            self.executor_available.clear()
+            if subtask or not self.subtask_waiters:
+                for i in self.executors:
+                    with i.cv:
+                        if i.state == WorkerState.IDLE and not i.exiting:
+                            self.logger.info("Task %d assigned to executor #%d", task.id, i.index)
+                            task.executor = i
+                            i.state = WorkerState.ASSIGNED
+                            if self.executor_waiters:
+                                # Let skipped top level tasks look again
+                                self.executor_available.set()
+                            return
+
+            # Out of executors! Spawn new one unless pool is at its limit,
+            # then wait for any executor to become available
+            maximum = self.pool_config['max']
+            starting = [e for e in self.executors if e.state == WorkerState.STARTING and not e.exiting]
+            if subtask:
+                if len(starting) <= self.subtask_waiters:
+                    self.spawn_executor()
+            elif len(starting) <= self.executor_waiters and (not maximum or len(self.executors) < maximum):
+                self.spawn_executor()
+
+            self.executor_waiters += 1
+            self.subtask_waiters += subtask
+            try:
+                self.executor_available.wait()
+            finally:
+                self.executor_waiters -= 1
+                self.subtask_waiters -= subtask
 
     def dispose_executors(self):
+        self.task_writer.flush()
         for i in self.executors:
             i.die()
 
+        if self.forkserver:
+            try:
+                self.forkserver.terminate()
+            except OSError:
+                pass
+
     def get_active_tasks(self):
         return [x for x in self.task_list if x.state in (
             TaskState.CREATED,
             TaskState.WAITING,
+            TaskState.ASSIGNING,
             TaskState.EXECUTING
         )]
 
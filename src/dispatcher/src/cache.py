@@ -25,30 +25,156 @@
 #
 #####################################################################
 
+import itertools
+import freenas.utils.query as q
 from gevent.event import Event
 from gevent.lock import RLock
-from freenas.utils.query import query, set
 from sortedcontainers import SortedDict
 
 
+class HashIndex(object):
+    """
+    Maps values of a single property to the set of cache keys holding it.
+    Serves '=' and 'in' filter operators.
+    """
+    operators = ('=', 'in')
+
+    def __init__(self, path):
+        self.path = path
+        self.buckets = {}
+        self.values = {}
+        self.unindexed = set()
+
+    def add(self, key, obj):
+        self.discard(key)
+        value = q.get(obj, self.path)
+        try:
+            self.buckets.setdefault(value, set()).add(key)
+            self.values[key] = value
+        except TypeError:
+            # Unhashable value, always return it as a candidate
+            self.unindexed.add(key)
+
+    def discard(self, key):
+        self.unindexed.discard(key)
+        if key not in self.values:
+            return
+
+        value = self.values.pop(key)
+        bucket = self.buckets[value]
+        bucket.discard(key)
+        if not bucket:
+            del self.buckets[value]
+
+    def clear(self):
+        self.buckets.clear()
+        self.values.clear()
+        self.unindexed.clear()
+
+    def lookup(self, op, value):
+        if op == '=':
+            try:
+                return self.buckets.get(value, set()) | self.unindexed
+            except TypeError:
+                return None
+
+        if op == 'in' and isinstance(value, (list, tuple)):
+            result = set(self.unindexed)
+            for i in value:
+                try:
+                    result |= self.buckets.get(i, set())
+                except TypeError:
+                    return None
+
+            return result
+
+        return None
+
+
+class SortedIndex(HashIndex):
+    """
+    Keeps values of a single property ordered. Serves '=', 'in', range
+    operators and ordering by that property.
+    """
+    operators = ('=', 'in', '>', '<', '>=', '<=')
+
+    def __init__(self, path):
+        super(SortedIndex, self).__init__(path)
+        self.buckets = SortedDict()
+
+    def add(self, key, obj):
+        self.discard(key)
+        value = q.get(obj, self.path)
+        if value is None:
+            self.unindexed.add(key)
+            return
+
+        try:
+            self.buckets.setdefault(value, set()).add(key)
+            self.values[key] = value
+        except TypeError:
+            # Value not comparable with the rest of the index
+            self.unindexed.add(key)
+
+    def lookup(self, op, value):
+        if op in ('=', 'in'):
+            return super(SortedIndex, self).lookup(op, value)
+
+        bounds = {
+            '>': lambda: self.buckets.irange(minimum=value, inclusive=(False, False)),
+            '>=': lambda: self.buckets.irange(minimum=value),
+            '<': lambda: self.buckets.irange(maximum=value, inclusive=(False, False)),
+            '<=': lambda: self.buckets.irange(maximum=value),
+        }
+
+        try:
+            result = set(self.unindexed)
+            for i in bounds[op]():
+                result |= self.buckets[i]
+        except (KeyError, TypeError):
+            return None
+
+        return result
+
+    def ordered(self, reverse=False, key=None):
+        for value in self.buckets.irange(reverse=reverse):
+            yield from sorted(self.buckets[value], key=key)
+
+
 class CacheStore(object):
     class CacheItem(object):
         def __init__(self):
             self.valid = Event()
             self.data = None
 
-    def __init__(self, key=None):
+    def __init__(self, key=None, hash_indexes=None, sorted_indexes=None):
         self.lock = RLock()
         self.store = SortedDict(key)
+        self.indexes = {}
+
+        for path in hash_indexes or []:
+            self.indexes[path] = HashIndex(path)
+
+        for path in sorted_indexes or []:
+            self.indexes[path] = SortedIndex(path)
 
     def __getitem__(self, item):
         return self.get(item)
 
+    def __index_add(self, key, data):
+        for index in self.indexes.values():
+            index.add(key, data)
+
+    def __index_discard(self, key):
+        for index in self.indexes.values():
+            index.discard(key)
+
     def put(self, key, data):
         with self.lock:
             item = self.store[key] if key in self.store else self.CacheItem()
             item.data = data
             item.valid.set()
+            self.__index_add(key, data)
 
             if key not in self.store:
                 self.store[key] = item
@@ -65,6 +191,7 @@ class CacheStore(object):
                 items[k] = self.CacheItem()
                 items[k].data = v
                 items[k].valid.set()
+                self.__index_add(k, v)
                 if k in self.store:
                     updated.append(k)
                 else:
@@ -80,7 +207,7 @@ class CacheStore(object):
                 return False
 
             for k, v in kwargs.items():
-                set(item, k, v)
+                q.set(item, k, v)
 
             self.put(key, item)
             return True
@@ -107,6 +234,7 @@ class CacheStore(object):
         with self.lock:
             if key in self.store:
                 del self.store[key]
+                self.__index_discard(key)
                 return True
 
             return False
@@ -117,6 +245,7 @@ class CacheStore(object):
             for key in keys:
                 if key in self.store:
                     del self.store[key]
+                    self.__index_discard(key)
                     removed.append(key)
 
             return removed
@@ -125,6 +254,9 @@ class CacheStore(object):
         with self.lock:
             items = list(self.store.keys())
             self.store.clear()
+            for index in self.indexes.values():
+                index.clear()
+
             return items
 
     def exists(self, key):
@@ -169,13 +301,86 @@ class CacheStore(object):
 
         return result
 
+    def plan(self, filter, params):
+        """
+        Narrows down the set of candidate keys using declared indexes.
+        Returns a tuple of (candidate keys or None, rules not fully served
+        by indexes, index able to produce requested ordering or None).
+        """
+        candidates = None
+        residual = []
+
+        for rule in filter:
+            index = None
+            if isinstance(rule, (list, tuple)) and len(rule) == 3 and isinstance(rule[0], str):
+                index = self.indexes.get(rule[0])
+
+            if not index or rule[1] not in index.operators:
+                residual.append(rule)
+                continue
+
+            keys = index.lookup(rule[1], rule[2])
+            if keys is None:
+                residual.append(rule)
+                continue
+
+            if index.unindexed:
+                residual.append(rule)
+
+            candidates = keys if candidates is None else candidates & keys
+
+        order = None
+        sort = params.get('sort')
+        if isinstance(sort, str):
+            sort = [sort]
+
+        if sort and len(sort) == 1:
+            index = self.indexes.get(sort[0].lstrip('-'))
+            if isinstance(index, SortedIndex) and not index.unindexed:
+                order = index
+
+        return candidates, residual, order
+
     def query(self, *filter, **params):
-        return query(list(self.validvalues()), *filter, **params)
+        if not self.indexes:
+            return q.query(list(self.validvalues()), *filter, **params)
+
+        candidates, residual, order = self.plan(filter, params)
+        params = dict(params)
+
+        if order:
+            sort = params.pop('sort')
+            reverse = (sort if isinstance(sort, str) else sort[0]).startswith('-')
+            keys = order.ordered(reverse, self.store.index)
+            if candidates is not None:
+                keys = (k for k in keys if k in candidates)
+        elif candidates is not None:
+            keys = sorted(candidates, key=self.store.index) if 'sort' not in params else candidates
+        else:
+            keys = self.store.keys()
+
+        values = (self.store[k] for k in keys if k in self.store)
+        values = (i.data for i in values if i.valid.is_set())
+
+        if not residual:
+            # Everything was answered by indexes, so offset, limit and single
+            # can be applied before materializing the result
+            if 'sort' not in params and not params.get('count'):
+                offset = params.pop('offset', None) or 0
+                limit = params.pop('limit', None)
+                if params.pop('single', False):
+                    limit = 1
+                    params['single'] = True
+
+                stop = offset + limit if limit is not None else None
+                values = itertools.islice(values, offset, stop)
+
+        return q.query(list(values), *residual, **params)
 
 
 class EventCacheStore(CacheStore):
-    def __init__(self, dispatcher, name, key=None):
-        super(EventCacheStore, self).__init__(key=key)
+    def __init__(self, dispatcher, name, key=None, hash_indexes=None, sorted_indexes=None):
+        super(EventCacheStore, self).__init__(key=key, hash_indexes=hash_indexes, sorted_indexes=sorted_indexes)
         self.dispatcher = dispatcher
         self.ready = False
         self.name = name
@@ -51,6 +51,7 @@ import struct
 import termios
 import fcntl
 import traceback
+import inspect
 import websocket  # do not remove - we import it only for side effects
 
 import gevent
@@ -66,11 +67,12 @@ from geventwebsocket import WebSocketApplication, WebSocketError
 
 from datastore import get_datastore
 from datastore.migrate import migrate_db, MigrationException
-from datastore.config import ConfigStore
+from datastore.config import ConfigStore, CachedConfigStore
 from freenas.dispatcher.jsonenc import loads, dumps
 from freenas.dispatcher.rpc import RpcContext, RpcException, ServerLockProxy
 from freenas.dispatcher.server import Server, ServerConnection
 from resources import ResourceGraph
+from subscription import SubscriptionRegistry
 from services import (
     ManagementService, DebugService, EventService, TaskService,
     PluginService, ShellService, LockService
@@ -83,7 +85,7 @@ from freenas.utils.trace_logger import TraceLogger, TRACE
 
 DEFAULT_CONFIGFILE = '/usr/local/etc/middleware.conf'
 LOGGING_FORMAT = '%(asctime)s %(levelname)s %(filename)s:%(lineno)d %(message)s'
-FEATURES = ['streaming_responses', 'strict_validation']
+FEATURES = ['streaming_responses', 'strict_validation', 'entity_deltas']
 trace_log_file = None
 
 
@@ -320,6 +322,7 @@ class Dispatcher(object):
         self.event_handlers = {}
         self.hooks = {}
         self.plugins = {}
+        self.module_files = {}
         self.threads = []
         self.queues = {}
         self.providers = {}
@@ -329,6 +332,7 @@ class Dispatcher(object):
         self.logger = logging.getLogger('Main')
         self.token_store = TokenStore(self)
         self.event_delivery_lock = RLock()
+        self.subscriptions = SubscriptionRegistry()
         self.rpc = None
         self.balancer = None
         self.datastore = None
@@ -356,7 +360,9 @@ class Dispatcher(object):
         self.start_logdb()
 
         self.datastore = get_datastore(self.configfile)
-        self.configstore = ConfigStore(self.datastore)
+        self.configstore = ConfigStore(self.datastore, notifier=self.__on_config_set)
+        if self.configstore.get('middleware.config_cache'):
+            self.configstore = CachedConfigStore(self.datastore, notifier=self.__on_config_set)
 
         self.migrate_logdb()
 
@@ -392,6 +398,8 @@ class Dispatcher(object):
         self.register_event_type('server.ready')
         self.register_event_type('server.shutdown')
         self.register_event_type('server.schema_document_changed')
+        self.register_event_type('config.changed')
+        self.register_event_handler('config.changed', self.__on_config_changed)
 
     def start(self):
         self.started_at = time.time()
@@ -525,6 +533,7 @@ class Dispatcher(object):
             plugin = Plugin(self, path)
             plugin.assign_module(load_module_from_file(name, path))
             self.plugins[name] = plugin
+            self.module_files[name] = path
         except Exception as err:
             self.logger.exception("Cannot load plugin from %s", path)
             self.report_error('Cannot load plugin from {0}'.format(path), err)
@@ -533,6 +542,15 @@ class Dispatcher(object):
 
         self.dispatch_event("server.plugin.loaded", {"name": os.path.basename(path)})
 
+    def __on_config_set(self, keys):
+        self.dispatch_event('config.changed', {'keys': keys, 'pid': os.getpid()})
+
+    def __on_config_changed(self, args):
+        if args.get('pid') == os.getpid():
+            return
+
+        self.configstore.invalidate(args.get('keys'))
+
     def __on_service_started(self, args):
         if args['name'] == 'syslog':
             try:
@@ -563,9 +581,8 @@ class Dispatcher(object):
                 # If there's no timestamp, assume event fired right now
                 args['timestamp'] = datetime.datetime.utcnow()
 
-            for srv in self.ws_servers:
-                for conn in srv.connections:
-                    conn.outgoing_events.put((name, args))
+            for conn in self.subscriptions.match(name):
+                conn.outgoing_events.put((name, args))
 
         if name in self.event_handlers:
             for h in self.event_handlers[name]:
@@ -645,6 +662,27 @@ class Dispatcher(object):
         self.logger.debug("New task handler: %s", name)
         self.tasks[name] = clazz
 
+    def get_task_filename(self, clazz):
+        module_name = inspect.getmodule(clazz).__name__
+        filename = self.module_files.get(module_name)
+        if filename:
+            return filename
+
+        # Task class lives outside of plugin modules, look it up once
+        for dir in self.plugin_dirs:
+            try:
+                for root, _, files in os.walk(dir):
+                    for f in files:
+                        name, ext = os.path.splitext(f)
+                        if name == module_name and ext in ('.py', '.pyc', '.so'):
+                            filename = os.path.join(root, f)
+                            self.module_files[module_name] = filename
+                            return filename
+            except OSError:
+                continue
+
+        return None
+
     def unregister_task_handler(self, name):
         del self.tasks[name]
 
@@ -935,6 +973,7 @@ class DispatcherConnection(ServerConnection):
                 if match_event(name, mask):
                     ev.decref()
 
+        self.dispatcher.subscriptions.remove(self)
         self.outgoing_events.put(StopIteration)
         self.dispatcher.dispatch_event('server.client_disconnected', {
             'address': self.client_address,
@@ -984,6 +1023,7 @@ class DispatcherConnection(ServerConnection):
                     if match_event(name, mask):
                         ev.incref()
 
+            self.dispatcher.subscriptions.subscribe(self, set.difference(set(event_masks), self.event_masks))
             self.event_masks = set.union(self.event_masks, set(event_masks))
 
     def on_events_unsubscribe(self, id, event_masks):
@@ -1012,6 +1052,7 @@ class DispatcherConnection(ServerConnection):
                     if match_event(name, mask):
                         ev.decref()
 
+            self.dispatcher.subscriptions.unsubscribe(self, intersecting_unsubscribe_events)
             self.event_masks = set.difference(self.event_masks, intersecting_unsubscribe_events)
 
     def on_events_event(self, id, data):
@@ -1205,6 +1246,7 @@ class DispatcherConnection(ServerConnection):
             self.dispatcher.dispatch_event('server.client_logout', {
                 'address': self.client_address,
                 'username': self.user.name,
+                'session_id': self.session_id,
                 'description': "Client {0} logged out".format(self.user.name)
             })
 
@@ -1254,11 +1296,20 @@ class DispatcherConnection(ServerConnection):
                 'following error occured {0}'.format(str(werr)))
 
     def emit_event(self, event, args):
-        for i in self.event_masks:
-            if not match_event(event, i):
-                continue
+        if not self.dispatcher.subscriptions.is_subscribed(self, event):
+            return
 
-            self.send_event(event, args)
+        if 'delta' in args:
+            # Entity subscriber events carry both the full entities and
+            # a delta against the previous version, send only one of them
+            args = dict(args)
+            delta = args.pop('delta')
+            if 'entity_deltas' in self.enabled_features:
+                args.pop('entities', None)
+                args.pop('data', None)
+                args['delta'] = delta
+
+        self.send_event(event, args)
 
     def emit_rpc_call(self, id, method, args):
         return self.send_call(id, method, args)
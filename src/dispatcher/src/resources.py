@@ -36,6 +36,7 @@ class Resource(object):
     def __init__(self, name):
         self.name = name
         self.busy = False
+        self.busy_descendants = 0
 
     def __str__(self):
         return "<Resource '{0}'>".format(self.name)
@@ -55,6 +56,7 @@ class ResourceGraph(object):
         self.root = Resource('root')
         self.resources = nx.DiGraph()
         self.resources.add_node(self.root)
+        self.index = {self.root.name: self.root}
 
     def lock(self):
         self.mutex.acquire()
@@ -66,6 +68,35 @@ class ResourceGraph(object):
     def nodes(self):
         return self.resources.nodes()
 
+    def __propagate_busy(self, resource, delta):
+        # Keep count of busy descendants on every ancestor so that
+        # can_acquire() doesn't have to walk the subtree
+        for i in nx.ancestors(self.resources, resource):
+            i.busy_descendants += delta
+
+    def __set_busy(self, resource, busy):
+        if resource.busy == busy:
+            return
+
+        resource.busy = busy
+        self.__propagate_busy(resource, 1 if busy else -1)
+
+    def __busy_subtree(self, resource):
+        subtree = nx.descendants(self.resources, resource)
+        subtree.add(resource)
+        return [i for i in subtree if i.busy]
+
+    def __remove_subtree(self, resource):
+        for i in self.__busy_subtree(resource):
+            self.__propagate_busy(i, -1)
+
+        for i in nx.descendants(self.resources, resource):
+            self.resources.remove_node(i)
+            self.index.pop(i.name, None)
+
+        self.resources.remove_node(resource)
+        self.index.pop(resource.name, None)
+
     def add_resource(self, resource, parents=None):
         with self.mutex:
             if not resource:
@@ -73,18 +104,26 @@ class ResourceGraph(object):
     
             if self.get_resource(resource.name):
                 raise ResourceError('Resource {0} already exists'.format(resource.name))
-    
-            self.resources.add_node(resource)
+
             if not parents:
                 parents = ['root']
-    
+
+            nodes = []
             for p in parents:
                 node = self.get_resource(p)
                 if not node:
                     raise ResourceError('Invalid parent resource {0}'.format(p))
-    
+
+                nodes.append(node)
+
+            self.resources.add_node(resource)
+            self.index[resource.name] = resource
+            for node in nodes:
                 self.resources.add_edge(node, resource)
 
+            if resource.busy:
+                self.__propagate_busy(resource, 1)
+
     def remove_resource(self, name):
         with self.mutex:
             resource = self.get_resource(name)
@@ -92,10 +131,7 @@ class ResourceGraph(object):
             if not resource:
                 return
     
-            for i in nx.descendants(self.resources, resource):
-                self.resources.remove_node(i)
-    
-            self.resources.remove_node(resource)
+            self.__remove_subtree(resource)
 
     def remove_resources(self, names):
         with self.mutex:
@@ -105,10 +141,7 @@ class ResourceGraph(object):
                 if not resource:
                     return
     
-                for i in nx.descendants(self.resources, resource):
-                    self.resources.remove_node(i)
-    
-                self.resources.remove_node(resource)
+                self.__remove_subtree(resource)
 
     def update_resource(self, name, new_parents):
         with self.mutex:
@@ -116,20 +149,27 @@ class ResourceGraph(object):
     
             if not resource:
                 return
-    
-            for i in self.resources.predecessors(resource):
+
+            busy = self.__busy_subtree(resource)
+            for i in busy:
+                self.__propagate_busy(i, -1)
+
+            for i in list(self.resources.predecessors(resource)):
                 self.resources.remove_edge(i, resource)
-    
-            for p in new_parents:
-                node = self.get_resource(p)
-                if not node:
-                    raise ResourceError('Invalid parent resource {0}'.format(p))
-    
-                self.resources.add_edge(node, resource)
+
+            try:
+                for p in new_parents:
+                    node = self.get_resource(p)
+                    if not node:
+                        raise ResourceError('Invalid parent resource {0}'.format(p))
+
+                    self.resources.add_edge(node, resource)
+            finally:
+                for i in busy:
+                    self.__propagate_busy(i, 1)
 
     def get_resource(self, name):
-        f = [i for i in self.resources.nodes() if i.name == name]
-        return f[0] if len(f) > 0 else None
+        return self.index.get(name)
 
     def get_resource_dependencies(self, name):
         res = self.get_resource(name)
@@ -148,11 +188,10 @@ class ResourceGraph(object):
                 if not res:
                     raise ResourceError('Resource {0} not found'.format(name))
     
-                for i in nx.descendants(self.resources, res):
-                    if i.busy:
-                        raise ResourceError('Cannot acquire, some of dependent resources are busy')
+                if res.busy_descendants:
+                    raise ResourceError('Cannot acquire, some of dependent resources are busy')
     
-                res.busy = True
+                self.__set_busy(res, True)
 
     def can_acquire(self, *names):
         if not names:
@@ -166,13 +205,9 @@ class ResourceGraph(object):
                 if not res:
                     return False
     
-                if res.busy:
+                if res.busy or res.busy_descendants:
                     return False
     
-                for i in nx.descendants(self.resources, res):
-                    if i.busy:
-                        return False
-    
             return True
 
     def release(self, *names):
@@ -184,4 +219,5 @@ class ResourceGraph(object):
     
             for name in names:
                 res = self.get_resource(name)
-                res.busy = False
+                if res:
+                    self.__set_busy(res, False)
@@ -165,7 +165,7 @@ def register_general_purpose_schemas(dispatcher):
             },
             'state': {
                 'type': 'string',
-                'enum': ['CREATED', 'WAITING', 'EXECUTING', 'ROLLBACK', 'FINISHED', 'FAILED', 'ABORTED']
+                'enum': ['CREATED', 'WAITING', 'ASSIGNING', 'EXECUTING', 'ROLLBACK', 'FINISHED', 'FAILED', 'ABORTED']
             },
             'output': {'type': 'string'},
             'warnings': {
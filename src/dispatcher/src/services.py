@@ -442,6 +442,12 @@ class TaskService(RpcService):
 
         return result
 
+    def get_executor_stats(self):
+        return self.__balancer.get_pool_stats()
+
+    def get_persistence_stats(self):
+        return self.__balancer.task_writer.get_stats()
+
     @private
     def register_task_hook(self, hook, task, condition=None):
         self.__dispatcher.register_task_hook(hook, task, condition)
@@ -0,0 +1,126 @@
+#+
+# Copyright 2014 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+
+import re
+import fnmatch
+
+
+WILDCARD_CHARS = re.compile(r'[*?\[]')
+
+
+class SubscriptionRegistry(object):
+    """
+    Index of event masks subscribed by connections.
+
+    Plain event names are kept in a hash table. Wildcard masks are compiled
+    to regular expressions once and bucketed by their literal prefix, so only
+    masks which can possibly match are tried. Results are memoized per event
+    name until the next subscription change.
+    """
+    def __init__(self, max_cached_names=4096):
+        self.exact = {}
+        self.patterns = {}
+        self.compiled = {}
+        self.match_cache = {}
+        self.max_cached_names = max_cached_names
+
+    def __len__(self):
+        return len(self.exact) + sum(len(i) for i in self.patterns.values())
+
+    @staticmethod
+    def split_mask(mask):
+        if not isinstance(mask, str):
+            # Precompiled regular expression
+            return None, mask
+
+        m = WILDCARD_CHARS.search(mask)
+        if not m:
+            return mask, None
+
+        return mask[:m.start()], re.compile(fnmatch.translate(mask))
+
+    def subscribe(self, conn, masks):
+        for mask in masks:
+            prefix, regex = self.split_mask(mask)
+            if regex is None:
+                self.exact.setdefault(mask, set()).add(conn)
+                continue
+
+            bucket = self.patterns.setdefault(prefix or '', {})
+            bucket.setdefault(mask, set()).add(conn)
+            self.compiled[mask] = regex
+
+        self.match_cache = {}
+
+    def unsubscribe(self, conn, masks):
+        for mask in masks:
+            prefix, regex = self.split_mask(mask)
+            table = self.exact if regex is None else self.patterns.get(prefix or '', {})
+            subscribers = table.get(mask)
+            if not subscribers:
+                continue
+
+            subscribers.discard(conn)
+            if not subscribers:
+                del table[mask]
+                if regex is not None:
+                    self.compiled.pop(mask, None)
+                    if not table:
+                        del self.patterns[prefix or '']
+
+        self.match_cache = {}
+
+    def remove(self, conn):
+        self.unsubscribe(conn, list(conn.event_masks))
+
+    def match(self, name):
+        result = self.match_cache.get(name)
+        if result is not None:
+            return result
+
+        result = set(self.exact.get(name, ()))
+        for prefix, bucket in self.patterns.items():
+            if not name.startswith(prefix):
+                continue
+
+            for mask, subscribers in bucket.items():
+                if subscribers <= result:
+                    continue
+
+                if self.compiled[mask].match(name):
+                    result |= subscribers
+
+        result = frozenset(result)
+        if len(self.match_cache) >= self.max_cached_names:
+            self.match_cache = {}
+
+        self.match_cache[name] = result
+        return result
+
+    def is_subscribed(self, conn, name):
+        return conn in self.match(name)
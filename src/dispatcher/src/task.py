@@ -37,6 +37,7 @@ import collections
 class TaskState(object):
     CREATED = 'CREATED'
     WAITING = 'WAITING'
+    ASSIGNING = 'ASSIGNING'
     EXECUTING = 'EXECUTING'
     ROLLBACK = 'ROLLBACK'
     FINISHED = 'FINISHED'
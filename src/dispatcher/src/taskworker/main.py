@@ -29,6 +29,10 @@
 import os
 import sys
 import errno
+import json
+import array
+import select
+import signal
 import setproctitle
 import socket
 import traceback
@@ -41,7 +45,7 @@ from freenas.dispatcher.fd import FileDescriptor
 from freenas.dispatcher.rpc import RpcService, RpcException, RpcWarning
 from freenas.utils import load_module_from_file, configure_logging, serialize_traceback
 from datastore import get_datastore
-from datastore.config import ConfigStore
+from datastore.config import ConfigStore, CachedConfigStore
 
 
 def serialize_error(err):
@@ -133,6 +137,115 @@ class TaskProxyService(RpcService):
         self.context.task.put(task)
 
 
+class ForkServer(object):
+    """
+    Imports task plugins once and forks ready-to-run task executors on
+    request of the dispatcher. Each request carries an executor key and
+    a file descriptor to be used as executor's stdout/stderr. Forked PID
+    and later its exit status are written back to the requesting socket.
+    """
+    def __init__(self, context, path):
+        self.context = context
+        self.path = path
+        self.sock = None
+        self.children = {}
+
+    def preload(self):
+        for filename in json.load(sys.stdin):
+            name, _ = os.path.splitext(os.path.basename(filename))
+            try:
+                self.context.module_cache[filename] = load_module_from_file(name, filename)
+            except BaseException as err:
+                print('Cannot preload {0}: {1}'.format(filename, str(err)), flush=True)
+
+    def spawn(self, conn):
+        fds = array.array('i')
+        msg, ancdata, _, _ = conn.recvmsg(1024, socket.CMSG_LEN(fds.itemsize))
+        for level, type, data in ancdata:
+            if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+                fds.frombytes(data[:fds.itemsize])
+
+        key = msg.decode('utf-8').strip()
+        if not key or not fds:
+            conn.close()
+            return
+
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                self.sock.close()
+                conn.close()
+                for c in self.children.values():
+                    c.close()
+
+                os.setpgrp()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                os.dup2(fds[0], sys.stdout.fileno())
+                os.dup2(fds[0], sys.stderr.fileno())
+                os.close(fds[0])
+                self.context.run(key)
+            except SystemExit as err:
+                code = err.code if isinstance(err.code, int) else 1
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                sys.stdout.flush()
+                os._exit(code)
+
+        os.close(fds[0])
+        conn.sendall('{0}\n'.format(pid).encode('utf-8'))
+        self.children[pid] = conn
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+
+            if pid == 0:
+                return
+
+            conn = self.children.pop(pid, None)
+            if not conn:
+                continue
+
+            code = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            with contextlib.suppress(OSError):
+                conn.sendall('{0}\n'.format(code).encode('utf-8'))
+
+            conn.close()
+
+    def serve(self):
+        setproctitle.setproctitle('task executor fork server')
+        self.preload()
+
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path)
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self.sock.listen(64)
+        print('READY', flush=True)
+
+        # Exit together with the dispatcher
+        while os.getppid() != 1:
+            r, _, _ = select.select([self.sock], [], [], 1.0)
+            if r:
+                conn, _ = self.sock.accept()
+                try:
+                    self.spawn(conn)
+                except OSError as err:
+                    print('Cannot fork task executor: {0}'.format(str(err)), flush=True)
+                    conn.close()
+
+            self.reap()
+
+
 class Context(object):
     def __init__(self):
         self.service = TaskProxyService(self)
@@ -162,6 +275,13 @@ class Context(object):
         if self.instance:
             self.instance.task_progress_handler(args)
 
+    def config_set_handler(self, keys):
+        self.conn.emit_event('config.changed', {'keys': keys, 'pid': os.getpid()})
+
+    def config_changed_handler(self, args):
+        if args.get('pid') != os.getpid():
+            self.configstore.invalidate(args.get('keys'))
+
     def collect_fds(self, obj):
         if isinstance(obj, dict):
             for v in obj.values():
@@ -196,22 +316,31 @@ class Context(object):
             instance.join_subtasks(instance.run_subtask(hook, *task['args'], **extra_env))
 
     def main(self):
+        if len(sys.argv) == 3 and sys.argv[1] == '--forkserver':
+            ForkServer(self, sys.argv[2]).serve()
+            return
+
         if len(sys.argv) != 2:
             print("Invalid number of arguments", file=sys.stderr)
             sys.exit(errno.EINVAL)
 
-        key = sys.argv[1]
+        self.run(sys.argv[1])
+
+    def run(self, key):
         configure_logging(None, logging.DEBUG)
 
         self.datastore = get_datastore()
-        self.configstore = ConfigStore(self.datastore)
         self.conn = Client()
         self.conn.connect('unix:')
         self.conn.login_service('task.{0}'.format(os.getpid()))
+        self.configstore = ConfigStore(self.datastore, notifier=self.config_set_handler)
+        if self.configstore.get('middleware.config_cache'):
+            self.configstore = CachedConfigStore(self.datastore, notifier=self.config_set_handler)
         self.conn.enable_server()
         self.conn.call_sync('management.enable_features', ['streaming_responses'])
         self.conn.rpc.register_service_instance('taskproxy', self.service)
         self.conn.register_event_handler('task.progress', self.task_progress_handler)
+        self.conn.register_event_handler('config.changed', self.config_changed_handler)
         self.conn.call_sync('task.checkin', key)
         setproctitle.setproctitle('task executor (idle)')
 
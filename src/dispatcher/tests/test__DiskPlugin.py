@@ -0,0 +1,136 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+######################################################################
+
+
+import os
+import sys
+import unittest
+import gevent
+import gevent.lock
+from xml.etree import ElementTree
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'plugins'))
+from DiskPlugin import GeomEventBatcher  # noqa
+
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def load_confxml(name):
+    # Maps DISK geom names to their ident from a recorded kern.geom.confxml
+    root = ElementTree.parse(os.path.join(FIXTURES, name)).getroot()
+    return {
+        g.find('name').text: g.find('provider/config/ident').text
+        for c in root.findall('class') if c.find('name').text == 'DISK'
+        for g in c.findall('geom')
+    }
+
+
+class FakeDispatcher(object):
+    def __init__(self):
+        self.locks = {}
+
+    def threaded(self, fn, *args):
+        return fn(*args)
+
+    def get_lock(self, name):
+        return self.locks.setdefault(name, gevent.lock.RLock())
+
+
+class ReplayBatcher(GeomEventBatcher):
+    """
+    Replays confxml snapshots, one per GEOM scan, and records the disks
+    every handler sees in the current snapshot
+    """
+    def __init__(self, *snapshots):
+        super(ReplayBatcher, self).__init__(FakeDispatcher(), scan=self.replay, interval=0.05)
+        self.snapshots = [load_confxml(i) for i in snapshots]
+        self.snapshot = None
+        self.ops = []
+
+    def replay(self):
+        self.snapshot = self.snapshots.pop(0)
+
+    def record(self, op, path):
+        self.ops.append((op, path, self.snapshot.get(os.path.basename(path))))
+
+    def attach(self, path):
+        self.record('attach', path)
+
+    def detach(self, path):
+        self.record('detach', path)
+
+    def mediachange(self, path):
+        self.record('mediachange', path)
+
+    def submit_all(self, events):
+        gevent.joinall([gevent.spawn(self.submit, op, path) for op, path in events])
+
+
+class TestGeomEventBatcher(unittest.TestCase):
+    def test_boot_burst(self):
+        batcher = ReplayBatcher('confxml-boot.xml')
+        disks = load_confxml('confxml-boot.xml')
+        batcher.submit_all(('attach', '/dev/' + i) for i in disks)
+
+        self.assertEqual(batcher.scans, 1)
+        self.assertEqual(
+            sorted(batcher.ops),
+            sorted(('attach', '/dev/' + name, ident) for name, ident in disks.items())
+        )
+
+    def test_mediachange_after_attach(self):
+        batcher = ReplayBatcher('confxml-boot.xml')
+        batcher.submit_all([('attach', '/dev/ada0'), ('mediachange', '/dev/ada0')])
+
+        self.assertEqual(batcher.ops, [('attach', '/dev/ada0', 'WD-WCC4M1KX0A1E')])
+
+    def test_detach_after_attach(self):
+        batcher = ReplayBatcher('confxml-boot.xml')
+        batcher.submit_all([('attach', '/dev/da1'), ('detach', '/dev/da1')])
+
+        self.assertEqual(batcher.ops, [('detach', '/dev/da1', 'Z1Z3A9TT')])
+
+    def test_replaced_disk(self):
+        # da1 is pulled and a different disk is inserted within the window,
+        # the stale cache entry has to be purged before the new one is built
+        batcher = ReplayBatcher('confxml-boot.xml', 'confxml-da1-replaced.xml')
+        batcher.submit_all([('attach', '/dev/da1')])
+        batcher.submit_all([('detach', '/dev/da1'), ('mediachange', '/dev/da0'), ('attach', '/dev/da1')])
+
+        self.assertEqual(batcher.scans, 2)
+        self.assertEqual([i for i in batcher.ops if i[1] == '/dev/da1'], [
+            ('attach', '/dev/da1', 'Z1Z3A9TT'),
+            ('detach', '/dev/da1', 'K4KAB2XB'),
+            ('attach', '/dev/da1', 'K4KAB2XB'),
+        ])
+        self.assertIn(('mediachange', '/dev/da0', 'Z1Z3A8KM'), batcher.ops)
+
+
+if __name__ == '__main__':
+    unittest.main()
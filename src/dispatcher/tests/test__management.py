@@ -35,3 +35,9 @@ class TestConnectionStreamingFeature(BaseTestCase):
         self.assertIn('streaming_responses', self.client.call_sync('management.get_enabled_features'))
         iterator = self.client.call_sync('user.query')
         self.assertIsInstance(iterator, StreamingResultIterator)
+
+
+class TestConnectionEntityDeltasFeature(BaseTestCase):
+    def test_enable(self):
+        self.client.call_sync('management.enable_features', ['entity_deltas'])
+        self.assertIn('entity_deltas', self.client.call_sync('management.get_enabled_features'))
@@ -0,0 +1,180 @@
+#+
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+
+"""
+etcd generate_all benchmark. Builds a plugin directory of synthetic mako
+templates and a set of groups which, like the real ones, pull in a shared
+'services' group, then times FileGenerationService.generate_all against a
+fake dispatcher client with simulated RPC latency. Also times the former
+serial, recompile-and-rewrite-everything implementation on the same data.
+
+Usage: python3 generate_all.py [-g 30] [-f 3] [-l 0.002]
+"""
+
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+from mako.template import Template
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import main  # noqa
+
+
+TEMPLATE = """\
+<%
+    items = dispatcher.call_sync('bench.query', '@NAME@')
+%>\\
+${disclaimer()}
+% for i in items:
+${i['name']} = "${i['value']}"
+% endfor
+"""
+
+
+class FakeDatastore(object):
+    def __init__(self, groups):
+        self.groups = groups
+
+    def query(self, collection, *filter):
+        return list(self.groups.values())
+
+    def get_one(self, collection, *filter):
+        _, _, name = filter[0]
+        return self.groups.get(name)
+
+
+class FakeClient(object):
+    def __init__(self, latency):
+        self.latency = latency
+        self.values = {}
+        self.events = 0
+
+    def call_sync(self, method, name):
+        time.sleep(self.latency)
+        return [{'name': 'key{0}'.format(i), 'value': self.values.get((name, i), i)} for i in range(50)]
+
+    def emit_event(self, name, params):
+        self.events += 1
+
+
+def generate(plugin_dir, groups, files):
+    result = {'services': {'name': 'services', 'dependencies': ['file:rc.conf']}}
+    names = ['rc.conf']
+    for g in range(groups):
+        deps = ['group:services']
+        for f in range(files):
+            name = 'local/group{0}/file{1}.conf'.format(g, f)
+            names.append(name)
+            deps.append('file:{0}'.format(name))
+
+        result['group{0}'.format(g)] = {'name': 'group{0}'.format(g), 'dependencies': deps}
+
+    for name in names:
+        path = os.path.join(plugin_dir, name + '.mako')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(TEMPLATE.replace('@NAME@', name))
+
+    return result
+
+
+def legacy_generate_all(context):
+    # Former implementation: serial, compiles every template on each
+    # render and rewrites every file
+    def generate_group(name):
+        group = context.datastore.get_one('etcd.groups', ('name', '=', name))
+        for i in group['dependencies']:
+            typ, fname = i.split(':')
+            if typ == 'file':
+                renderer = context.renderers['.mako']
+                text = Template(filename=context.managed_files[fname]).render(**renderer.get_template_context())
+                with open(os.path.join(context.root, fname), 'w', encoding='utf-8') as fd:
+                    fd.write(text)
+                context.emit_event('etcd.file_generated', {'filename': fname})
+            elif typ == 'group':
+                generate_group(fname)
+
+    for group in context.datastore.query('etcd.groups'):
+        generate_group(group['name'])
+
+
+def run(label, fn, client):
+    events = client.events
+    start = time.perf_counter()
+    fn()
+    print('{0}: {1:.3f}s, {2} files written'.format(label, time.perf_counter() - start, client.events - events))
+
+
+def main_():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-g', metavar='GROUPS', type=int, default=30)
+    parser.add_argument('-f', metavar='FILES', type=int, default=3, help='Files per group')
+    parser.add_argument('-l', metavar='LATENCY', type=float, default=0.002, help='Simulated RPC latency in seconds')
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        plugin_dir = os.path.join(tmpdir, 'plugins')
+        root = os.path.join(tmpdir, 'etc')
+        groups = generate(plugin_dir, args.g, args.f)
+        for i in groups.values():
+            for dep in i['dependencies']:
+                typ, name = dep.split(':')
+                if typ == 'file':
+                    os.makedirs(os.path.dirname(os.path.join(root, name)), exist_ok=True)
+
+        context = main.Main()
+        context.root = root
+        context.plugin_dirs = [plugin_dir]
+        context.datastore = FakeDatastore(groups)
+        context.client = FakeClient(args.l)
+        context.scan_plugins()
+        context.init_renderers()
+        service = main.FileGenerationService(context)
+        print('{0} groups, {1} managed files'.format(len(groups), len(context.managed_files)))
+
+        run('legacy', lambda: legacy_generate_all(context), context.client)
+        shutil.rmtree(root)
+        for i in context.managed_files:
+            os.makedirs(os.path.dirname(os.path.join(root, i)), exist_ok=True)
+
+        run('generate_all (cold)', service.generate_all, context.client)
+        run('generate_all (unchanged)', service.generate_all, context.client)
+        context.client.values[('rc.conf', 0)] = 'changed'
+        run('generate_all (one file changed)', service.generate_all, context.client)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main_()
@@ -28,6 +28,7 @@
 
 import os
 import sys
+import stat
 import socket
 import logging
 import argparse
@@ -36,8 +37,10 @@ import errno
 import datastore
 import time
 import imp
+import tempfile
 import setproctitle
 import renderers
+from concurrent.futures import ThreadPoolExecutor
 from datastore.config import ConfigStore
 from freenas.dispatcher.client import Client, ClientError
 from freenas.dispatcher.rpc import RpcService, RpcException
@@ -46,6 +49,7 @@ from freenas.utils.debug import DebugService
 
 
 DEFAULT_CONFIGFILE = '/usr/local/etc/middleware.conf'
+GENERATE_WORKERS = 8
 TEMPLATE_RENDERERS = {
     '.mako': renderers.MakoTemplateRenderer,
     '.py': renderers.PythonRenderer,
@@ -70,25 +74,36 @@ class FileGenerationService(RpcService):
         self.datastore = ctx.datastore
 
     def generate_all(self):
+        # Every file or plugin is generated once, by the first group that
+        # depends on it, and groups are processed concurrently
+        seen = set()
+        batches = []
         for group in self.datastore.query('etcd.groups'):
-            self.generate_group(group['name'])
+            deps = [i for i in self.context.resolve_group(group['name']) if i not in seen]
+            seen.update(deps)
+            if deps:
+                batches.append(deps)
+
+        with ThreadPoolExecutor(GENERATE_WORKERS) as executor:
+            return [f for changed in executor.map(self.generate_dependencies, batches) for f in changed]
 
     def generate_file(self, filename):
         if filename not in self.context.managed_files.keys():
-            return
+            return False
 
         text = self.context.generate_file(filename)
         filepath = os.path.join(self.context.root, filename)
         try:
-            with open(filepath, 'w', encoding='utf-8') as fd:
-                fd.write(text)
+            if not self.context.write_file(filepath, text):
+                return False
         except FileNotFoundError as e:
             self.context.logger.error('Failed to open {0}: {1}'.format(filepath, e), exc_info=True)
-            return
+            return False
 
         self.context.emit_event('etcd.file_generated', {
             'filename': filepath,
         })
+        return True
 
     def generate_plugin(self, name):
         if name not in self.context.managed_files.keys():
@@ -111,19 +126,18 @@ class FileGenerationService(RpcService):
             self.context.logger.error('Cannot run plugin {0}: {1}'.format(name, str(err)), exc_info=True)
 
     def generate_group(self, name):
-        group = self.datastore.get_one('etcd.groups', ('name', '=', name))
-        if not group:
-            raise RpcException(errno.ENOENT, 'Group {0} not found'.format(name))
-
-        for i in group['dependencies']:
-            typ, fname = i.split(':')
+        return self.generate_dependencies(self.context.resolve_group(name))
 
+    def generate_dependencies(self, deps):
+        changed = []
+        for typ, fname in deps:
             if typ == 'file':
-                self.generate_file(fname)
+                if self.generate_file(fname):
+                    changed.append(os.path.join(self.context.root, fname))
             elif typ == 'plugin':
                 self.generate_plugin(fname)
-            elif typ == 'group':
-                self.generate_group(fname)
+
+        return changed
 
     def get_managed_files(self):
         return self.context.managed_files
@@ -218,6 +232,57 @@ class Main(object):
                     self.managed_files[name] = abspath
                     self.logger.info('Adding managed file %s [%s]', name, ext)
 
+    def resolve_group(self, name, visited=None):
+        # Flattens nested groups into an ordered list of (type, name) pairs
+        visited = visited if visited is not None else set()
+        group = self.datastore.get_one('etcd.groups', ('name', '=', name))
+        if not group:
+            raise RpcException(errno.ENOENT, 'Group {0} not found'.format(name))
+
+        visited.add(name)
+        result = []
+        for i in group['dependencies']:
+            typ, fname = i.split(':')
+            if typ == 'group':
+                if fname not in visited:
+                    result.extend(d for d in self.resolve_group(fname, visited) if d not in result)
+            elif (typ, fname) not in result:
+                result.append((typ, fname))
+
+        return result
+
+    def write_file(self, filepath, text):
+        # Atomically replaces filepath with text, unless it's already there.
+        # Returns True if the file has been written.
+        data = text.encode('utf-8')
+        filepath = os.path.realpath(filepath)
+        try:
+            st = os.stat(filepath)
+            if st.st_size == len(data):
+                with open(filepath, 'rb') as fd:
+                    if fd.read() == data:
+                        return False
+        except FileNotFoundError:
+            st = None
+
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(filepath), prefix='.{0}.'.format(os.path.basename(filepath)))
+        try:
+            with open(fd, 'wb') as f:
+                f.write(data)
+
+            if st:
+                os.chmod(tmppath, stat.S_IMODE(st.st_mode))
+                os.chown(tmppath, st.st_uid, st.st_gid)
+            else:
+                os.chmod(tmppath, 0o644)
+
+            os.rename(tmppath, filepath)
+        except:
+            os.unlink(tmppath)
+            raise
+
+        return True
+
     def generate_file(self, file_path):
         if file_path not in self.managed_files.keys():
             raise RpcException(errno.ENOENT, 'No such file')
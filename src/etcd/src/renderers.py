@@ -25,7 +25,8 @@
 #
 #####################################################################
 
-
+import os
+import threading
 from mako import exceptions
 from mako.template import Template
 from datastore.config import ConfigStore
@@ -40,6 +41,8 @@ class TemplateFunctions:
 class MakoTemplateRenderer(object):
     def __init__(self, context):
         self.context = context
+        self.cache = {}
+        self.lock = threading.Lock()
 
     def get_template_context(self):
         return {
@@ -49,9 +52,24 @@ class MakoTemplateRenderer(object):
             "ds": self.context.datastore
         }
 
+    def get_template(self, path):
+        # Compiled templates are reused until the source file changes
+        st = os.stat(path)
+        key = (st.st_mtime_ns, st.st_size)
+        with self.lock:
+            entry = self.cache.get(path)
+            if entry and entry[0] == key:
+                return entry[1]
+
+        tmpl = Template(filename=path)
+        with self.lock:
+            self.cache[path] = (key, tmpl)
+
+        return tmpl
+
     def render_template(self, path):
         try:
-            tmpl = Template(filename=path)
+            tmpl = self.get_template(path)
             return tmpl.render(**self.get_template_context())
         except:
             self.context.logger.debug('Failed to render mako template: {0}'.format(
@@ -0,0 +1,145 @@
+#+
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+
+"""
+Ingestion benchmark for fnstatd. Generates graphite plaintext input like
+the one collectd sends (one line per metric per interval) and feeds it
+through InputServer.ingest(), comparing it with the former line-by-line
+DataSource.submit() path.
+
+Usage: python3 ingest.py [-s 2000] [-i 60]
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tables
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import main as fnstatd  # noqa
+
+
+SCHEMA = {
+    'buckets': [
+        {'interval': '10s', 'retention': '1h'},
+        {'interval': '1m', 'retention': '1d'}
+    ]
+}
+
+
+class FakeClient(object):
+    def emit_event(self, name, args):
+        pass
+
+    def call_sync(self, *args):
+        pass
+
+
+class FakeConfig(fnstatd.DataSourceConfig):
+    def __init__(self):
+        self.buckets = [fnstatd.DataSourceBucket(idx, i) for idx, i in enumerate(SCHEMA['buckets'])]
+        self.primary_bucket = self.buckets[0]
+
+
+class Context(object):
+    def __init__(self, hdf):
+        self.hdf = hdf
+        self.hdf_group = hdf.create_group('/', 'stats')
+        self.client = FakeClient()
+        self.logger = fnstatd.logging.getLogger('bench')
+        self.data_sources = {}
+
+    def request_table(self, name):
+        return self.hdf.create_table(self.hdf_group, name.replace('.', '_'), fnstatd.DataPoint, name)
+
+    def request_buffer(self, name, size):
+        return fnstatd.PersistentRingBuffer(self.request_table(name), size)
+
+    def get_data_source(self, name):
+        if name not in self.data_sources:
+            alerts = {'alert_high_enabled': False, 'alert_low_enabled': False}
+            self.data_sources[name] = fnstatd.DataSource(self, name, FakeConfig(), alerts)
+
+        return self.data_sources[name]
+
+
+def generate(sources, intervals, start=1500000000):
+    for i in range(intervals):
+        ts = start + i * 10
+        yield ''.join(
+            'localhost.metric-{0}.value {1} {2}\n'.format(s, float(s * i), ts) for s in range(sources)
+        ).encode('utf-8')
+
+
+def run(name, sources, intervals, ingest):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        hdf = tables.open_file(os.path.join(tmpdir, 'stats.hdf'), mode='w')
+        context = Context(hdf)
+        server = fnstatd.InputServer.__new__(fnstatd.InputServer)
+        server.context = context
+
+        # Create data sources up front, that's not what's being measured
+        for s in range(sources):
+            context.get_data_source('localhost.metric-{0}.value'.format(s))
+
+        payload = list(generate(sources, intervals))
+        start = time.perf_counter()
+        for data in payload:
+            ingest(server, context, data)
+
+        elapsed = time.perf_counter() - start
+        hdf.close()
+
+    samples = sources * intervals
+    print('{0}: {1} samples in {2:.2f}s ({3:.0f} samples/s)'.format(name, samples, elapsed, samples / elapsed))
+
+
+def ingest_lines(server, context, data):
+    for line in data.decode('utf-8').splitlines():
+        name, value, timestamp = line.split()
+        context.get_data_source(name).submit(int(timestamp), float(value))
+
+
+def ingest_batched(server, context, data):
+    server.ingest(data.split(b'\n'))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', metavar='SOURCES', type=int, default=2000)
+    parser.add_argument('-i', metavar='INTERVALS', type=int, default=60)
+    args = parser.parse_args()
+
+    run('line by line', args.s, args.i, ingest_lines)
+    run('batched', args.s, args.i, ingest_batched)
+
+
+if __name__ == '__main__':
+    main()
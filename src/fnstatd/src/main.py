@@ -51,20 +51,19 @@ from gevent.server import StreamServer
 from freenas.dispatcher.client import Client, ClientError
 from freenas.dispatcher.rpc import RpcService, RpcException, accepts, returns, generator
 from datastore import DatastoreException, get_datastore
-from ringbuffer import MemoryRingBuffer, PersistentRingBuffer
+from datastore.config import ConfigStore
+from ringbuffer import MemoryRingBuffer, PersistentRingBuffer, MappedRingBuffer, Consolidator
 from freenas.utils.debug import DebugService
 from freenas.utils import configure_logging, to_timedelta, materialized_paths_to_tree
 
 
 DEFAULT_CONFIGFILE = '/usr/local/etc/middleware.conf'
 DEFAULT_DBFILE = 'stats.hdf'
+INPUT_CHUNK_SIZE = 256 * 1024
+STORAGE_FLUSH_INTERVAL = 30
 threadpool = gevent.threadpool.ThreadPool(5)
 
 
-def round_timestamp(timestamp, frequency):
-    return int(frequency * round(float(timestamp) / frequency))
-
-
 def parse_datetime(s):
     return dateutil.parser.parse(s)
 
@@ -130,6 +129,7 @@ class DataSource(object):
         self.logger = logging.getLogger('DataSource:{0}'.format(self.name))
         self.bucket_buffers = self.create_buckets()
         self.primary_buffer = self.bucket_buffers[0]
+        self.consolidators = {b.index: Consolidator(b.consolidation) for b in self.config.buckets[1:]}
         self.primary_interval = self.config.buckets[0].interval
         self.last_value = 0
         self.events_enabled = False
@@ -139,23 +139,53 @@ class DataSource(object):
         # Primary bucket should be hold in memory
         buckets = [MemoryRingBuffer(self.config.buckets[0].intervals_count)]
 
-        # And others saved to HDF5 file
+        # And others saved to persistent storage
         for idx, b in enumerate(self.config.buckets[1:]):
-            table = self.context.request_table('{0}#b{1}'.format(self.name, idx))
-            buckets.append(PersistentRingBuffer(table, b.intervals_count))
+            buckets.append(self.context.request_buffer('{0}#b{1}'.format(self.name, idx), b.intervals_count))
 
         self.logger.debug('Created {0} buckets'.format(len(buckets)))
         return buckets
 
     def submit(self, timestamp, value):
-        timestamp = round_timestamp(timestamp, self.config.primary_interval.total_seconds())
-        change = None
-        self.primary_buffer.push(timestamp, value)
+        self.submit_many([timestamp], [value])
+
+    def submit_many(self, timestamps, values):
+        # Pushes a batch of samples, then evaluates events and alerts once
+        # against the last one
+        frequency = self.config.primary_interval.total_seconds()
+        timestamps = (np.round(np.asarray(timestamps, dtype=float) / frequency) * frequency).astype(np.int64)
+        values = np.asarray(values, dtype=float)
+        if not len(timestamps):
+            return
 
+        # Split the batch on coarser bucket boundaries so every bucket gets
+        # persisted with the data up to its own timestamp
+        due = np.zeros(len(timestamps), dtype=bool)
         for b in self.config.buckets[1:]:
-            if timestamp % b.interval.total_seconds() == 0:
-                self.persist(timestamp, self.bucket_buffers[b.index], b)
+            due |= timestamps % int(b.interval.total_seconds()) == 0
+
+        start = 0
+        for idx in np.flatnonzero(due):
+            self.push(timestamps[start:idx + 1], values[start:idx + 1])
+            start = idx + 1
+            timestamp = int(timestamps[idx])
+            for b in self.config.buckets[1:]:
+                if timestamp % b.interval.total_seconds() == 0:
+                    self.persist(timestamp, self.bucket_buffers[b.index], b)
+
+        self.push(timestamps[start:], values[start:])
+        self.update_value(float(values[-1]))
+
+    def push(self, timestamps, values):
+        if not len(timestamps):
+            return
+
+        self.primary_buffer.push_many(timestamps.astype('M8[s]'), values)
+        for c in self.consolidators.values():
+            c.add_many(values)
 
+    def update_value(self, value):
+        change = None
         if math.isnan(value):
             value = None
 
@@ -188,13 +218,13 @@ class DataSource(object):
                         self.emit_alert_low()
 
     def persist(self, timestamp, buffer, bucket):
-        def doit():
-            count = bucket.interval.total_seconds() / self.config.buckets[0].interval.total_seconds()
-            data = self.bucket_buffers[0].data
-            mean = np.mean(list(zip(*data[-count:]))[1])
-            buffer.push(timestamp, mean)
+        consolidator = self.consolidators[bucket.index]
+        buffer.push(timestamp, consolidator.value)
+        consolidator.reset()
 
-        threadpool.apply(doit)
+    def flush(self):
+        for b in self.bucket_buffers[1:]:
+            b.flush()
 
     def query(self, start, end, frequency):
         self.logger.debug('Query: start={0}, end={1}, frequency={2}'.format(start, end, frequency))
@@ -272,19 +302,52 @@ class InputServer(object):
         gevent.kill(self.thread)
 
     def handle(self, socket, address):
-        fd = socket.makefile()
+        remainder = b''
         while True:
-            line = fd.readline()
-            if not line:
+            chunk = socket.recv(INPUT_CHUNK_SIZE)
+            if not chunk:
                 break
 
-            name, value, timestamp = line.split()
-            ds = self.context.get_data_source(name)
-            ds.submit(int(timestamp), float(value))
+            lines = (remainder + chunk).split(b'\n')
+            remainder = lines.pop()
+            self.ingest(lines)
+
+        if remainder:
+            self.ingest([remainder])
 
         socket.shutdown(gevent.socket.SHUT_RDWR)
         socket.close()
 
+    def ingest(self, lines):
+        # Groups a chunk of graphite plaintext lines per data source, so
+        # values are converted and submitted in one go per source
+        batch = {}
+        for line in lines:
+            fields = line.split()
+            if len(fields) != 3:
+                if fields:
+                    self.context.logger.warning('Malformed input line: {0}'.format(line))
+                continue
+
+            name, value, timestamp = fields
+            samples = batch.get(name)
+            if samples is None:
+                samples = batch[name] = ([], [])
+
+            samples[0].append(timestamp)
+            samples[1].append(value)
+
+        for name, (timestamps, values) in batch.items():
+            try:
+                timestamps = np.array(timestamps).astype(float)
+                values = np.array(values).astype(float)
+            except ValueError:
+                self.context.logger.warning('Malformed values for data source {0}'.format(name))
+                continue
+
+            ds = self.context.get_data_source(name.decode('utf-8'))
+            ds.submit_many(timestamps, values)
+
 
 class OutputService(RpcService):
     def __init__(self, context):
@@ -425,6 +488,10 @@ class Main(object):
         self.client = None
         self.server = None
         self.datastore = None
+        self.configstore = None
+        self.storage = None
+        self.directory = None
+        self.flush_thread = None
         self.hdf = None
         self.hdf_group = None
         self.config = None
@@ -438,6 +505,8 @@ class Main(object):
             self.logger.error('Cannot initialize datastore: %s', str(err))
             sys.exit(1)
 
+        self.configstore = ConfigStore(self.datastore)
+
     def init_database(self):
         # adding this try/except till system-dataset plugin is added back in in full fidelity
         # just a hack (since that directory's data will not persist)
@@ -448,12 +517,45 @@ class Main(object):
             directory = '/var/tmp/statd'
             if not os.path.exists(directory):
                 os.makedirs(directory)
+
+        self.directory = directory
+        self.storage = self.configstore.get('middleware.statd_storage') or 'hdf5'
+        self.logger.info('Using {0} storage for coarse buckets'.format(self.storage))
+
+        if self.storage == 'mmap':
+            os.makedirs(os.path.join(directory, 'stats'), exist_ok=True)
+            return
+
         self.hdf = tables.open_file(os.path.join(directory, DEFAULT_DBFILE), mode='a')
         if not hasattr(self.hdf.root, 'stats'):
             self.hdf.create_group('/', 'stats')
 
         self.hdf_group = self.hdf.root.stats
 
+    def request_buffer(self, name, size):
+        if self.storage == 'mmap':
+            path = os.path.join(self.directory, 'stats', '{0}.ring'.format(name.replace('/', '_')))
+            return MappedRingBuffer(path, size)
+
+        return PersistentRingBuffer(self.request_table(name), size)
+
+    def flush_storage(self):
+        if self.storage == 'mmap':
+            # msync() of many files may take a while, keep it off the event loop
+            threadpool.apply(lambda: [ds.flush() for ds in list(self.data_sources.values())])
+            return
+
+        if self.hdf:
+            self.hdf.flush()
+
+    def flush_storage_thread(self):
+        while True:
+            gevent.sleep(STORAGE_FLUSH_INTERVAL)
+            try:
+                self.flush_storage()
+            except Exception as err:
+                self.logger.error('Cannot flush statistics storage: {0}'.format(str(err)))
+
     def request_table(self, name):
         try:
             if hasattr(self.hdf_group, name):
@@ -534,6 +636,7 @@ class Main(object):
     def die(self):
         self.logger.warning('Exiting')
         self.server.stop()
+        self.flush_storage()
         self.client.disconnect()
         sys.exit(0)
 
@@ -558,6 +661,7 @@ class Main(object):
         self.init_dispatcher()
         self.init_database()
         self.server.start()
+        self.flush_thread = gevent.spawn(self.flush_storage_thread)
         self.logger.info('Started')
         self.client.wait_forever()
 
@@ -26,11 +26,68 @@
 #####################################################################
 
 
+import os
 import time
 import numpy as np
 import pandas as pd
 
 
+MAPPED_MAGIC = b'FNSRING1'
+MAPPED_HEADER = np.dtype([('magic', 'S8'), ('size', '<i8'), ('head', '<i8'), ('tail', '<i8')])
+MAPPED_RECORD = np.dtype([('timestamp', '<i8'), ('value', '<f8')])
+
+
+class Consolidator(object):
+    # Running aggregate of the samples falling into a single slot of
+    # a coarser bucket, so downsampling doesn't need to look back at
+    # the primary buffer
+    def __init__(self, function='avg'):
+        self.function = function or 'avg'
+        self.reset()
+
+    def reset(self):
+        self.sum = 0.0
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.last = None
+
+    def add_many(self, values):
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return
+
+        vmin = float(values.min())
+        vmax = float(values.max())
+        self.sum += float(values.sum())
+        self.count += len(values)
+        self.min = vmin if self.min is None else min(self.min, vmin)
+        self.max = vmax if self.max is None else max(self.max, vmax)
+        self.last = float(values[-1])
+
+    @property
+    def value(self):
+        if not self.count:
+            return float('nan')
+
+        if self.function == 'avg':
+            return self.sum / self.count
+
+        if self.function == 'sum':
+            return self.sum
+
+        if self.function == 'min':
+            return self.min
+
+        if self.function == 'max':
+            return self.max
+
+        if self.function == 'last':
+            return self.last
+
+        raise ValueError('Unknown consolidation function {0}'.format(self.function))
+
+
 class MemoryRingBuffer(object):
     def __init__(self, size):
         self.store = np.zeros(size, dtype='M8[s],f8')
@@ -78,6 +135,29 @@ class MemoryRingBuffer(object):
         if self.head == self.tail:
             self.head = (self.head + 1) % self.size
 
+    def push_many(self, timestamps, values):
+        # Same result as calling push() for every sample, but done with
+        # (at most) two slice assignments
+        count = len(timestamps)
+        if not count:
+            return
+
+        used = (self.tail - self.head) % self.size
+        tail = (self.tail + count) % self.size
+        if count > self.size:
+            timestamps = timestamps[-self.size:]
+            values = values[-self.size:]
+
+        start = (tail - len(timestamps)) % self.size
+        first = min(len(timestamps), self.size - start)
+        self.store['timestamp'][start:start + first] = timestamps[:first]
+        self.store['value'][start:start + first] = values[:first]
+        self.store['timestamp'][:len(timestamps) - first] = timestamps[first:]
+        self.store['value'][:len(timestamps) - first] = values[first:]
+
+        self.tail = tail
+        self.head = (tail - min(used + count, self.size - 1)) % self.size
+
     def pop(self):
         pass
 
@@ -133,12 +213,113 @@ class PersistentRingBuffer(object):
         self.table.flush()
 
     def push(self, timestamp, value):
+        # Flushing is left to flush(), called periodically for the whole file
         self.table[self.table.attrs.tail] = (timestamp, value)
         self.table.attrs.tail = (self.table.attrs.tail + 1) % self.size
         if self.table.attrs.head == self.table.attrs.tail:
             self.table.attrs.head = (self.table.attrs.head + 1) % self.size
 
+    def flush(self):
         self.table.flush()
 
     def pop(self):
         pass
+
+
+class MappedRingBuffer(object):
+    # Ring buffer kept in a memory-mapped file of fixed width records.
+    # Pushes only touch memory, flush() syncs dirty pages to disk.
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.dirty = False
+
+        if not self.valid():
+            self.create()
+
+        self.header = np.memmap(path, dtype=MAPPED_HEADER, mode='r+', shape=(1,))
+        self.store = np.memmap(path, dtype=MAPPED_RECORD, mode='r+', offset=MAPPED_HEADER.itemsize, shape=(size,))
+
+    def valid(self):
+        try:
+            with open(self.path, 'rb') as f:
+                header = np.frombuffer(f.read(MAPPED_HEADER.itemsize), dtype=MAPPED_HEADER)
+        except OSError:
+            return False
+
+        if len(header) != 1 or header[0]['magic'] != MAPPED_MAGIC or header[0]['size'] != self.size:
+            return False
+
+        return os.path.getsize(self.path) == MAPPED_HEADER.itemsize + self.size * MAPPED_RECORD.itemsize
+
+    def create(self):
+        header = np.zeros(1, dtype=MAPPED_HEADER)
+        header[0] = (MAPPED_MAGIC, self.size, 0, 0)
+        with open(self.path, 'wb') as f:
+            f.write(header.tobytes())
+            f.truncate(MAPPED_HEADER.itemsize + self.size * MAPPED_RECORD.itemsize)
+
+    @property
+    def head(self):
+        return int(self.header['head'][0])
+
+    @property
+    def tail(self):
+        return int(self.header['tail'][0])
+
+    @property
+    def empty(self):
+        return self.head == self.tail
+
+    @property
+    def used_count(self):
+        return (self.tail - self.head) % self.size
+
+    @property
+    def data(self):
+        if self.empty:
+            return None
+
+        head, tail = self.head, self.tail
+        if tail > head:
+            return np.array(self.store[head:tail])
+
+        return np.concatenate((self.store[head:], self.store[:tail]))
+
+    @property
+    def df(self):
+        if self.empty:
+            return None
+
+        data = self.data
+        return pd.DataFrame(
+            index=pd.to_datetime(data['timestamp'], unit='s', utc=True),
+            data=data['value']
+        )
+
+    def push(self, timestamp, value):
+        head, tail = self.head, self.tail
+        self.store[tail] = (timestamp, value)
+        tail = (tail + 1) % self.size
+        if head == tail:
+            head = (head + 1) % self.size
+
+        self.header['head'][0] = head
+        self.header['tail'][0] = tail
+        self.dirty = True
+
+    def flush(self):
+        if not self.dirty:
+            return
+
+        self.store.flush()
+        self.header.flush()
+        self.dirty = False
+
+    def close(self):
+        self.flush()
+        del self.store
+        del self.header
+
+    def pop(self):
+        pass
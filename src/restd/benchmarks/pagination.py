@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+restd collection GET benchmark.
+
+Full listing: peak memory and time to first byte of a buffered JSON
+response (the whole result list encoded at once) against a streamed one.
+
+Deep paging: per-page latency at increasing depths with ?offset= and with
+?after= cursors. The fake dispatcher behaves like the datastore does with
+an index on id: offset has to skip over rows one by one, while an
+('id', '>', value) filter seeks directly.
+
+Usage: python3 pagination.py [-n 100000] [-l 100]
+"""
+import argparse
+import bisect
+import itertools
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import base  # noqa
+import main  # noqa
+from freenas.dispatcher.client import StreamingResultIterator  # noqa
+
+
+class FakeRequest(object):
+    def __init__(self, params):
+        self.params = params
+        self.context = {}
+
+
+class FakeResponse(object):
+    def __init__(self):
+        self.headers = {}
+
+    def append_header(self, name, value):
+        self.headers[name] = value
+
+
+class FakeDispatcher(object):
+    def __init__(self, count):
+        self.rows = [{'id': i, 'name': 'tank/data@auto-{0:08d}'.format(i), 'properties': {'used': i * 4096}} for i in range(count)]
+        self.ids = [i['id'] for i in self.rows]
+
+    def query(self, filter, params):
+        start = 0
+        for name, op, value in filter:
+            assert name == 'id' and op == '>'
+            start = bisect.bisect_right(self.ids, value)
+
+        it = (self.rows[i] for i in range(start, len(self.rows)))
+        if params.get('offset'):
+            it = itertools.islice(it, params['offset'], None)
+
+        return list(itertools.islice(it, params['limit']))
+
+
+class Resource(base.ResourceQueryMixin):
+    pass
+
+
+def listing(rows, streamed):
+    start = time.perf_counter()
+    first = None
+    size = 0
+    if streamed:
+        for chunk in main.JSONTranslator().encode_stream(StreamingResultIterator(iter(rows))):
+            first = first or time.perf_counter() - start
+            size += len(chunk)
+    else:
+        # Former path: call_sync result materialized as a list, then encoded whole
+        body = main.JsonEncoder(indent=True).encode(list(rows)).encode('utf-8')
+        first = time.perf_counter() - start
+        size = len(body)
+        del body
+
+    return first, time.perf_counter() - start, size
+
+
+def peak_memory(fn, *args):
+    tracemalloc.start()
+    fn(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def get_page(resource, dispatcher, params):
+    req = FakeRequest(params)
+    resp = FakeResponse()
+    (filter, urlparams), _ = resource.run_get(req, {})
+    result = dispatcher.query(filter, urlparams)
+    if 'keyset' in req.context:
+        resource.set_next_cursor(req, resp, result)
+
+    main.JsonEncoder(indent=True).encode(result)
+    return resp.headers.get('Link')
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        rv = fn()
+
+    return (time.perf_counter() - start) / repeat * 1000, rv
+
+
+def main_():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', metavar='ROWS', type=int, default=100000)
+    parser.add_argument('-l', metavar='LIMIT', type=int, default=100)
+    parser.add_argument('-r', metavar='REPEAT', type=int, default=20)
+    args = parser.parse_args()
+
+    dispatcher = FakeDispatcher(args.n)
+    resource = Resource()
+    print('{0} rows'.format(args.n))
+
+    for label, streamed in (('buffered', False), ('streamed', True)):
+        first, total, size = listing(dispatcher.rows, streamed)
+        peak = peak_memory(listing, dispatcher.rows, streamed)
+        print('full listing {0}: first byte {1:.1f}ms, total {2:.1f}ms, peak {3:.1f}MB, {4:.1f}MB sent'.format(
+            label, first * 1000, total * 1000, peak / 2 ** 20, size / 2 ** 20
+        ))
+
+    for depth in sorted({d for d in (args.l, 1000, 10000, args.n // 2, args.n - args.l) if args.l <= d < args.n}):
+        offset_ms, _ = timed(lambda: get_page(resource, dispatcher, {'limit': str(args.l), 'offset': str(depth)}), args.r)
+
+        # Cursor the page ending right before row depth would come with
+        req = FakeRequest({'limit': str(args.l)})
+        req.context['keyset'] = {'sort': ['id'], 'limit': args.l}
+        resp = FakeResponse()
+        resource.set_next_cursor(req, resp, dispatcher.rows[depth - args.l:depth])
+        link = resp.headers['Link']
+        after = link[link.index('after=') + 6:link.index('>')]
+        after_ms, _ = timed(lambda: get_page(resource, dispatcher, {'limit': str(args.l), 'after': after}), args.r)
+        print('page at depth {0}: offset {1:.2f}ms, after {2:.2f}ms'.format(depth, offset_ms, after_ms))
+
+
+if __name__ == '__main__':
+    main_()
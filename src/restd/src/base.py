@@ -1,8 +1,13 @@
+import base64
+import binascii
 import falcon
 import logging
 import pprint
 
+import freenas.utils.query as q
+from freenas.dispatcher.jsonenc import dumps, loads
 from freenas.dispatcher.rpc import RpcException
+from urllib.parse import urlencode
 
 from swagger import normalize_schema
 
@@ -243,6 +248,7 @@ class ResourceQueryMixin:
 
     def run_get(self, req, urlparams):
         args = []
+        after = None
         for key, val in req.params.items():
             if '__' in key:
                 field, op = key.split('__', 1)
@@ -265,6 +271,9 @@ class ResourceQueryMixin:
             elif key == 'sort':
                 urlparams[key] = [convert(v) for v in val.split(',')]
                 continue
+            elif key == 'after':
+                after = val
+                continue
 
             op_map = {
                 'eq': '=',
@@ -288,8 +297,71 @@ class ResourceQueryMixin:
                 val = None
             args.append((field, op, val))
 
+        if after is not None or ('limit' in urlparams and not urlparams.get('count')):
+            self.run_keyset(req, args, urlparams, after)
+
         return [args, urlparams], {}
 
+    def run_keyset(self, req, args, urlparams, after):
+        """
+        Keyset pagination: pages are ordered by the requested sort keys plus
+        id, and ?after=<cursor> continues right past the last row of the
+        previous page using a filter instead of an offset. Limited requests
+        using offset get the same stable order, so their pages don't overlap.
+        """
+        sort = urlparams.get('sort') or []
+        if 'id' not in sort and '-id' not in sort:
+            sort = sort + ['id']
+
+        if after is not None:
+            if 'offset' in urlparams:
+                raise falcon.HTTPBadRequest('Invalid cursor', 'Cannot use both offset and after')
+
+            try:
+                token = after + '=' * (-len(after) % 4)
+                cursor = loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+                cursor_sort, values = cursor
+                if not all((
+                    isinstance(cursor_sort, list), isinstance(values, list),
+                    cursor_sort, len(values) == len(cursor_sort),
+                    all(isinstance(k, str) and k.lstrip('-') for k in cursor_sort),
+                    not any(isinstance(v, (dict, list)) for v in values)
+                )):
+                    raise ValueError('Malformed cursor')
+            except (ValueError, TypeError, binascii.Error):
+                raise falcon.HTTPBadRequest('Invalid cursor', 'Cannot decode after cursor')
+
+            if 'sort' in urlparams and cursor_sort != sort:
+                raise falcon.HTTPBadRequest('Invalid cursor', 'Cursor was issued for a different sort order')
+
+            sort = cursor_sort
+            args.append(self.keyset_filter(sort, values))
+
+        urlparams['sort'] = sort
+        req.context['keyset'] = {'sort': sort, 'limit': urlparams.get('limit')}
+
+    def keyset_filter(self, sort, values):
+        # (k1, k2, ...) > (v1, v2, ...) expanded into or'ed prefix matches
+        clauses = []
+        for i, key in enumerate(sort):
+            terms = [(k.lstrip('-'), '=', v) for k, v in zip(sort[:i], values[:i])]
+            terms.append((key.lstrip('-'), '<' if key.startswith('-') else '>', values[i]))
+            clauses.append(terms[0] if len(terms) == 1 else ('and', terms))
+
+        return clauses[0] if len(clauses) == 1 else ('or', clauses)
+
+    def set_next_cursor(self, req, resp, result):
+        sort = req.context['keyset']['sort']
+        limit = req.context['keyset']['limit']
+        if not limit or len(result) < limit:
+            return
+
+        values = [q.get(result[-1], key.lstrip('-')) for key in sort]
+        params = dict(req.params)
+        params.pop('offset', None)
+        params['after'] = base64.urlsafe_b64encode(dumps([sort, values]).encode('utf-8')).decode('ascii').rstrip('=')
+        resp.append_header('Link', '<?{0}>; rel="next"'.format(urlencode(params, doseq=True)))
+
 
 class EntityResource(Resource, ResourceQueryMixin):
 
@@ -311,6 +383,11 @@ class EntityResource(Resource, ResourceQueryMixin):
                 else:
                     raise NotImplementedError('{0} not implemented'.format(typ))
             resp.status = falcon.HTTP_201
+        elif method == 'get' and req.context.get('keyset', {}).get('limit'):
+            # Pages are bounded, so they are sent as a whole along with
+            # the cursor of the next one
+            rv = req.context['result'] = list(rv)
+            self.set_next_cursor(req, resp, rv)
         return rv
 
     def run_post(self, req, urlparams):
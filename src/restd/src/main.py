@@ -4,7 +4,9 @@ import errno
 import falcon
 import gevent
 import glob
+import hashlib
 import importlib.machinery
+import itertools
 import json
 import logging
 import os
@@ -12,7 +14,9 @@ import signal
 import sys
 import time
 
-from freenas.dispatcher.client import Client, ClientError
+from collections import Counter, OrderedDict
+from threading import RLock
+from freenas.dispatcher.client import Client, ClientError, StreamingResultIterator
 from freenas.dispatcher.rpc import RpcException
 from freenas.utils import configure_logging
 from gevent.pywsgi import WSGIHandler, WSGIServer
@@ -21,6 +25,17 @@ from serializers import JsonEncoder
 from swagger import SwaggerResource
 
 
+SESSION_POOL_SIZE = 32
+SESSION_TTL = 60
+STREAM_BATCH_SIZE = 256
+RESPONSE_CACHE_SIZE = 64
+RESPONSE_CACHE_MAX_BODY = 1024 * 1024
+
+# Namespaces whose query results only change along with their .changed
+# events. Others (ie. service, with its live state) must not be cached.
+ETAG_NAMESPACES = ('disk', 'volume', 'network.interface')
+
+
 class RESTWSGIHandler(WSGIHandler):
 
     def get_environ(self):
@@ -60,11 +75,175 @@ class JSONTranslator(object):
 
     def process_response(self, req, resp, resource):
         if 'result' in req.context:
-            resp.body = JsonEncoder(indent=True).encode(req.context['result'])
+            result = req.context['result']
+            if isinstance(result, StreamingResultIterator):
+                resp.stream = self.encode_stream(result)
+                return
+
+            resp.body = JsonEncoder(indent=True).encode(result)
+
+    def encode_stream(self, result):
+        # Sends the JSON array in chunks as the dispatcher streams it in.
+        # Each batch is encoded as a list and spliced into the outer one,
+        # which yields exactly what encoding the whole result would.
+        encoder = JsonEncoder(indent=True)
+        sep = '['
+        while True:
+            batch = list(itertools.islice(result, STREAM_BATCH_SIZE))
+            if not batch:
+                break
+
+            yield (sep + encoder.encode(batch)[1:-2]).encode('utf-8')
+            sep = ','
+
+        yield b'[]' if sep == '[' else b'\n]'
+
+
+class SessionPool(object):
+    """
+    Keeps authenticated dispatcher connections around between requests.
+    Idle connections are keyed by a salted digest of the credentials they
+    were opened with and are dropped after ttl seconds or when the pool
+    grows beyond size.
+    """
+
+    def __init__(self, size=SESSION_POOL_SIZE, ttl=SESSION_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.salt = os.urandom(16)
+        self.lock = RLock()
+        self.idle = OrderedDict()
+        self.active = {}
+        self.session_ids = set()
+
+    def digest(self, username, password):
+        return hashlib.sha256(self.salt + '{0}:{1}'.format(username, password).encode('utf-8')).digest()
+
+    def acquire(self, username, password):
+        key = self.digest(username, password)
+        with self.lock:
+            for client, session in reversed(self.idle.items()):
+                if session['key'] == key and self.is_fresh(session):
+                    del self.idle[client]
+                    self.active[client] = session
+                    return client
+
+        client = Client()
+        client.connect('unix:')
+        try:
+            client.login_user(username, password, check_password=True)
+            client.call_sync('management.enable_features', ['streaming_responses'])
+            session_id = client.call_sync('session.get_my_session_id')
+        except:
+            client.disconnect()
+            raise
+
+        client.on_error(lambda reason, **kwargs: self.discard(client))
+        with self.lock:
+            self.session_ids.add(session_id)
+            self.active[client] = {
+                'key': key,
+                'username': username,
+                'session_id': session_id,
+                'created_at': time.monotonic()
+            }
+
+        return client
+
+    def release(self, client, reuse=True):
+        with self.lock:
+            session = self.active.pop(client, None)
+            if session and reuse and self.is_fresh(session):
+                self.idle[client] = session
+                client = None
+
+            evicted = []
+            while len(self.idle) > self.size:
+                evicted.append(self.idle.popitem(last=False))
+
+            if client and session:
+                evicted.append((client, session))
+
+        self.close(evicted)
+
+    def discard(self, client):
+        with self.lock:
+            self.idle.pop(client, None)
+            self.active.pop(client, None)
+
+    def is_fresh(self, session):
+        return time.monotonic() - session['created_at'] < self.ttl
+
+    def close(self, sessions):
+        for client, session in sessions:
+            client.disconnect()
+
+    def on_client_logout(self, username, session_id=None):
+        # Our own connections show up as server.client_logout events too,
+        # these must not invalidate the remaining sessions of the same user
+        with self.lock:
+            if session_id in self.session_ids:
+                self.session_ids.remove(session_id)
+                return
+
+        self.invalidate(username)
+
+    def forget_closed(self):
+        # Logout events sent while the event connection was down are lost,
+        # drop the ids that aren't backing a pooled connection anymore
+        with self.lock:
+            self.session_ids = {s['session_id'] for s in itertools.chain(self.idle.values(), self.active.values())}
+
+    def invalidate(self, username=None):
+        with self.lock:
+            # In-flight sessions get disconnected once their request is done
+            for session in self.active.values():
+                if username is None or session['username'] == username:
+                    session['created_at'] = float('-inf')
+
+            expired = [(c, s) for c, s in self.idle.items() if username is None or s['username'] == username]
+            for c, s in expired:
+                del self.idle[c]
+
+        self.close(expired)
+
+    def expire(self):
+        with self.lock:
+            expired = [(c, s) for c, s in self.idle.items() if not self.is_fresh(s)]
+            for c, s in expired:
+                del self.idle[c]
+
+        self.close(expired)
+
+
+class SessionStream(object):
+    """
+    Response stream which holds on to its dispatcher connection until the
+    WSGI server closes it. Connections of streams that didn't run to the
+    end still have results in flight, so these are not reused.
+    """
+
+    def __init__(self, sessions, client, stream):
+        self.sessions = sessions
+        self.client = client
+        self.stream = stream
+        self.done = False
+
+    def __iter__(self):
+        yield from self.stream
+        self.done = True
+
+    def close(self):
+        if self.client:
+            self.sessions.release(self.client, self.done)
+            self.client = None
 
 
 class AuthMiddleware(object):
 
+    def __init__(self, sessions):
+        self.sessions = sessions
+
     def process_request(self, req, resp):
         # Do not require auth to access index
         if req.relative_uri == '/':
@@ -87,10 +266,7 @@ class AuthMiddleware(object):
             )
 
         try:
-            client = Client()
-            client.connect('unix:')
-            client.login_user(username, password, check_password=True)
-            req.context['client'] = client
+            req.context['client'] = self.sessions.acquire(username, password)
         except RpcException as e:
             if e.code == errno.EACCES:
                 raise falcon.HTTPUnauthorized(
@@ -102,7 +278,105 @@ class AuthMiddleware(object):
 
     def process_response(self, req, resp, resource):
         if 'client' in req.context:
-            req.context['client'].disconnect()
+            if resp.stream is not None:
+                resp.stream = SessionStream(self.sessions, req.context['client'], resp.stream)
+                return
+
+            self.sessions.release(req.context['client'])
+
+
+class ETagMiddleware(object):
+    """
+    Conditional GETs for resources backed by <namespace>.query or
+    <namespace>.get_config of namespaces in ETAG_NAMESPACES, which the
+    dispatcher has a <namespace>.changed event type for. Each namespace has
+    a generation counter bumped by these events, and the ETag is derived
+    from it. A matching If-None-Match gets
+    a 304 and recently rendered bodies are served again, both without
+    calling the dispatcher, until the generation moves on.
+    """
+
+    def __init__(self, size=RESPONSE_CACHE_SIZE):
+        self.size = size
+        self.epoch = binascii.hexlify(os.urandom(4)).decode('ascii')
+        self.lock = RLock()
+        self.namespaces = set()
+        self.generations = Counter()
+        self.bodies = OrderedDict()
+
+    def add_namespace(self, namespace):
+        self.namespaces.add(namespace)
+
+    def changed(self, namespace=None):
+        with self.lock:
+            for ns in ([namespace] if namespace else self.namespaces):
+                self.generations[ns] += 1
+
+            for key in [k for k in self.bodies if namespace is None or k[0] == namespace]:
+                del self.bodies[key]
+
+    def get_namespace(self, resource):
+        method = getattr(resource, 'get', None)
+        if not method or not method.startswith('rpc:'):
+            return None
+
+        namespace, name = method[4:].rsplit('.', 1)
+        if name not in ('query', 'get_config') or namespace not in self.namespaces:
+            return None
+
+        return namespace
+
+    def process_resource(self, req, resp, resource, params):
+        namespace = self.get_namespace(resource)
+        if not namespace or req.method != 'GET':
+            return
+
+        key = (namespace, req.relative_uri)
+        with self.lock:
+            generation = self.generations[namespace]
+            cached = self.bodies.get(key)
+            if cached and cached[0] == generation:
+                self.bodies.move_to_end(key)
+            else:
+                cached = None
+
+        etag = '"{0}-{1}"'.format(self.epoch, generation)
+        req.context['etag'] = (namespace, generation, etag)
+        if etag in [t.strip() for t in (req.get_header('If-None-Match') or '').split(',')]:
+            raise falcon.HTTPStatus(falcon.HTTP_304, headers={'ETag': etag})
+
+        if cached:
+            raise falcon.HTTPStatus(falcon.HTTP_200, headers=dict(cached[2], ETag=etag), body=cached[1])
+
+    def process_response(self, req, resp, resource):
+        namespace = self.get_namespace(resource)
+        if not namespace:
+            return
+
+        if req.method != 'GET':
+            # Don't wait for the change event to arrive
+            self.changed(namespace)
+            return
+
+        if 'etag' not in req.context or resp.status != falcon.HTTP_200 or 'result' not in req.context:
+            return
+
+        namespace, generation, etag = req.context['etag']
+        resp.set_header('ETag', etag)
+        if resp.body is None or len(resp.body) > RESPONSE_CACHE_MAX_BODY:
+            return
+
+        link = resp.get_header('Link')
+        headers = {'Link': link} if link else {}
+        with self.lock:
+            if self.generations[namespace] != generation:
+                return
+
+            key = (namespace, req.relative_uri)
+            self.bodies[key] = (generation, resp.body, headers)
+            self.bodies.move_to_end(key)
+            while len(self.bodies) > self.size:
+                self.bodies.popitem(last=False)
 
 
 class RESTApi(object):
@@ -116,8 +390,11 @@ class RESTApi(object):
         self._used_schemas = set()
         self._services = {}
         self._tasks = {}
+        self.sessions = SessionPool()
+        self.etags = ETagMiddleware()
         self.api = falcon.API(middleware=[
-            AuthMiddleware(),
+            AuthMiddleware(self.sessions),
+            self.etags,
             JSONTranslator(),
         ])
         self.api.add_route('/', SwaggerResource(self))
@@ -128,11 +405,22 @@ class RESTApi(object):
         def on_error(reason, **kwargs):
             if reason in (ClientError.CONNECTION_CLOSED, ClientError.LOGOUT):
                 self.logger.warning('Connection to dispatcher lost')
+                # Change events might get lost while reconnecting
+                self.etags.changed()
+                self.sessions.forget_closed()
                 self.connect()
 
+        def on_client_logout(args):
+            self.sessions.on_client_logout(args['username'], args.get('session_id'))
+
+        def on_user_changed(args):
+            self.sessions.invalidate()
+
         self.dispatcher = Client()
         self.dispatcher.on_error(on_error)
         self.connect()
+        self.dispatcher.register_event_handler('server.client_logout', on_client_logout)
+        self.dispatcher.register_event_handler('user.changed', on_user_changed)
 
     def init_metadata(self):
         self._tasks = self.dispatcher.call_sync('discovery.get_tasks')
@@ -142,6 +430,16 @@ class RESTApi(object):
             for method in self._services[service]:
                 self._rpcs['{0}.{1}'.format(service, method['name'])] = method
 
+        def on_changed(namespace):
+            return lambda args: self.etags.changed(namespace)
+
+        event_types = self.dispatcher.call_sync('discovery.get_event_types')
+        for namespace in ETAG_NAMESPACES:
+            name = '{0}.changed'.format(namespace)
+            if name in event_types:
+                self.etags.add_namespace(namespace)
+                self.dispatcher.register_event_handler(name, on_changed(namespace))
+
     def load_plugins(self):
         pluginsdir = os.path.realpath(os.path.join(os.path.dirname(__file__), '..', 'plugins'))
         for i in glob.glob1(pluginsdir, "*.py"):
@@ -168,6 +466,11 @@ class RESTApi(object):
             environ['PATH_INFO'] = environ.get('PATH_INFO', '').replace('/api/v2.0', '', 1)
         return self.api.__call__(environ, start_response)
 
+    def expire_sessions(self):
+        while True:
+            gevent.sleep(self.sessions.ttl)
+            self.sessions.expire()
+
     def register_crud(self, klass):
         ins = klass(self, self.dispatcher)
         self._cruds.append(ins)
@@ -184,7 +487,7 @@ class RESTApi(object):
         self.load_plugins()
 
         server4 = WSGIServer(('', 8889), self, handler_class=RESTWSGIHandler)
-        self._threads = [gevent.spawn(server4.serve_forever)]
+        self._threads = [gevent.spawn(server4.serve_forever), gevent.spawn(self.expire_sessions)]
         gevent.joinall(self._threads)
 
     def die(self, *args):
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Load test for restd authentication. Hammers a cheap read-only resource
+from a number of concurrent clients, each request carrying Basic
+credentials like a monitoring system polling the API would, and reports
+requests/s and latency percentiles. Run it against a build before and
+after a change to compare.
+
+Usage: ./loadtest.py -a freenas.local -u root -p secret [-c 8] [-n 2000]
+"""
+import argparse
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from client import Client
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-a', '--address', required=True)
+    parser.add_argument('-u', '--username', required=True)
+    parser.add_argument('-p', '--password', required=True)
+    parser.add_argument('-P', '--port')
+    parser.add_argument('-c', '--concurrency', default=8, type=int)
+    parser.add_argument('-n', '--requests', default=2000, type=int)
+    parser.add_argument('-r', '--resource', default='system/info/version')
+    args = parser.parse_args()
+
+    client = Client(
+        'http://{0}{1}'.format(args.address, ':{0}'.format(args.port) if args.port else ''),
+        '/api/v2.0/',
+        username=args.username,
+        password=args.password,
+    )
+
+    def request(_):
+        start = time.perf_counter()
+        r = client.get(args.resource)
+        return r.status_code, time.perf_counter() - start
+
+    # Warm up, so that the first logins aren't part of the measurement
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        list(executor.map(request, range(args.concurrency)))
+
+        start = time.perf_counter()
+        results = list(executor.map(request, range(args.requests)))
+        elapsed = time.perf_counter() - start
+
+    latencies = sorted(t for _, t in results)
+    errors = sum(1 for status, _ in results if status != 200)
+    print('{0} requests, {1} concurrent, {2} errors'.format(len(results), args.concurrency, errors))
+    print('{0:.1f} requests/s'.format(len(results) / elapsed))
+    print('latency: p50 {0:.1f}ms, p90 {1:.1f}ms, p99 {2:.1f}ms'.format(
+        latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.9)] * 1000,
+        latencies[int(len(latencies) * 0.99)] * 1000
+    ))
+
+
+if __name__ == '__main__':
+    main()